@@ -52,7 +52,7 @@ print("######## Connecting to DB: %s", DATABASES)
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "dtr5app.cache_backends.MetricsRedisCache",
         "LOCATION": "redis://%s:%s/1" % (os.environ.get("REDIS_HOST", "localhost"), os.environ.get("REDIS_PORT", "6379")),
         "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient",},
     }
@@ -75,6 +75,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    "dtr5app.middleware.RequestMetricsMiddleware",
     # 'dtr5app.middleware.CheckSiteTemporarilyUnavailable',
     # 'dtr5app.middleware.CheckSiteUnavailableIfSiteIsOnlineNotFound',
     "django.middleware.common.BrokenLinkEmailsMiddleware",
@@ -88,7 +89,7 @@ MIDDLEWARE = (
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     # 'dtr5app.middleware.UserSetDefaultLocalizationValues',
-    # 'dtr5app.middleware.UserProfileLastActiveMiddleware',
+    "dtr5app.middleware.UserProfileLastActiveMiddleware",
 )
 
 ROOT_URLCONF = "dtr5.urls"
@@ -164,7 +165,57 @@ SEARCH_RESULTS_BUFFER_SIZE = 100  # unused?
 
 LINKS_IN_PROFILE_HEADER = 5
 RESULTS_BUFFER_TIMEOUT = 10  # minutes until search result cache refresh
+RESULTS_BUFFER_MAX_AGE = 60  # minutes until a full search, not incremental
 RESULTS_BUFFER_LEN = 1000  # usernames in search result cache
+
+# Run searches on the in-memory match index ("index"), or as one raw SQL
+# query per search ("sql").
+SEARCH_BACKEND = "index"
+MATCH_INDEX_TIMEOUT = 10  # minutes until the match index is rebuilt
+
+# Share search results between all users with the same favorite subreddits
+# and search options for so many minutes. 0 to search for every user. Auth
+# user's location is rounded to a geo cell of SEARCH_CACHE_GEO_CELL times
+# their search distance.
+SEARCH_CACHE_TIMEOUT = 10
+SEARCH_CACHE_GEO_CELL = 0.05
+
+# Leave full searches to the search worker (manage.py search_worker) and show
+# the last search results meanwhile. If a queued search job didn't finish
+# after SEARCH_JOB_TIMEOUT seconds, search within the request again.
+SEARCH_ASYNC = True
+SEARCH_JOB_TIMEOUT = 60
+
+# Buffer profile counter increments (views, likes, matches) in Redis and write
+# them to the database with "manage.py flush_profile_counters" instead of one
+# UPDATE per increment. Buffered counts show up after the next flush.
+PROFILE_COUNTERS_BUFFERED = False
+
+# Write users' last activity (Profile.accessed) to the database at most once
+# every ACTIVITY_FLUSH_INTERVAL seconds, and keep ACTIVITY_LIVE_WINDOW seconds
+# of it in Redis to count active users, see utils_activity.
+ACTIVITY_FLUSH_INTERVAL = 60
+ACTIVITY_LIVE_WINDOW = 15 * 60
+
+# Keep the VISITORS_LIST_MAX most recent visitors of every profile in Redis,
+# for VISITORS_TIMEOUT seconds after the last visit, see utils_visitors.
+VISITORS_LIST_MAX = 1000
+VISITORS_TIMEOUT = 30 * 86400
+
+# Seconds until the stats page values are refreshed in the background.
+STATS_CACHE_TIMEOUT = 60
+
+# Per-view request metrics, see utils_metrics. The SQL of every query is only
+# kept for this fraction of requests, to list the slowest queries per view.
+METRICS_QUERY_SAMPLE_RATE = 0.01
+
+# User map tiles are cached for MAP_TILE_TIMEOUT seconds. From zoom level
+# MAP_POINTS_ZOOM on, tiles with up to MAP_POINTS_MAX users show every single
+# user instead of clusters, see utils_map.
+MAP_TILE_TIMEOUT = 60
+MAP_POINTS_ZOOM = 10
+MAP_POINTS_MAX = 250
+
 USER_MAX_PICS_COUNT = 10  # max number of linked pics in user profile
 
 # Ignore subreddits too small or too large.
@@ -174,12 +225,19 @@ SR_MAX_SUBS = 5000000  # unused
 # How many subreddits to use at a time to find matches.
 SR_LIMIT = 50
 
+# Subreddits with a lower Sr.weight are not considered in search at all. The
+# weight is ln(users / subscribers_here), so 0.1 ignores subreddits that
+# more than ~90% of all users here are subscribed to. 0.0 to use all.
+SR_WEIGHT_MIN = 0.0
+
 # How many favorite subreddits can a user select.
 SR_FAVS_COUNT_MAX = 10
 
 # How many users to show per page (subreddit view, match view, likes view, ..)
 USERS_PER_PAGE = 20
 USERS_ORPHANS = 0
+# Seconds to cache the approximate total of cursor paginated lists.
+KEYSET_COUNT_TIMEOUT = 300
 
 # Limit number of subreddits to fetch
 SR_FETCH_LIMIT = 200  # None to fetch all
@@ -431,10 +489,12 @@ PREFERENCE = (  # bitmap  # unused
 
 ORDER_BY = (
     ("-sr_count", "best matches"),
+    ("-sr_weight", "best matches, small subs first"),
     ("-accessed", "recently active"),
     # ('reddit_joined', 'reddit oldest'), --> no, b/c "created" data bug.
     ("-date_joined", "newest members"),
     ("-views_count", "most viewed"),
+    ("distance", "nearest first"),
     # ('accessed', ''),
     # ('date_joined', ''),
     # ('views_count', ''),
@@ -61,8 +61,29 @@ urlpatterns = [
         views_mod.mod_report_view,
         name="mod_report_item_page",
     ),
+    re_path(
+        r"^mod/search-cache.json$",
+        views_mod.mod_search_cache_view,
+        name="mod_search_cache",
+    ),
+    re_path(
+        r"^mod/search-jobs.json$",
+        views_mod.mod_search_jobs_view,
+        name="mod_search_jobs",
+    ),
+    re_path(r"^mod/metrics.json$", views_mod.mod_metrics_view, name="mod_metrics"),
+    re_path(
+        r"^mod/metrics.txt$",
+        views_mod.mod_metrics_prometheus_view,
+        name="mod_metrics_prometheus",
+    ),
     re_path(r"^stats/$", views.stats_view, name="stats"),
     re_path(r"^map/$", views.usermap_view, name="usermap"),
+    re_path(
+        r"^map/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+).json$",
+        views.usermap_tile_view,
+        name="usermap_tile",
+    ),
     # API URLs
     re_path(
         r"^api/v1/filter-members.json$",
@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Profile, Flag, Sr, Subscribed, Report, \
-    PushNotificationEndpoint, Message
+from .models import Profile, Flag, Match, Sr, Subscribed, Report, \
+    PushNotificationEndpoint, Conversation, Message
 
 
 class ProfileAdmin(admin.ModelAdmin):
@@ -21,6 +21,10 @@ class FlagAdmin(admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'flag', 'created', )
 
 
+class MatchAdmin(admin.ModelAdmin):
+    list_display = ('user', 'match_user', 'created', )
+
+
 class ReportAdmin(admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'created', 'resolved', 'reason', )
 
@@ -29,6 +33,11 @@ class PushNotificationEndpointAdmin(admin.ModelAdmin):
     list_display = ('user', 'sub', )
 
 
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user1', 'user2', 'last_message_at',
+                    'user1_unread', 'user2_unread', )
+
+
 class MessageAdmin(admin.ModelAdmin):
     fields = ('id', 'sender', 'receiver', 'created')  # TODO: as text!
     list_display = ('id', 'sender', 'receiver', 'created', )
@@ -38,6 +47,8 @@ admin.site.register(Profile, ProfileAdmin)
 admin.site.register(Sr, SrAdmin)
 admin.site.register(Subscribed, SubscribedAdmin)
 admin.site.register(Flag, FlagAdmin)
+admin.site.register(Match, MatchAdmin)
 admin.site.register(Report, ReportAdmin)
 admin.site.register(PushNotificationEndpoint, PushNotificationEndpointAdmin)
+admin.site.register(Conversation, ConversationAdmin)
 admin.site.register(Message, MessageAdmin)
@@ -6,3 +6,9 @@ from django.apps import AppConfig
 class Dtr5appConfig(AppConfig):
     name = 'dtr5app'
     verbose_name = "Dtr5app"
+
+    def ready(self):
+        # Connect the signal receivers that invalidate shared search results
+        # and queue search jobs on login.
+        from dtr5app import utils_search_cache  # noqa: F401
+        from dtr5app import utils_search_jobs  # noqa: F401
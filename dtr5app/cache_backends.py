@@ -0,0 +1,11 @@
+"""
+Cache backends that count hits and misses for the request metrics, see
+utils_metrics.
+"""
+from django_redis.cache import RedisCache
+
+from dtr5app.utils_metrics import MetricsCacheMixin
+
+
+class MetricsRedisCache(MetricsCacheMixin, RedisCache):
+    pass
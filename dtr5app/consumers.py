@@ -3,10 +3,9 @@ import json
 from channels import Channel, Group
 from channels.auth import channel_session_user, channel_session_user_from_http
 from django.contrib.auth.models import User
-from django.db.models import Max
 from django.shortcuts import get_object_or_404
 
-from dtr5app.models import Message, Subscribed
+from dtr5app.models import Conversation, Message, Subscribed
 from dtr5app.serializers import MessageSerializer
 from dtr5app.utils_common import json_serializer_helper
 from dtr5app.utils_push_notifications import simple_push_notification
@@ -18,8 +17,8 @@ def get_group_id_for_user(user):
     return 'user-{}'.format(user.id)
 
 
-def get_msg_data(after, user1, user2):
-    obj = Message.get_messages_list(after, user1, user2)
+def get_msg_data(after, user1, user2, before=None):
+    obj = Message.get_messages_list(after, user1, user2, before)
     return MessageSerializer(obj, many=True).data
 
 
@@ -28,14 +27,9 @@ def get_request_object(message_object):
 
 
 def get_user_list_by_latest_message_sent(user):
-    """For User user, return all User objects that recently sent a chat
-    message."""
-    user_list = User.objects\
-        .filter(sent_messages__receiver=user)\
-        .annotate(latest=Max('sent_messages__created'))\
-        .values('id', 'username', 'latest')\
-        .order_by()[:50]
-    return user_list
+    """For User user, return the 50 users with the most recent chat
+    messages sent or received, see Conversation.get_chat_list()."""
+    return Conversation.get_chat_list(user, 50)
 
 
 @channel_session_user
@@ -54,7 +48,9 @@ def chat_init(message):
     payload = get_request_object(message)
     sender_group = get_group_id_for_user(message.user)
     view_user = get_object_or_404(User, username=payload['view_user'])
-    msg_list = get_msg_data(payload['after'], message.user, view_user)
+    msg_list = get_msg_data(payload['after'], message.user, view_user,
+                            payload.get('before'))
+    Conversation.mark_read(message.user, view_user)
     resp = {'action': 'chat.init', 'msg_list': msg_list}
     Group(sender_group).send({'text': json.dumps(resp)})
 
@@ -68,7 +64,7 @@ def chat_receive(message):
     sender_group = get_group_id_for_user(sender)
     receiver_group = get_group_id_for_user(receiver)
 
-    obj = Message.objects.create(msg=msg, sender=sender, receiver=receiver)
+    obj = Conversation.add_message(sender, receiver, msg)
     msg_obj = MessageSerializer(obj, many=False).data
     resp = {'action': 'chat.receive', 'msg_list': [msg_obj]}
 
@@ -0,0 +1,20 @@
+"""
+Rebuild the Match table from all mutual likes in the Flag table. The table
+is kept up to date by Flag.set_flag() and Flag.delete_flag(), so this is only
+needed once after the Match table was added, or to repair it.
+"""
+
+from django.core.management.base import BaseCommand
+from dtr5app.utils import rebuild_matches
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Match table from all mutual like flags.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of user ids per transaction.')
+
+    def handle(self, *args, **options):
+        count = rebuild_matches(batch_size=options['batch_size'])
+        self.stdout.write('Found {} matches.'.format(count))
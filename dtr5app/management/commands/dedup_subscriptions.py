@@ -0,0 +1,33 @@
+"""
+Remove all "double subscriptions", more than one Subscribed row for the same
+user and subreddit, and recount Sr.subscribers_here and the search weights of
+the subreddits involved. Run this before migration 0048, which adds a unique
+constraint on (user, sr) to the Subscribed table, and afterwards with --all,
+to repair the subscriber counts of all subreddits.
+"""
+
+from django.core.management.base import BaseCommand
+from dtr5app.utils import (count_subscribers_here, dedup_subscriptions,
+                           update_sr_weights)
+
+
+class Command(BaseCommand):
+    help = 'Remove double subscriptions and recount subreddit subscribers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of double subscriptions per delete.')
+        parser.add_argument('--all', action='store_true',
+                            help='Recount the subscribers of all subreddits.')
+
+    def handle(self, *args, **options):
+        sr_ids = dedup_subscriptions(batch_size=options['batch_size'])
+        self.stdout.write('Found double subscriptions in {} subreddits.'
+                          .format(len(sr_ids)))
+
+        if options['all']:
+            sr_ids = None
+        count = count_subscribers_here(sr_ids)
+        update_sr_weights(sr_ids, refresh=True)
+        self.stdout.write('Recounted the subscribers of {} subreddits.'
+                          .format(count))
@@ -0,0 +1,31 @@
+"""
+Write the buffered profile counter increments to the database, see
+utils_counters. Only needed with PROFILE_COUNTERS_BUFFERED, run it every
+minute or so from cron, or keep it running with --loop.
+"""
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from dtr5app.utils_counters import flush_profile_counters
+
+
+class Command(BaseCommand):
+    help = 'Write buffered profile counters to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, dest='batch_size',
+                            default=1000, help='Profiles per batch.')
+        parser.add_argument('--loop', type=int, dest='loop', default=0,
+                            help='Flush again every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            count = flush_profile_counters(options['batch_size'])
+            if options['verbosity'] > 1:
+                self.stdout.write('Updated {} profiles.'.format(count))
+            if not options['loop']:
+                break
+            sleep(options['loop'])
@@ -43,7 +43,7 @@ class Command(BaseCommand):
                 print(s.format(p.user_id, p.lat, p.lng, nlng))
                 p.lng = nlng
                 if save:
-                    p.save()
+                    p.save(update_fields=['lng'])
                 count += 1
 
         return count
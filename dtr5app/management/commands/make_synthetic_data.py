@@ -0,0 +1,56 @@
+"""
+Fill the database with a synthetic population of users, to measure the site
+at a realistic scale with the "run_benchmark" command, see utils_synthetic.
+For example, for 10k, 100k and 1M users:
+
+    ./manage.py make_synthetic_data --users 10000
+    ./manage.py run_benchmark --output bench-10k.json
+    ./manage.py make_synthetic_data --users 90000 --seed 1
+    ./manage.py run_benchmark --output bench-100k.json
+    ./manage.py make_synthetic_data --users 900000 --seed 2
+    ./manage.py run_benchmark --output bench-1m.json
+
+Never run this on the production database. Remove all synthetic data again
+with --delete.
+"""
+
+from django.core.management.base import BaseCommand
+from dtr5app.utils_synthetic import delete_synthetic_data, make_synthetic_data
+
+
+class Command(BaseCommand):
+    help = 'Create synthetic users, subscriptions, flags, visits and messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000,
+                            help='Number of users to add.')
+        parser.add_argument('--srs', type=int, default=2000,
+                            help='Number of synthetic subreddits.')
+        parser.add_argument('--subs', type=int, default=25,
+                            help='Average subscriptions per user.')
+        parser.add_argument('--flags', type=int, default=10,
+                            help='Average likes and nopes sent per user.')
+        parser.add_argument('--visits', type=int, default=10,
+                            help='Average profile visits per user.')
+        parser.add_argument('--messages', type=int, default=5,
+                            help='Average messages sent per user.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed, use a new one for every run.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of users per transaction.')
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete all synthetic data instead.')
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            count = delete_synthetic_data()
+            self.stdout.write('Deleted {} synthetic users.'.format(count))
+            return
+
+        count = make_synthetic_data(
+            users=options['users'], srs=options['srs'],
+            subs_per_user=options['subs'], flags_per_user=options['flags'],
+            visits_per_user=options['visits'],
+            messages_per_user=options['messages'], seed=options['seed'],
+            batch_size=options['batch_size'])
+        self.stdout.write('Created {} synthetic users.'.format(count))
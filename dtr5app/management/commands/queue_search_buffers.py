@@ -0,0 +1,37 @@
+"""
+Queue search buffer jobs for all recently active users, so that their search
+results are up to date before they need them. Run this every few minutes,
+with the search worker running.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import now
+
+from dtr5app.models import Profile
+from dtr5app.utils_search import SearchBuffer
+from dtr5app.utils_search_jobs import queue_search_job
+
+
+class Command(BaseCommand):
+    help = 'Queue search buffer jobs for recently active users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, dest='minutes', default=30,
+                            help='Users active within so many minutes.')
+
+    def handle(self, *args, **options):
+        since = now() - timedelta(minutes=options['minutes'])
+        user_ids = Profile.objects.filter(
+            Q(accessed__gte=since) | Q(user__last_login__gte=since),
+            user__is_active=True,
+        ).values_list('user_id', flat=True)
+
+        count = 0
+        for user_id in user_ids.iterator():
+            # Keep the search results order of the user's last search.
+            order_by = SearchBuffer.load(user_id).order_by
+            count += queue_search_job(user_id, order_by)
+
+        self.stdout.write('Queued search jobs for {} users.'.format(count))
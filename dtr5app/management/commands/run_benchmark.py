@@ -0,0 +1,48 @@
+"""
+Time search_users, the results, user detail, matches and flag API views,
+and the chat consumers against the current database, and write the results
+as JSON, see utils_benchmark. Fill the database with make_synthetic_data
+first, and compare the JSON files of different runs.
+
+With --serializers, also compare the user list serializers at 20, 500 and
+5000 users.
+"""
+import json
+
+from django.core.management.base import BaseCommand
+from dtr5app.utils_benchmark import (BENCHMARKS, run_benchmark,
+                                     run_serializer_benchmark)
+
+
+class Command(BaseCommand):
+    help = 'Time the hot code paths and write the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20,
+                            help='Number of sample users.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs of every benchmark per sample user.')
+        parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+                            default=BENCHMARKS, help='Benchmarks to run.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Pick a different set of sample users.')
+        parser.add_argument('--serializers', action='store_true',
+                            help='Also time the user list serializers.')
+        parser.add_argument('--output', default='',
+                            help='Write the JSON to this file, not stdout.')
+
+    def handle(self, *args, **options):
+        result = run_benchmark(users=options['users'],
+                               repeat=options['repeat'],
+                               names=options['only'], seed=options['seed'])
+        if options['serializers']:
+            result['serializers'] = run_serializer_benchmark(
+                repeat=options['repeat'])
+        data = json.dumps(result, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+            self.stdout.write('Wrote {}'.format(options['output']))
+        else:
+            self.stdout.write(data)
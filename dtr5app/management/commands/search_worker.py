@@ -0,0 +1,40 @@
+"""
+Run queued search buffer jobs, see utils_search_jobs. Run one or more of
+these next to the web processes, e.g. as the dtr5-search-worker.service.
+"""
+from time import time as unixtime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from dtr5app.utils_search import update_search_results_buffer
+from dtr5app.utils_search_jobs import finish_search_job, get_search_job
+
+
+class Command(BaseCommand):
+    help = 'Run queued search buffer jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-jobs', type=int, dest='max_jobs',
+                            default=0, help='Exit after this many jobs.')
+
+    def handle(self, *args, **options):
+        count = 0
+        while not options['max_jobs'] or count < options['max_jobs']:
+            job = get_search_job()
+            if job is None:
+                continue
+
+            close_old_connections()
+            started = unixtime()
+            try:
+                user = User.objects.get(pk=job['user_id'], is_active=True)
+                update_search_results_buffer(user, job['order_by'],
+                                             force=job['force'])
+            except Exception as e:
+                self.stderr.write('Search job {} failed: {}'.format(job, e))
+                finish_search_job(job, started, failed=True)
+            else:
+                finish_search_job(job, started)
+            count += 1
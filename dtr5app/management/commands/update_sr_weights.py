@@ -0,0 +1,16 @@
+"""
+Recalculate the search weight of all subreddits. A subscription change only
+updates the weights of the subreddits involved, but the total number of users
+changes too, so run this once a day or so.
+"""
+
+from django.core.management.base import BaseCommand
+from dtr5app.utils import update_sr_weights
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the search weight of all subreddits.'
+
+    def handle(self, *args, **options):
+        count = update_sr_weights(refresh=True)
+        self.stdout.write('Updated the weight of {} subreddits.'.format(count))
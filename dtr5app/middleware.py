@@ -1,9 +1,11 @@
 import re
 from os.path import join, exists
-from datetime import datetime
-from pytz import utc
 from django.conf import settings
+from django.db import connection
 from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from dtr5app.utils_activity import track_user_activity
+from dtr5app.utils_metrics import finish_request, start_request
 
 
 def return_site_offline_response():
@@ -44,17 +46,41 @@ class CheckSiteTemporarilyUnavailable():
             return None
 
 
-class UserProfileLastActiveMiddleware():
-    """Set Profile.accessed to now()."""
+class UserProfileLastActiveMiddleware(MiddlewareMixin):
+    """
+    Set Profile.accessed to now(), written behind in bulk, see
+    utils_activity.
+    """
 
     def process_request(self, request):
         if request.user.is_authenticated:
-            request.user.profile.accessed = datetime.now().replace(tzinfo=utc)
-            request.user.profile.save(update_fields=['accessed'])
+            track_user_activity(request.user.id)
 
         return None
 
 
+class RequestMetricsMiddleware:
+    """
+    Record wall time, database queries, cache hits and misses, and response
+    size of every request per view, see utils_metrics. Put it first, so that
+    the time spent in all other middleware is part of the wall time.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = start_request()
+        with connection.execute_wrapper(metrics.execute):
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else '<unresolved>'
+        size = 0 if response.streaming else len(response.content)
+        finish_request(view_name, size)
+        return response
+
+
 class UserSetDefaultLocalizationValues():
     """Set some default vals on the request, based on user's HTTP headers"""
     mi_vals = ['enus',
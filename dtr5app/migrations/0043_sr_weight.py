@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.db.models import FloatField, Value
+from django.db.models.functions import Cast, Greatest, Ln
+
+
+def set_sr_weights(apps, schema_editor):
+    # Same as utils.update_sr_weights(), for all subreddits.
+    User = apps.get_model('auth', 'User')
+    Sr = apps.get_model('dtr5app', 'Sr')
+    n = User.objects.filter(is_active=True, last_login__isnull=False).count()
+    weight = Greatest(Ln(Value(n + 1.0) / (
+        Cast('subscribers_here', FloatField()) + Value(1.0))), Value(0.0))
+    Sr.objects.update(weight=weight)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0042_alter_profile__lookingfor_alter_profile_sex_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sr',
+            name='weight',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.RunPython(set_sr_weights, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0043_sr_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='search_updated',
+            field=models.DateTimeField(db_index=True, default=None, null=True),
+        ),
+    ]
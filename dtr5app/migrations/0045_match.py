@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dtr5app', '0044_profile_search_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Match',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('match_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'user match',
+                'verbose_name_plural': 'user matches',
+                'unique_together': {('user', 'match_user')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['user', '-created'], name='dtr5app_mat_user_id_17baa8_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0045_match'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='matches_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='new_likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='new_matches_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='new_views_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='views_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
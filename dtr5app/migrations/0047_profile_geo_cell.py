@@ -0,0 +1,32 @@
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Floor, Greatest, Least
+
+# Same as toolbox.get_geo_cell(), for the cell size at the time of writing.
+GEO_CELL_DEGREES = 0.5
+GEO_CELL_COLS = int(360 / GEO_CELL_DEGREES) + 1
+
+
+def set_geo_cells(apps, schema_editor):
+    Profile = apps.get_model('dtr5app', 'Profile')
+    lat = Least(Greatest(F('lat'), Value(-90.0)), Value(90.0))
+    lng = Least(Greatest(F('lng'), Value(-180.0)), Value(180.0))
+    Profile.objects.update(
+        geo_cell=Floor((lat + 90) / GEO_CELL_DEGREES) * GEO_CELL_COLS +
+        Floor((lng + 180) / GEO_CELL_DEGREES))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0046_profile_counters_integer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='geo_cell',
+            field=models.IntegerField(db_index=True, default=None, null=True),
+        ),
+        migrations.RunPython(set_geo_cells, migrations.RunPython.noop),
+    ]
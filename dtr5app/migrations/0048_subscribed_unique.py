@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Q
+
+
+def delete_double_subscriptions(apps, schema_editor):
+    # Usually a no-op, the "dedup_subscriptions" command should have removed
+    # all doubles in batches before, while the site was online.
+    Subscribed = apps.get_model('dtr5app', 'Subscribed')
+    doubles = Subscribed.objects.order_by().values('user_id', 'sr_id') \
+        .annotate(n=Count('id'), first_id=Min('id'),
+                  fav=Count('id', filter=Q(is_favorite=True))) \
+        .filter(n__gt=1)
+    for row in doubles:
+        if row['fav']:  # keep the favorite of any of the doubles
+            Subscribed.objects.filter(id=row['first_id']) \
+                .update(is_favorite=True)
+        Subscribed.objects.filter(user_id=row['user_id'], sr_id=row['sr_id']) \
+            .exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dtr5app', '0047_profile_geo_cell'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_double_subscriptions,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='subscribed',
+            unique_together={('user', 'sr')},
+        ),
+        migrations.AddIndex(
+            model_name='subscribed',
+            index=models.Index(fields=['sr', 'user', 'is_favorite'], name='dtr5app_sub_sr_id_941e9d_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without locking the tables against writes, which
+    # is only possible outside of a transaction.
+    atomic = False
+
+    dependencies = [
+        ('dtr5app', '0048_subscribed_unique'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='flag',
+            index=models.Index(fields=['receiver', 'flag', 'sender'], name='dtr5app_fla_receive_bca857_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'id'], name='dtr5app_mes_sender__05baa1_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='visit',
+            index=models.Index(fields=['host', '-created'], name='dtr5app_vis_host_id_75c53b_idx'),
+        ),
+        # The users that can show up in search, see utils_search. The table
+        # belongs to django.contrib.auth, so the index is created here.
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY dtr5app_auth_user_active_idx '
+            'ON auth_user (id) WHERE is_active AND last_login IS NOT NULL',
+            'DROP INDEX CONCURRENTLY dtr5app_auth_user_active_idx',
+        ),
+    ]
@@ -0,0 +1,42 @@
+import json
+
+from django.db import migrations, models
+
+
+def set_pic_columns(apps, schema_editor):
+    Profile = apps.get_model('dtr5app', 'Profile')
+    qs = Profile.objects.exclude(_pics__in=('', '[]')).only('user_id', '_pics')
+    batch = []
+    for profile in qs.iterator(chunk_size=1000):
+        try:
+            pics = json.loads(profile._pics)
+        except ValueError:
+            pics = []
+        profile.primary_pic_url = pics[0]['url'] if pics else ''
+        profile.pic_count = len(pics)
+        batch.append(profile)
+        if len(batch) >= 1000:
+            Profile.objects.bulk_update(batch, ['primary_pic_url', 'pic_count'])
+            batch = []
+    Profile.objects.bulk_update(batch, ['primary_pic_url', 'pic_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0049_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='pic_count',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='primary_pic_url',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(set_pic_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtr5app', '0050_profile_pic_columns'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='flag',
+            index=models.Index(fields=['receiver', 'flag', '-created'], name='dtr5app_fla_receive_818efd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='flag',
+            index=models.Index(fields=['sender', 'flag', '-created'], name='dtr5app_fla_sender__b3ab01_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def delete_double_visits(apps, schema_editor):
+    # Only doubles of concurrent visits, Visit.add_visitor_host() deleted
+    # the pair's earlier visits before. The most recent visit is kept.
+    Visit = apps.get_model('dtr5app', 'Visit')
+    doubles = Visit.objects.order_by().values('visitor_id', 'host_id') \
+        .annotate(n=Count('id'), last_id=Max('id')).filter(n__gt=1)
+    for row in doubles:
+        Visit.objects.filter(visitor_id=row['visitor_id'],
+                             host_id=row['host_id']) \
+            .exclude(id=row['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dtr5app', '0051_flag_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_double_visits,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='visit',
+            unique_together={('visitor', 'host')},
+        ),
+    ]
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Q
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_conversations(apps, schema_editor):
+    # One conversation per pair of users who sent each other messages, with
+    # their latest message. Unread messages were never counted before.
+    Conversation = apps.get_model('dtr5app', 'Conversation')
+    Message = apps.get_model('dtr5app', 'Message')
+    rows = Message.objects.filter(sender__isnull=False, receiver__isnull=False) \
+        .order_by().values('sender_id', 'receiver_id') \
+        .annotate(last_id=Max('id'), last_at=Max('created'))
+
+    pairs = {}
+    for row in rows:
+        pair = tuple(sorted((row['sender_id'], row['receiver_id'])))
+        last_id, last_at = pairs.get(pair, (row['last_id'], row['last_at']))
+        pairs[pair] = (max(last_id, row['last_id']),
+                       max(last_at, row['last_at']))
+    Conversation.objects.bulk_create([Conversation(
+        user1_id=user1_id, user2_id=user2_id,
+        last_message_id=last_id, last_message_at=last_at,
+    ) for (user1_id, user2_id), (last_id, last_at) in pairs.items()],
+        batch_size=1000)
+
+    for pk, user1_id, user2_id in Conversation.objects.values_list(
+            'pk', 'user1_id', 'user2_id').iterator():
+        Message.objects.filter(
+            Q(sender_id=user1_id, receiver_id=user2_id) |
+            Q(sender_id=user2_id, receiver_id=user1_id),
+        ).update(conversation_id=pk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dtr5app', '0052_visit_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_message_id', models.IntegerField(default=None, null=True)),
+                ('last_message_at', models.DateTimeField(default=None, null=True)),
+                ('user1_unread', models.PositiveIntegerField(default=0)),
+                ('user2_unread', models.PositiveIntegerField(default=0)),
+                ('user1', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user2', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'conversation',
+                'verbose_name_plural': 'conversations',
+                'unique_together': {('user1', 'user2')},
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='dtr5app.conversation'),
+        ),
+        migrations.RunPython(create_conversations, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='dtr5app_mes_convers_f5907c_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='dtr5app_mes_sender__05baa1_idx',
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user1', '-last_message_at'], name='dtr5app_con_user1_i_52a646_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user2', '-last_message_at'], name='dtr5app_con_user2_i_568dbe_idx'),
+        ),
+    ]
@@ -3,8 +3,8 @@ import json
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.validators import validate_comma_separated_integer_list
-from django.db import models
-from django.db.models import Q
+from django.db import connection, models, transaction
+from django.db.models import F, Q
 from django.db.models.fields import NOT_PROVIDED
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -17,6 +17,7 @@ from toolbox import (
                      get_age,
                      get_eastern_zodiac,
                      get_eastern_zodiac_symbol,
+                     get_geo_cell,
                      get_western_zodiac,
                      get_western_zodiac_symbol,
                      sr_str_to_list,
@@ -34,6 +35,10 @@ class Profile(models.Model):
     created = models.DateField(null=True, default=None)  # REDDIT accunt created
     updated = models.DateTimeField(null=True, default=None)  # profile updated
     accessed = models.DateTimeField(null=True, default=None)  # last activity
+    # Last change of the profile or subscriptions that may change the search
+    # results of other users, see SEARCH_FIELDS.
+    search_updated = models.DateTimeField(null=True, default=None,
+                                          db_index=True)
 
     # changeable Reddit user account data:
     link_karma = models.IntegerField(default=0)
@@ -47,6 +52,8 @@ class Profile(models.Model):
     # other data:
     lat = models.FloatField(default=0.0)
     lng = models.FloatField(default=0.0)
+    # Grid cell of lat/lng, set on save, see toolbox.get_geo_cell().
+    geo_cell = models.IntegerField(null=True, default=None, db_index=True)
     fuzzy = models.IntegerField(default=2)  # km lat/lng fuzziness radius
 
     # manually input data
@@ -57,6 +64,10 @@ class Profile(models.Model):
     # url: char field with the complete picture URL.
     # src: char field with the comeplete URL to the pic's source page.
     _pics = models.TextField(default='')
+    # Denormalized from _pics on save, so that lists and search don't need to
+    # parse the JSON, see Profile.pics.
+    primary_pic_url = models.TextField(default='')
+    pic_count = models.PositiveSmallIntegerField(default=0, db_index=True)
     background_pic = models.CharField(default='', max_length=250)
 
     # classify as only or mostly dating or friends, or both.
@@ -80,15 +91,15 @@ class Profile(models.Model):
     fitness = models.PositiveSmallIntegerField(default=1,  # unused
                                                choices=settings.FITNESS)
 
-    # Some numbers
-    views_count = models.PositiveSmallIntegerField(default=0)
-    matches_count = models.PositiveSmallIntegerField(default=0)
+    # Some numbers, change them with utils_counters.incr_profile_counters()
+    views_count = models.PositiveIntegerField(default=0)
+    matches_count = models.PositiveIntegerField(default=0)
 
     # All "new_*_count" values are set to 0 every time they are displayed,
     # like its done on Reddit with "new messages".
-    new_matches_count = models.PositiveSmallIntegerField(default=0)
-    new_likes_count = models.PositiveSmallIntegerField(default=0)
-    new_views_count = models.PositiveSmallIntegerField(default=0)
+    new_matches_count = models.PositiveIntegerField(default=0)
+    new_likes_count = models.PositiveIntegerField(default=0)
+    new_views_count = models.PositiveIntegerField(default=0)
 
     # Send notification when upvote received via Reddit PM.
     upvote_notif_now = models.BooleanField(default=False)  # for every upvote
@@ -166,11 +177,46 @@ class Profile(models.Model):
     def __str__(self):
         return self.user.username
 
+    # Fields other users filter their search on. A change to any of them
+    # invalidates the shared search results, see utils_search_cache.
+    SEARCH_FIELDS = ('sex', 'dob', 'lat', 'lng', 'has_verified_email',
+                     'pic_count')
+
     def __init__(self, *args, **kwargs):
         super(Profile, self).__init__(*args, **kwargs)
+        self._search_fields_state = self.get_search_fields_state()
 
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is None or {'lat', 'lng'} & set(update_fields):
+            self.geo_cell = get_geo_cell(self.lat, self.lng)
+            if update_fields is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + \
+                    ['geo_cell']
+        # Unless _pics is deferred, and not saved anyway.
+        if '_pics' in self.__dict__ and \
+                (update_fields is None or '_pics' in update_fields):
+            pics = self.pics
+            self.primary_pic_url = pics[0]['url'] if pics else ''
+            self.pic_count = len(pics)
+            if update_fields is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + \
+                    ['primary_pic_url', 'pic_count']
+        if self._state.adding or self.search_fields_changed():
+            self.search_updated = now()
+            if kwargs.get('update_fields', None) is not None:
+                kwargs['update_fields'] = \
+                    list(kwargs['update_fields']) + ['search_updated']
         super(Profile, self).save(*args, **kwargs)
+        self._search_fields_state = self.get_search_fields_state()
+
+    def get_search_fields_state(self):
+        # Read from __dict__ so that deferred fields are not loaded.
+        return tuple(self.__dict__.get(x) for x in self.SEARCH_FIELDS)
+
+    def search_fields_changed(self):
+        """Return True if a SEARCH_FIELDS value changed since last save."""
+        return self._search_fields_state != self.get_search_fields_state()
 
     def _user_id(self):
         return self.user.id
@@ -201,16 +247,21 @@ class Profile(models.Model):
 
     @property
     def pics(self):
-        try:
-            li = json.loads(self._pics)
-            for x in li:
-                if 'imgur.com/' in x['url']:
-                    x['url_large'] = x['url'].replace('m.jpg', '.jpg')
-                else:
-                    x['url_large'] = x['url']
-            return li
-        except ValueError:
-            return []
+        # The parsed list is kept until _pics changes. Return copies, so that
+        # callers can't change the kept list.
+        cached = self.__dict__.get('_pics_parsed')
+        if cached is None or cached[0] != self._pics:
+            try:
+                li = json.loads(self._pics)
+                for x in li:
+                    if 'imgur.com/' in x['url']:
+                        x['url_large'] = x['url'].replace('m.jpg', '.jpg')
+                    else:
+                        x['url_large'] = x['url']
+            except ValueError:
+                li = []
+            cached = self.__dict__['_pics_parsed'] = (self._pics, li)
+        return [dict(x) for x in cached[1]]
 
     @pics.setter
     def pics(self, li):
@@ -227,6 +278,7 @@ class Profile(models.Model):
                 # -- TODO --
         # Serialilze pics list into JSON string.
         self._pics = json.dumps(li, ensure_ascii=False)
+        self.__dict__.pop('_pics_parsed', None)
 
     @property
     def lookingfor(self):
@@ -416,9 +468,8 @@ class Profile(models.Model):
 
     def match_with(self, view_user):
         """Return True if user is a match (multual like) with view_user."""
-        return (Flag.objects.filter(flag=Flag.LIKE_FLAG).filter(
-            Q(sender=self.user, receiver=view_user) |
-            Q(receiver=self.user, sender=view_user)).count() == 2)
+        return Match.objects.filter(user=self.user,
+                                    match_user=view_user).exists()
 
     def does_like(self, view_user):
         """Return True is the instance user "liked" view_user."""
@@ -461,11 +512,32 @@ class Flag(models.Model):
         verbose_name = 'user flag'
         verbose_name_plural = 'user flags'
         unique_together = ['sender', 'receiver', 'flag']
+        indexes = [
+            # Flags received, e.g. "who liked me". The unique index above
+            # covers all lookups by sender.
+            models.Index(fields=['receiver', 'flag', 'sender']),
+            # Flags in the order of the cursor paginated lists.
+            models.Index(fields=['receiver', 'flag', '-created']),
+            models.Index(fields=['sender', 'flag', '-created']),
+        ]
 
     def __str__(self):
         return '<Flag: {} --{}--> {}>'.format(
             self.sender.username, self.get_flag_display(), self.receiver.username)
 
+    @staticmethod
+    def lock_pair(user1, user2):
+        """
+        Lock the User rows of user1 and user2 until the end of the current
+        transaction, always in the order of their ids, so that two requests
+        that flag each other can't deadlock. Otherwise, with concurrent likes
+        between the same users under READ COMMITTED, neither like would see
+        the other and no Match would be created.
+        """
+        list(User.objects.select_for_update()
+                         .filter(pk__in=[user1.pk, user2.pk])
+                         .order_by('pk').values_list('pk', flat=True))
+
     @classmethod
     def delete_flag(cls, _sender, _receiver):
         """
@@ -473,19 +545,71 @@ class Flag(models.Model):
         between a pair of users. Deleting a flag between two users always
         deletes all flags between them.
         """
-        for x in cls.objects.filter(sender=_sender, receiver=_receiver):
-            x.delete()
+        with transaction.atomic():
+            cls.lock_pair(_sender, _receiver)
+            for x in cls.objects.filter(sender=_sender, receiver=_receiver):
+                x.delete()
+            Match.delete_match(_sender, _receiver)
 
     @classmethod
     def set_flag(cls, _sender, _receiver, flag):
         """
         All current flags are "unique", so that setting one of them
         on a user, automatically removes all previously set flags on
-        that user.
+        that user. A like on a user who liked back creates a Match.
         """
-        cls.delete_flag(_sender, _receiver)
-        return cls.objects.create(
-            sender=_sender, receiver=_receiver, flag=cls.FLAG_DICT[flag])
+        with transaction.atomic():
+            # Also locks the pair of users, see lock_pair().
+            cls.delete_flag(_sender, _receiver)
+            obj = cls.objects.create(
+                sender=_sender, receiver=_receiver, flag=cls.FLAG_DICT[flag])
+            if obj.flag == cls.LIKE_FLAG and cls.objects.filter(
+                    sender=_receiver, receiver=_sender,
+                    flag=cls.LIKE_FLAG).exists():
+                Match.set_match(_sender, _receiver, obj.created)
+        return obj
+
+
+class Match(models.Model):
+    """
+    Mutual likes between two users, kept in sync with the Flag table by
+    Flag.set_flag() and Flag.delete_flag(). Every match is stored twice, once
+    for each user, so that all matches of a user are one index lookup. Run
+    the "build_matches" command to rebuild it from the Flag table.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="matches")
+    match_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    created = models.DateTimeField(default=now)  # time of the second like
+
+    class Meta:
+        verbose_name = 'user match'
+        verbose_name_plural = 'user matches'
+        unique_together = ['user', 'match_user']
+        indexes = [models.Index(fields=['user', '-created'])]
+
+    def __str__(self):
+        return '<Match: {} <--> {}>'.format(
+            self.user.username, self.match_user.username)
+
+    @classmethod
+    def set_match(cls, user1, user2, created=None):
+        """Store the match between user1 and user2, for both of them."""
+        created = created or now()
+        cls.objects.bulk_create([
+            cls(user=user1, match_user=user2, created=created),
+            cls(user=user2, match_user=user1, created=created),
+        ], ignore_conflicts=True)
+
+    @classmethod
+    def delete_match(cls, user1, user2):
+        """Remove the match between user1 and user2, if there is any."""
+        cls.objects.filter(Q(user=user1, match_user=user2) |
+                           Q(user=user2, match_user=user1)).delete()
+
+    @classmethod
+    def delete_user_matches(cls, user):
+        """Remove all matches of user, e.g. when they delete their likes."""
+        cls.objects.filter(Q(user=user) | Q(match_user=user)).delete()
 
 
 class Report(models.Model):
@@ -529,6 +653,10 @@ class Sr(models.Model):
     subscribers = models.IntegerField(default=0)
     # Subreddir subscribers with an account here on this site
     subscribers_here = models.IntegerField(default=0)
+    # Inverse frequency of the subreddit among users here, see
+    # utils.update_sr_weights(). Sharing a small sub has a high weight in
+    # search, sharing one of the large default subs a very low one.
+    weight = models.FloatField(default=0.0)
 
     class Meta:
         verbose_name = "subreddit"
@@ -553,9 +681,11 @@ class Subscribed(models.Model):
         verbose_name = "subreddit subscription"
         verbose_name_plural = "subreddit subscriptions"
         ordering = ['sr__display_name']
-
-        # TODO: add this here, first clean up dupes.
-        # unique_together = [user, sr]
+        unique_together = [('user', 'sr')]
+        indexes = [
+            # Covers the subscriptions self-join of the search.
+            models.Index(fields=['sr', 'user', 'is_favorite']),
+        ]
 
     def __str__(self):
         return '<Subscribed: {} --> {}>'.format(self.user.username, self.sr.name)
@@ -574,7 +704,10 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 
 class Visit(models.Model):
-    """Remember the last visit of a user to another user's profile page."""
+    """
+    Remember the last visit of a user to another user's profile page. There
+    is one row per visitor and host, updated with every visit.
+    """
     visitor = models.ForeignKey(
         User, on_delete=models.CASCADE, editable=False, related_name='visited', db_index=True)
     host = models.ForeignKey(
@@ -586,15 +719,29 @@ class Visit(models.Model):
         verbose_name = "visit"
         verbose_name_plural = "visits"
         ordering = ['-created']
+        unique_together = ['visitor', 'host']
+        indexes = [models.Index(fields=['host', '-created'])]
 
     def __str__(self):
         return '{} visited {}'.format(self.visitor.username,
                                       self.host.username)
 
     @classmethod
-    def add_visitor_host(cls, visitor, host):
-        Visit.objects.filter(visitor=visitor, host=host).delete()
-        return Visit.objects.create(visitor=visitor, host=host)
+    def add_visitor_host(cls, visitor, host, created=None):
+        """
+        Insert the visit, or set the time of the pair's existing visit, and
+        show it again if it was hidden, with a single upsert query.
+        """
+        created = created or now()
+        sql = ('INSERT INTO {} (visitor_id, host_id, created, hidden) '
+               'VALUES (%s, %s, %s, %s) '
+               'ON CONFLICT (visitor_id, host_id) DO UPDATE '
+               'SET created = EXCLUDED.created, hidden = EXCLUDED.hidden')
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(cls._meta.db_table), [
+                visitor.id, host.id,
+                connection.ops.adapt_datetimefield_value(created), False])
+        return created
 
 
 class PushNotificationEndpoint(models.Model):
@@ -607,30 +754,134 @@ class PushNotificationEndpoint(models.Model):
         return self.sub[:50]
 
 
+class Conversation(models.Model):
+    """
+    The chat between two users, with the latest message and the number of
+    unread messages of each user, for the chat list. The user with the lower
+    id is always user1, so that there is only one conversation per pair.
+    """
+    user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created = models.DateTimeField(default=now)
+    last_message_id = models.IntegerField(null=True, default=None)
+    last_message_at = models.DateTimeField(null=True, default=None)
+    user1_unread = models.PositiveIntegerField(default=0)
+    user2_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "conversation"
+        verbose_name_plural = "conversations"
+        unique_together = ['user1', 'user2']
+        indexes = [
+            # The chat lists, by last activity.
+            models.Index(fields=['user1', '-last_message_at']),
+            models.Index(fields=['user2', '-last_message_at']),
+        ]
+
+    def __str__(self):
+        return '<Conversation: {} <-> {}>'.format(self.user1_id, self.user2_id)
+
+    @staticmethod
+    def get_pair(user_a, user_b):
+        """Return the ids of user_a and user_b as (user1_id, user2_id)."""
+        return tuple(sorted((user_a.id, user_b.id)))
+
+    @staticmethod
+    def get_unread_field(pair, user):
+        return 'user1_unread' if user.id == pair[0] else 'user2_unread'
+
+    @classmethod
+    def add_message(cls, sender, receiver, msg):
+        """
+        Store a message from sender to receiver, and set it as the latest
+        message of their conversation, with one more unread message for
+        receiver. Returns the new Message object.
+        """
+        pair = cls.get_pair(sender, receiver)
+        unread = cls.get_unread_field(pair, receiver)
+        with transaction.atomic():
+            conversation, _ = cls.objects.get_or_create(
+                user1_id=pair[0], user2_id=pair[1])
+            message = Message.objects.create(
+                conversation=conversation, sender=sender, receiver=receiver,
+                msg=msg)
+            cls.objects.filter(pk=conversation.pk).update(
+                last_message_id=message.id, last_message_at=message.created,
+                **{unread: F(unread) + 1})
+        return message
+
+    @classmethod
+    def mark_read(cls, reader, other):
+        """Set the number of unread messages of reader from other to 0."""
+        pair = cls.get_pair(reader, other)
+        unread = cls.get_unread_field(pair, reader)
+        return cls.objects.filter(
+            user1_id=pair[0], user2_id=pair[1], **{unread + '__gt': 0},
+        ).update(**{unread: 0})
+
+    @classmethod
+    def get_chat_list(cls, user, limit=50):
+        """
+        Return a list of dicts with the "id", "username", "latest" message
+        time, and number of "unread" messages, of the users that user had a
+        chat with, the most recent first.
+        """
+        rows = cls.objects.filter(
+            Q(user1=user) | Q(user2=user), last_message_at__isnull=False,
+        ).order_by('-last_message_at').values_list(
+            'user1_id', 'user1__username', 'user1_unread',
+            'user2_id', 'user2__username', 'user2_unread',
+            'last_message_at')[:limit]
+
+        user_list = []
+        for row in rows:
+            # The other user, with auth user's unread messages from them.
+            if row[0] == user.id:
+                other_id, other_username, unread = row[3], row[4], row[2]
+            else:
+                other_id, other_username, unread = row[0], row[1], row[5]
+            user_list.append({'id': other_id, 'username': other_username,
+                              'latest': row[6], 'unread': unread})
+        return user_list
+
+
 class Message(models.Model):
     msg = models.CharField(max_length=240, blank=False, null=False)
     sender = models.ForeignKey(User, on_delete=models.SET_NULL, 
             null=True, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.SET_NULL, 
             null=True, related_name='received_messages')
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.SET_NULL, null=True,
+        related_name='messages', db_index=False)
     created = models.DateTimeField(default=now)
 
     class Meta:
         verbose_name = "private message"
         verbose_name_plural = "private messages"
         ordering = ['-id']
+        indexes = [models.Index(fields=['conversation', 'id'])]
 
     def __str__(self):
         return '<Message: {} --> {}>'.format(self.sender.username, self.receiver.username)
 
     @classmethod
-    def get_messages_list(cls, after, user1, user2):
-        """Return a list of Message objects with created time larger than
-        the "after" date. user_list is a list of exactly two users, both of
-        which have to be present, either os sender or receiver."""
-        messages = (Message.objects.filter(sender=user1, receiver=user2) |
-                    Message.objects.filter(sender=user2, receiver=user1))
+    def get_messages_list(cls, after, user1, user2, before=None):
+        """
+        Return up to 20 Message objects between user1 and user2, the most
+        recent first. With "after", the next messages with an id larger than
+        "after", to poll for new messages. With "before", the previous
+        messages with an id smaller than "before", to load older messages.
+        """
+        pair = Conversation.get_pair(user1, user2)
+        messages = Message.objects.filter(conversation__user1_id=pair[0],
+                                          conversation__user2_id=pair[1])
+        if before:
+            messages = messages.filter(id__lt=before)
         if after:
-            messages = messages.filter(id__gt=after)
+            # The oldest new messages first, so that polling again "after"
+            # the newest of them doesn't skip any.
+            messages = messages.filter(id__gt=after).order_by('id')
+            return list(messages.select_related('sender', 'receiver')[:20])[::-1]
 
-        return messages.prefetch_related('sender', 'receiver')[:20]  # max 20
+        return messages.select_related('sender', 'receiver')[:20]  # max 20
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 
 from dtr5app.models import Profile, Subscribed, Sr, Message
+from toolbox import get_age
 
 
 class ChatsUserSerializer(serializers.ModelSerializer):
@@ -44,10 +45,7 @@ class BasicUserProfileSerializer(serializers.ModelSerializer):
 
     # noinspection PyMethodMayBeStatic
     def get_pic(self, obj):
-        try:
-            return obj.pics[0]['url']
-        except IndexError:
-            return ''
+        return obj.primary_pic_url
 
 
 class BasicUserSerializer(serializers.ModelSerializer):
@@ -60,6 +58,78 @@ class BasicUserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'profile', 'flag_created', 'flag_created')
 
 
+# Columns of BasicUserSerializer, relative to the User model.
+BASIC_USER_COLUMNS = ('id', 'username', 'profile__accessed',
+                      'profile__link_karma', 'profile__comment_karma',
+                      'profile__lat', 'profile__lng', 'profile__sex',
+                      'profile__dob', 'profile__primary_pic_url')
+_datetime_to_representation = serializers.DateTimeField().to_representation
+
+
+def _datetime_or_none(value):
+    return None if value is None else _datetime_to_representation(value)
+
+
+def get_basic_user_columns(prefix='', flag_created=None):
+    """Return the values_list() columns for get_basic_user_data()."""
+    columns = [prefix + x for x in BASIC_USER_COLUMNS]
+    if flag_created:
+        columns.append(flag_created)
+    return columns
+
+
+def get_basic_user_data(row):
+    """
+    Return the BasicUserSerializer data of one values_list() row of the
+    get_basic_user_columns() columns, with "flag_created" if it was selected.
+    """
+    item = {
+        'id': row[0],
+        'username': row[1],
+        'profile': {
+            'accessed': _datetime_or_none(row[2]),
+            'link_karma': row[3],
+            'comment_karma': row[4],
+            'lat': row[5],
+            'lng': row[6],
+            'sex': row[7],
+            'age': get_age(row[8]) if row[8] else None,
+            'pic': row[9],
+        },
+    }
+    if len(row) > len(BASIC_USER_COLUMNS):
+        item['flag_created'] = _datetime_or_none(row[10])
+    return item
+
+
+def basic_user_list_data(queryset, prefix='', flag_created=None):
+    """
+    Same as BasicUserSerializer(queryset, many=True).data, but only the
+    needed columns are fetched, and the dicts are built directly from them,
+    without User and Profile objects or DRF fields per row.
+
+    :queryset: any queryset, that reaches the users with the "prefix"
+               lookup, e.g. a Match queryset with prefix "match_user__".
+    :flag_created: lookup of the "flag_created" value, by default the
+                   "flag_created" annotation of the queryset, if any.
+    """
+    if flag_created is None and 'flag_created' in queryset.query.annotations:
+        flag_created = 'flag_created'
+    columns = get_basic_user_columns(prefix, flag_created)
+    return [get_basic_user_data(row) for row in
+            queryset.prefetch_related(None).values_list(*columns)]
+
+
+def basic_user_list_data_by_ids(id_list):
+    """
+    Same as basic_user_list_data(), for the users in id_list, in the same
+    order. Ids of users that don't exist anymore are skipped.
+    """
+    data = {x['id']: x for x in basic_user_list_data(
+        User.objects.filter(id__in=list(id_list)))}
+    return [data[x] for x in id_list if x in data]
+
+
 class ViewUserProfileSerializer(serializers.ModelSerializer):
     """
     Limited to values that are accessible by any logged in user. To have a
@@ -0,0 +1,69 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Profile
+from dtr5app.utils_activity import (count_active_users, flush_user_activity,
+                                    get_active_user_ids, track_user_activity)
+from dtr5app.utils_stats import get_active_users
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_INTERVAL=60,
+                   ACTIVITY_LIVE_WINDOW=900)
+@patch('dtr5app.utils_activity.get_activity_connection')
+class Dtr5appActivityTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', last_login=now())
+
+    def tearDown(self):
+        pass
+
+    def test_flush_once_per_interval(self, get_activity_connection):
+        conn = get_activity_connection.return_value
+        conn.zrangebyscore.return_value = [(str(self.user.id).encode(),
+                                            now().timestamp())]
+
+        for i in range(3):
+            track_user_activity(self.user.id)
+
+        self.assertEqual(conn.zadd.call_count, 3)
+        self.assertEqual(conn.zrangebyscore.call_count, 1)
+        self.assertIsNotNone(Profile.objects.get(user=self.user).accessed)
+
+    def test_flush_since_last_flush(self, get_activity_connection):
+        conn = get_activity_connection.return_value
+        conn.zrangebyscore.return_value = []
+
+        self.assertEqual(flush_user_activity(until=1000.0), 0)
+        flush_user_activity(until=1060.0)
+        args = conn.zrangebyscore.call_args[0]
+        # One flush interval is read again, for late activity.
+        self.assertEqual(args[1:], (940.0, 1060.0))
+
+    def test_without_redis(self, get_activity_connection):
+        get_activity_connection.return_value = None
+
+        track_user_activity(self.user.id)
+        self.assertIsNotNone(Profile.objects.get(user=self.user).accessed)
+        self.assertEqual(flush_user_activity(), 0)
+        self.assertIsNone(count_active_users(60))
+
+    def test_count_active_users(self, get_activity_connection):
+        conn = get_activity_connection.return_value
+        conn.zcount.return_value = 7
+
+        self.assertEqual(get_active_users(5), 7)
+        self.assertIsNone(count_active_users(3600))
+        self.assertEqual(get_active_users(60), 0)  # from the database
+
+    def test_get_active_user_ids(self, get_activity_connection):
+        conn = get_activity_connection.return_value
+        conn.zrangebyscore.return_value = [b'3', b'5']
+
+        self.assertEqual(get_active_user_ids(300), [3, 5])
+        self.assertIsNone(get_active_user_ids(3600))
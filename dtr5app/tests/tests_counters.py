@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Profile
+from dtr5app.utils_counters import (flush_profile_counters,
+                                    incr_profile_counters,
+                                    update_profile_counters)
+from dtr5app.utils_search import update_search_settings
+
+
+class Dtr5appCountersTestCase(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='testuser1',
+                                         last_login=now())
+        self.user2 = User.objects.create(username='testuser2',
+                                         last_login=now())
+
+    def tearDown(self):
+        pass
+
+    def get_profile(self, user):
+        return Profile.objects.get(user=user)
+
+    @override_settings(PROFILE_COUNTERS_BUFFERED=False)
+    def test_incr_profile_counters(self):
+        incr_profile_counters(self.user1.id, views_count=1, new_views_count=1)
+        incr_profile_counters(self.user1.id, views_count=1)
+        profile = self.get_profile(self.user1)
+        self.assertEqual((profile.views_count, profile.new_views_count),
+                         (2, 1))
+
+        with self.assertRaises(ValueError):
+            incr_profile_counters(self.user1.id, height=1)
+
+    @override_settings(PROFILE_COUNTERS_BUFFERED=False)
+    def test_profile_save_keeps_counters(self):
+        # The profile was loaded before another user's view was counted.
+        profile = self.get_profile(self.user1)
+        incr_profile_counters(self.user1.id, views_count=1)
+
+        request = SimpleNamespace(user=self.user1, session={},
+                                  POST=QueryDict('f_distance=50'))
+        self.user1.profile = profile
+        update_search_settings(request)
+        profile = self.get_profile(self.user1)
+        self.assertEqual((profile.f_distance, profile.views_count), (50, 1))
+
+    def test_decrement_stops_at_zero(self):
+        update_profile_counters([self.user1.id], matches_count=1)
+        update_profile_counters([self.user1.id, self.user2.id],
+                                matches_count=-1)
+        self.assertEqual(self.get_profile(self.user1).matches_count, 0)
+        self.assertEqual(self.get_profile(self.user2).matches_count, 0)
+
+    @patch('dtr5app.utils_counters.pop_buffered_counters')
+    def test_flush_profile_counters(self, pop_buffered_counters):
+        pop_buffered_counters.side_effect = [{
+            self.user1.id: {'views_count': 3, 'new_views_count': 3},
+            self.user2.id: {'views_count': 3, 'new_views_count': 3},
+        }]
+
+        self.assertEqual(flush_profile_counters(batch_size=10), 2)
+        self.assertEqual(pop_buffered_counters.call_count, 1)
+        for user in (self.user1, self.user2):
+            profile = self.get_profile(user)
+            self.assertEqual((profile.views_count, profile.new_views_count),
+                             (3, 3))
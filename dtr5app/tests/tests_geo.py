@@ -0,0 +1,69 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils.timezone import now
+from dtr5app.models import Profile
+from dtr5app.utils_geo import (get_distances, get_geo_cell_q,
+                               get_latlng_box_q, get_latlng_box_sql)
+from toolbox import distance_between_geolocations, get_geo_cell
+
+
+class Dtr5appGeoTestCase(TestCase):
+    berlin = (52.5200, 13.4050)
+    potsdam = (52.3906, 13.0645)
+    munich = (48.1351, 11.5820)
+
+    def setUp(self):
+        self.users = []
+        for i, (lat, lng) in enumerate((self.berlin, self.potsdam,
+                                        self.munich)):
+            user = User.objects.create(username='testuser{}'.format(i),
+                                       last_login=now())
+            user.profile.lat, user.profile.lng = lat, lng
+            user.profile.save(update_fields=['lat', 'lng'])
+            self.users.append(user)
+
+    def tearDown(self):
+        pass
+
+    def test_geo_cell_set_on_save(self):
+        profile = Profile.objects.get(user=self.users[0])
+        self.assertEqual(profile.geo_cell, get_geo_cell(*self.berlin))
+
+    def test_get_distances(self):
+        lats, lngs = zip(self.potsdam, self.munich)
+        distances = get_distances(*self.berlin, lats, lngs)
+        for d, p in zip(distances, (self.potsdam, self.munich)):
+            expected = distance_between_geolocations(self.berlin, p) / 1000
+            self.assertAlmostEqual(d, expected, delta=0.1)
+
+    def test_geo_cell_q(self):
+        params = {'lat': self.berlin[0], 'lng': self.berlin[1],
+                  'distance': 50}
+        ids = User.objects.filter(get_geo_cell_q(params)) \
+                          .values_list('id', flat=True)
+        self.assertEqual(set(ids), {self.users[0].id, self.users[1].id})
+
+    def test_latlng_box_q(self):
+        params = {'lat': self.berlin[0], 'lng': self.berlin[1],
+                  'distance': 50}
+        ids = User.objects.filter(get_geo_cell_q(params),
+                                  get_latlng_box_q(params)) \
+                          .values_list('id', flat=True)
+        self.assertEqual(set(ids), {self.users[0].id, self.users[1].id})
+
+    def test_latlng_box_across_antimeridian(self):
+        # Fiji, on both sides of the antimeridian.
+        profiles = Profile.objects.filter(user__in=self.users)
+        profiles.filter(user=self.users[0]).update(lat=-17.7, lng=178.0)
+        profiles.filter(user=self.users[1]).update(lat=-17.7, lng=-179.5)
+        params = {'lat': -17.7, 'lng': -179.5, 'distance': 300}
+        expected = {self.users[0].id, self.users[1].id}
+
+        ids = profiles.filter(get_latlng_box_q(params, prefix='')) \
+                      .values_list('user_id', flat=True)
+        self.assertEqual(set(ids), expected)
+
+        sql, sql_params = get_latlng_box_sql(params, 'p')
+        rows = Profile.objects.raw(
+            'SELECT * FROM dtr5app_profile p WHERE 1=1 ' + sql, sql_params)
+        self.assertEqual({x.user_id for x in rows}, expected)
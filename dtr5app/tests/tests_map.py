@@ -0,0 +1,81 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+from dtr5app import utils_match_engine
+from dtr5app.utils_map import (build_map_tile, get_tile_bounds,
+                               normalize_t_window)
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+# No search job is queued on login, there is no Redis queue in the tests.
+@override_settings(CACHES=LOCMEM_CACHES, MAP_POINTS_ZOOM=10,
+                   MAP_POINTS_MAX=250, SEARCH_ASYNC=False)
+class Dtr5appMapTestCase(TestCase):
+    # Berlin, Potsdam and Munich are all in the zoom 4 tile 8/5.
+    locations = ((52.52, 13.40), (52.39, 13.06), (48.14, 11.58), (0.5, 0.5))
+
+    def setUp(self):
+        self.users = []
+        for i, (lat, lng) in enumerate(self.locations):
+            user = User.objects.create(username='testuser{}'.format(i),
+                                       last_login=now())
+            user.profile.lat, user.profile.lng = lat, lng
+            user.profile.save()
+            self.users.append(user)
+        utils_match_engine._index = None
+
+    def tearDown(self):
+        utils_match_engine._index = None
+
+    def test_tile_bounds(self):
+        west, south, east, north = get_tile_bounds(4, 8, 5)
+        self.assertEqual((west, east), (0.0, 22.5))
+        self.assertTrue(south < 48.14 and 52.52 < north)
+
+    def test_clusters(self):
+        tile = build_map_tile(4, 8, 5)
+        self.assertEqual(tile['users'], [])
+        self.assertEqual(sorted(x[2] for x in tile['clusters']), [1, 1, 1])
+
+        # At zoom 2, Berlin and Potsdam are close enough for one cluster.
+        tile = build_map_tile(2, 2, 1)
+        self.assertEqual(sorted(x[2] for x in tile['clusters']), [1, 2])
+
+    def test_single_users_at_high_zoom(self):
+        # tile of zoom 10 with Berlin in it
+        tile = build_map_tile(10, 550, 335)
+        self.assertEqual(tile['clusters'], [])
+        self.assertEqual([x[0] for x in tile['users']], ['testuser0'])
+
+    def test_t_window(self):
+        self.assertEqual(normalize_t_window(0), 0)
+        self.assertEqual(normalize_t_window(90), 60)
+        self.assertEqual(build_map_tile(4, 8, 5, t=60)['clusters'], [])
+
+    @patch('dtr5app.utils_map.get_active_user_ids')
+    def test_live_t_window(self, get_active_user_ids):
+        get_active_user_ids.return_value = [self.users[0].id]
+        tile = build_map_tile(4, 8, 5, t=5)
+        self.assertEqual(tile['t'], 5)
+        self.assertEqual([x[2] for x in tile['clusters']], [1])
+
+        # Without live activity, windows shorter than the age of the index
+        # are widened.
+        get_active_user_ids.return_value = None
+        utils_match_engine.get_match_index().built -= 6 * 60
+        self.assertEqual(build_map_tile(4, 8, 5, t=5)['t'], 60)
+
+    def test_tile_view(self):
+        self.client.force_login(self.users[0])
+        url = reverse('usermap_tile', args=(4, 8, 5))
+        response = self.client.get(url, {'t': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+        url = reverse('usermap_tile', args=(4, 16, 5))
+        self.assertEqual(self.client.get(url).status_code, 404)
@@ -0,0 +1,119 @@
+from datetime import date
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Sr, Subscribed
+from dtr5app.utils_match_engine import MatchIndex
+from dtr5app.utils_search import run_search
+
+
+class Dtr5appMatchEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.users = []
+        for i in range(5):
+            u = User.objects.create(username='testuser{}'.format(i),
+                                    last_login=now())
+            u.profile.dob = date(1990, 1, 1)
+            u.profile.sex = 1 if i % 2 else 4
+            u.profile.save()
+            self.users.append(u)
+
+        self.srs = [Sr.objects.create(id='sr{}'.format(i),
+                                      url='/r/sr{}/'.format(i),
+                                      display_name='sr{}'.format(i))
+                    for i in range(3)]
+
+        subs = {0: (0, 1, 2), 1: (0, 1), 2: (2, ), 3: (0, 1, 2)}
+        for i, sr_list in subs.items():
+            for j in sr_list:
+                Subscribed.objects.create(user=self.users[i], sr=self.srs[j])
+
+        self.sr_ids = [x.id for x in self.srs]
+
+    def tearDown(self):
+        pass
+
+    def test_order_by_sr_count(self):
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id}
+        usernames = idx.search_usernames(self.sr_ids, params)
+        self.assertEqual(usernames, ['testuser3', 'testuser1', 'testuser2'])
+
+    def set_sr_weights(self, *weights):
+        for sr, weight in zip(self.srs, weights):
+            Sr.objects.filter(id=sr.id).update(weight=weight)
+
+    def test_order_by_sr_weight(self):
+        # testuser2 shares only one, but a rare subreddit.
+        self.set_sr_weights(0.1, 0.1, 3.0)
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id}
+        usernames = idx.search_usernames(self.sr_ids, params,
+                                         order_by='-sr_weight')
+        self.assertEqual(usernames, ['testuser3', 'testuser2', 'testuser1'])
+
+        # Also selects the "limit" users by weight.
+        usernames = idx.search_usernames(self.sr_ids, params, limit=2,
+                                         order_by='-sr_weight')
+        self.assertEqual(usernames, ['testuser3', 'testuser2'])
+
+    def test_sr_weight_min(self):
+        # Subreddits below the minimum weight are ignored, so testuser1
+        # has nothing in common anymore.
+        self.set_sr_weights(0.1, 0.1, 3.0)
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id}
+        usernames = idx.search_usernames(self.sr_ids, params, min_weight=1.0)
+        self.assertEqual(usernames, ['testuser2', 'testuser3'])
+
+    @override_settings(SEARCH_BACKEND='sql', SR_WEIGHT_MIN=1.0)
+    def test_sr_weight_min_sql(self):
+        # Same as the index, with the raw SQL search.
+        self.set_sr_weights(0.1, 0.1, 3.0)
+        params = {'user_id': self.users[0].id}
+        ids = run_search(self.users[0], self.sr_ids, params, '-sr_weight')[0]
+        self.assertEqual(set(ids), {self.users[2].id, self.users[3].id})
+
+    def test_filter_sex_and_exclude(self):
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id, 'sex': 1}
+        usernames = idx.search_usernames(self.sr_ids, params)
+        self.assertEqual(usernames, ['testuser3', 'testuser1'])
+
+        usernames = idx.search_usernames(self.sr_ids, params,
+                                         exclude_ids=[self.users[3].id])
+        self.assertEqual(usernames, ['testuser1'])
+
+    def test_inactive_users_not_indexed(self):
+        self.users[3].is_active = False
+        self.users[3].save()
+        idx = MatchIndex.build()
+        self.assertIsNone(idx.get_row(self.users[3].id))
+        self.assertEqual(len(idx), 4)
+
+    def test_limit(self):
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id}
+        usernames = idx.search_usernames(self.sr_ids, params, limit=1)
+        self.assertEqual(usernames, ['testuser3'])
+
+    def test_distance_filter_and_order(self):
+        # testuser1 in Potsdam, testuser2 in Munich, testuser3 in Hamburg.
+        for i, latlng in ((1, (52.39, 13.06)), (2, (48.14, 11.58)),
+                          (3, (53.55, 9.99))):
+            profile = self.users[i].profile
+            profile.lat, profile.lng = latlng
+            profile.save()
+
+        idx = MatchIndex.build()
+        params = {'user_id': self.users[0].id, 'lat': 52.52, 'lng': 13.40}
+        usernames = idx.search_usernames(self.sr_ids, params,
+                                         order_by='distance')
+        self.assertEqual(usernames, ['testuser1', 'testuser3', 'testuser2'])
+
+        # Hamburg is inside the Berlin lat/lng box, but not the radius.
+        params['distance'] = 240
+        usernames = idx.search_usernames(self.sr_ids, params,
+                                         order_by='distance')
+        self.assertEqual(usernames, ['testuser1'])
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+from dtr5app.utils_metrics import (MetricsCacheMixin, finish_request,
+                                   get_metrics, get_prometheus_metrics,
+                                   reset_metrics, start_request)
+
+
+class MetricsLocMemCache(MetricsCacheMixin, LocMemCache):
+    pass
+
+
+METRICS_CACHES = {'default': {
+    'BACKEND': 'dtr5app.tests.tests_metrics.MetricsLocMemCache'}}
+
+
+# No search job is queued on login, there is no Redis queue in the tests.
+@override_settings(CACHES=METRICS_CACHES, ALLOWED_HOSTS=['testserver'],
+                   SEARCH_ASYNC=False)
+class Dtr5appMetricsTestCase(TestCase):
+
+    def setUp(self):
+        reset_metrics()
+        self.user = User.objects.create(username='testuser', last_login=now(),
+                                        is_staff=True)
+
+    def tearDown(self):
+        reset_metrics()
+
+    def test_cache_hits_and_misses(self):
+        cache.set('a', 1)
+        start_request()
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1})
+        finish_request('test_view', 100)
+
+        data = get_metrics()['test_view']
+        self.assertEqual(data['requests'], 1)
+        self.assertEqual(data['counters'],
+                         {'cache_hits': 2, 'cache_misses': 3})
+        self.assertEqual(data['histograms']['response_bytes']['sum'], 100)
+
+        text = get_prometheus_metrics()
+        self.assertIn('dtr5_request_cache_hits_total{view="test_view"} 2\n',
+                      text)
+        self.assertIn('dtr5_request_response_bytes_sum{view="test_view"} 100',
+                      text)
+
+    @override_settings(METRICS_QUERY_SAMPLE_RATE=1.0)
+    def test_metrics_views(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('mod_metrics'))
+        data = self.client.get(reverse('mod_metrics')).json()
+
+        view = data['mod_metrics']
+        self.assertEqual(view['requests'], 1)
+        self.assertGreater(view['histograms']['queries']['sum'], 0)
+        self.assertEqual(len(view['slow_queries']),
+                         view['histograms']['queries']['sum'])
+
+        text = self.client.get(reverse('mod_metrics_prometheus')).content
+        self.assertIn(b'dtr5_request_duration_seconds_count'
+                      b'{view="mod_metrics"} 2', text)
+        self.assertIn(b'dtr5_request_queries_bucket'
+                      b'{view="mod_metrics",le="+Inf"} 2', text)
+
+    def test_metrics_staff_only(self):
+        self.user.is_staff = False
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('mod_metrics')).status_code,
+                         302)
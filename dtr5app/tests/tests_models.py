@@ -1,8 +1,14 @@
+import threading
 from datetime import date
+from unittest import skipUnless
+from unittest.mock import patch
+
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.test import TestCase
-from dtr5app.models import Profile
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from dtr5app.models import Conversation, Flag, Match, Message, Profile
+from dtr5app.utils import (count_matches, get_matches_user_list,
+                           rebuild_matches)
 
 
 class Dtr5appModelsTestCase(TestCase):
@@ -88,6 +94,30 @@ class Dtr5appModelsTestCase(TestCase):
             li = Profile.objects.get(pk=self.user1.pk)._f_ignore_sr_li
         self.assertEqual(li, self.sr_list)
 
+    def test_profile_pics(self):
+        profile = self.user1.profile
+        profile.pics = [{'url': 'https://i.imgur.com/abcm.jpg'},
+                        {'url': 'https://example.com/b.jpg'}]
+        self.assertEqual(profile.pics[0]['url_large'],
+                         'https://i.imgur.com/abc.jpg')
+        # Parsed once, and changes to the returned list are not kept.
+        profile.pics[0]['url'] = 'changed'
+        self.assertEqual(profile.pics[0]['url'], 'https://i.imgur.com/abcm.jpg')
+
+        profile.save(update_fields=['_pics'])
+        profile = Profile.objects.get(pk=self.user1.pk)
+        self.assertEqual(profile.primary_pic_url, 'https://i.imgur.com/abcm.jpg')
+        self.assertEqual(profile.pic_count, 2)
+
+        profile.pics = profile.pics[1:]
+        profile.save()
+        profile = Profile.objects.get(pk=self.user1.pk)
+        self.assertEqual(profile.primary_pic_url, 'https://example.com/b.jpg')
+        self.assertEqual(profile.pic_count, 1)
+
+        profile._pics = ''
+        self.assertEqual(profile.pics, [])
+
     def test_profile_dob_age(self):
         dob1 = date(1995, 1, 1)
         dob2 = date(1990, 1, 1)
@@ -95,3 +125,145 @@ class Dtr5appModelsTestCase(TestCase):
         self.user2.profile.dob = dob2
         diff = self.user2.profile.get_age() - self.user1.profile.get_age()
         self.assertEqual(5, diff)
+
+    def test_match_set_and_deleted_with_flags(self):
+        Flag.set_flag(self.user1, self.user2, 'like')
+        self.assertFalse(self.user1.profile.match_with(self.user2))
+        self.assertEqual(0, count_matches(self.user1))
+
+        Flag.set_flag(self.user2, self.user1, 'like')
+        self.assertTrue(self.user1.profile.match_with(self.user2))
+        self.assertTrue(self.user2.profile.match_with(self.user1))
+        self.assertEqual(1, count_matches(self.user1))
+        self.assertEqual([self.user2],
+                         get_matches_user_list(self.user1))
+
+        Flag.set_flag(self.user2, self.user1, 'nope')
+        self.assertFalse(self.user1.profile.match_with(self.user2))
+        self.assertEqual(0, Match.objects.count())
+
+    def test_rebuild_matches(self):
+        Flag.objects.create(sender=self.user1, receiver=self.user2,
+                            flag=Flag.LIKE_FLAG)
+        Flag.objects.create(sender=self.user2, receiver=self.user1,
+                            flag=Flag.LIKE_FLAG)
+        self.assertEqual(0, Match.objects.count())
+
+        self.assertEqual(1, rebuild_matches())
+        self.assertEqual(1, count_matches(self.user1))
+        self.assertEqual(1, count_matches(self.user2))
+
+    def test_rebuild_matches_concurrent_match(self):
+        user3 = User.objects.create(username='testuser3')
+        for a, b in ((self.user1, self.user2), (self.user2, self.user1),
+                     (self.user1, user3), (user3, self.user1)):
+            Flag.objects.create(sender=a, receiver=b, flag=Flag.LIKE_FLAG)
+        Match.objects.create(user=user3, match_user=self.user2)  # stale
+        bulk_create, added = Match.objects.bulk_create, []
+
+        # A like that became a match while the Match table is rebuilt.
+        def concurrent_bulk_create(objs, **kwargs):
+            if objs and not added:
+                added.append(True)
+                Match.set_match(self.user1, self.user2)
+            return bulk_create(objs, **kwargs)
+
+        with patch.object(Match.objects, 'bulk_create',
+                          concurrent_bulk_create):
+            self.assertEqual(2, rebuild_matches(batch_size=1))
+        self.assertEqual(
+            sorted(Match.objects.values_list('user_id', 'match_user_id')),
+            sorted([(self.user1.id, self.user2.id),
+                    (self.user2.id, self.user1.id),
+                    (self.user1.id, user3.id), (user3.id, self.user1.id)]))
+
+    def test_conversation_add_message(self):
+        user3 = User.objects.create(username='testuser3')
+        m1 = Conversation.add_message(self.user2, self.user1, 'Hi 1')
+        m2 = Conversation.add_message(self.user2, self.user1, 'Hi 2')
+        m3 = Conversation.add_message(self.user1, self.user2, 'Hi 3')
+        Conversation.add_message(user3, self.user1, 'Hi 4')
+
+        conversation = Conversation.objects.get(user2=self.user2)
+        self.assertEqual(conversation.user1, self.user1)
+        self.assertEqual(conversation.last_message_id, m3.id)
+        self.assertEqual(conversation.last_message_at, m3.created)
+        self.assertEqual(conversation.user1_unread, 2)
+        self.assertEqual(conversation.user2_unread, 1)
+        self.assertEqual(m1.conversation, m2.conversation)
+
+        Conversation.mark_read(self.user1, self.user2)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.user1_unread, 0)
+        self.assertEqual(conversation.user2_unread, 1)
+
+        with self.assertNumQueries(1):
+            chat_list = Conversation.get_chat_list(self.user1)
+        self.assertEqual([(x['username'], x['unread']) for x in chat_list],
+                         [('testuser3', 1), ('testuser2', 0)])
+        self.assertEqual([(x['username'], x['unread']) for x in
+                          Conversation.get_chat_list(self.user2)],
+                         [('testuser1', 1)])
+
+    def test_messages_list(self):
+        user3 = User.objects.create(username='testuser3')
+        ids = [Conversation.add_message(*users, str(i)).id for i, users in
+               enumerate([(self.user1, self.user2), (self.user2, self.user1)]
+                         * 15)]
+        Conversation.add_message(self.user1, user3, 'Not listed.')
+
+        def get_ids(*args):
+            return [x.id for x in Message.get_messages_list(
+                *args[:1], self.user2, self.user1, *args[1:])]
+
+        self.assertEqual(get_ids(None), ids[::-1][:20])
+        self.assertEqual(get_ids(None, ids[10]), ids[:10][::-1])
+        # The next messages after a message, not the most recent ones.
+        self.assertEqual(get_ids(ids[3]), ids[4:24][::-1])
+        self.assertEqual(get_ids(ids[-1]), [])
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'Concurrent transactions need a PostgreSQL server.')
+class Dtr5appFlagRaceTestCase(TransactionTestCase):
+    """Concurrent likes between two users in two database connections."""
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='testuser1')
+        self.user2 = User.objects.create(username='testuser2')
+
+    def tearDown(self):
+        pass
+
+    def test_concurrent_likes_match(self):
+        # Both requests wait after their like, before they look for the
+        # other like, so that without the lock, each of them would only see
+        # its own like. With the lock, the second request waits for the
+        # first to commit, and the barrier times out.
+        barrier = threading.Barrier(2)
+        create = Flag.objects.create
+
+        def create_and_wait(**kwargs):
+            obj = create(**kwargs)
+            try:
+                barrier.wait(timeout=2)
+            except threading.BrokenBarrierError:
+                pass
+            return obj
+
+        def like(sender, receiver):
+            try:
+                Flag.set_flag(sender, receiver, 'like')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=like, args=pair) for pair in
+                   ((self.user1, self.user2), (self.user2, self.user1))]
+        with patch.object(Flag.objects, 'create', create_and_wait):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(Flag.objects.filter(flag=Flag.LIKE_FLAG).count(), 2)
+        self.assertEqual(Match.objects.count(), 2)
@@ -0,0 +1,125 @@
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import Http404
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+from dtr5app.models import Flag, Match, Sr, Subscribed
+from dtr5app.utils_pagination import (decode_cursor, encode_cursor,
+                                      get_approximate_count, get_keyset_page)
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+# No search job is queued on login, there is no Redis queue in the tests.
+@override_settings(CACHES=LOCMEM_CACHES, ALLOWED_HOSTS=['testserver'],
+                   USERS_PER_PAGE=3, SEARCH_ASYNC=False)
+class Dtr5appPaginationTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        t = now()
+        self.user = User.objects.create(username='testuser', last_login=t)
+        self.others = []
+        for i in range(8):
+            u = User.objects.create(username='testuser{}'.format(i),
+                                    last_login=t)
+            self.others.append(u)
+            # Pairs of likes at the same time, to test the tie breaker.
+            Flag.objects.create(sender=u, receiver=self.user,
+                                flag=Flag.LIKE_FLAG,
+                                created=t - timedelta(minutes=i // 2))
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        pass
+
+    def get_all_pages(self, url, params=None):
+        cursor, user_list = '', []
+        for _ in range(10):
+            data = self.client.get(url, {**(params or {}),
+                                         'cursor': cursor}).json()
+            user_list += data['user_list']
+            cursor = data['next_cursor']
+            if cursor is None:
+                return data, user_list
+        self.fail('Too many pages.')
+
+    def test_cursor(self):
+        t = now()
+        cursor = encode_cursor([t, 123])
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor, 2), [t.isoformat(), 123])
+        self.assertIsNone(decode_cursor('', 2))
+        for bad in ('x', 'a' * 7, encode_cursor([1]), encode_cursor({})):
+            with self.assertRaises(Http404):
+                decode_cursor(bad, 2)
+
+    def test_get_keyset_page(self):
+        qs = Flag.objects.filter(receiver=self.user)
+        ordering = ('-created', '-sender_id')
+        expected = list(qs.order_by(*ordering)
+                          .values_list('sender__username', flat=True))
+
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = get_keyset_page(qs, ordering, cursor,
+                                       columns=['sender__username'])
+            pages.append([x[0] for x in page])
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual([len(x) for x in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_get_approximate_count(self):
+        qs = Flag.objects.filter(receiver=self.user)
+        self.assertEqual(get_approximate_count('test', qs), 8)
+        qs.first().delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_approximate_count('test', qs), 8)
+
+    def test_upvotes_recv_api(self):
+        Flag.set_flag(self.user, self.others[5], 'nope')
+        data, user_list = self.get_all_pages(reverse('upvotes_recv_api'))
+        self.assertEqual(data['count'], 7)
+
+        # Same users as without the cursor, in the order of the cursor.
+        legacy = self.client.get(reverse('upvotes_recv_api')).json()
+        legacy = sorted(legacy['user_list'], reverse=True,
+                        key=lambda x: (x['flag_created'], x['id']))
+        self.assertEqual(len(user_list), 7)
+        self.assertEqual(user_list, legacy)
+
+    def test_matches_api(self):
+        for u in self.others[:5]:
+            Match.set_match(self.user, u)
+        data, user_list = self.get_all_pages(reverse('matches_api'))
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(sorted(x['username'] for x in user_list),
+                         sorted(x.username for x in self.others[:5]))
+
+    def test_sr_user_list_api(self):
+        sr = Sr.objects.create(id='abc', url='/r/test', display_name='test')
+        for u in self.others[:7]:
+            u.profile.dob = date(1990, 1, 1)
+            u.profile.link_karma = 1
+            u.profile.save()
+            Subscribed.objects.create(user=u, sr=sr)
+        url = reverse('sr_user_list_api', args=('test',))
+        params = {'hide_no_pic': 0, 'order': '-date_joined'}
+
+        data, user_list = self.get_all_pages(url, params)
+        self.assertEqual(data['count'], 7)
+        self.assertEqual(data['view_sr']['display_name'], 'test')
+        self.assertEqual([x['username'] for x in user_list],
+                         [x.username for x in reversed(self.others[:7])])
+
+        # Orders by values that change are always paginated by page number.
+        params['order'] = '-views_count'
+        data = self.client.get(url, {**params, 'cursor': ''}).json()
+        self.assertNotIn('next_cursor', data)
@@ -0,0 +1,139 @@
+import json
+import random
+from datetime import date, timedelta
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+from django.utils.timezone import now
+from dtr5app.models import (Conversation, Flag, Message, Profile, Sr,
+                            Subscribed, Visit)
+from dtr5app.utils_search import get_search_sql
+from dtr5app.utils_synthetic import create_synthetic_messages
+from toolbox import get_geo_cell
+
+# Tables that grow with the number of users, and must never be read with a
+# sequential scan by any of the hot queries below.
+LARGE_TABLES = ('auth_user', 'dtr5app_profile', 'dtr5app_subscribed',
+                'dtr5app_flag', 'dtr5app_visit', 'dtr5app_message',
+                'dtr5app_conversation')
+SEED_USERS = 2000
+SEED_SRS = 200
+SEED_ROWS_PER_USER = 10  # subscriptions, likes, visits, and messages each
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'Query plans are only checked on PostgreSQL.')
+class Dtr5appQueryPlansTestCase(TestCase):
+    """
+    Check the EXPLAIN plans of the hot queries against a seeded database,
+    to catch a query that doesn't use its index anymore.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(0)
+        t = now()
+
+        users = User.objects.bulk_create([
+            User(username='testuser{}'.format(i), last_login=t)
+            for i in range(SEED_USERS)])
+        profiles = []
+        for u in users:
+            lat, lng = rnd.uniform(-60, 70), rnd.uniform(-180, 180)
+            profiles.append(Profile(
+                user=u, lat=lat, lng=lng, geo_cell=get_geo_cell(lat, lng),
+                sex=rnd.choice((1, 2)), search_updated=t,
+                dob=date(1970, 1, 1) + timedelta(days=rnd.randrange(15000))))
+        Profile.objects.bulk_create(profiles)
+
+        srs = Sr.objects.bulk_create([
+            Sr(id='sr{}'.format(i), name='sr{}'.format(i),
+               url='/r/sr{}/'.format(i), display_name='sr{}'.format(i))
+            for i in range(SEED_SRS)])
+
+        subs, flags, visits, messages = [], [], [], []
+        for u in users:
+            for sr in rnd.sample(srs, SEED_ROWS_PER_USER):
+                subs.append(Subscribed(user=u, sr=sr))
+            for other in rnd.sample(users, SEED_ROWS_PER_USER):
+                flags.append(Flag(sender=u, receiver=other,
+                                  flag=Flag.LIKE_FLAG))
+                visits.append(Visit(visitor=u, host=other))
+                messages.append((u.id, other.id))
+        Subscribed.objects.bulk_create(subs)
+        Flag.objects.bulk_create(flags, ignore_conflicts=True)
+        Visit.objects.bulk_create(visits)
+        create_synthetic_messages(messages, t, 1000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.user = users[0]
+        cls.other = users[1]
+
+    def tearDown(self):
+        pass
+
+    def get_plan(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    def get_scans(self, node):
+        """Yield all plan nodes that read a table."""
+        if 'Relation Name' in node:
+            yield node
+        for child in node.get('Plans', []):
+            yield from self.get_scans(child)
+
+    def assertNoSeqScan(self, sql, params):
+        plan = self.get_plan(sql, params)
+        seq_scans = [x['Relation Name']
+                     for x in self.get_scans(plan[0]['Plan'])
+                     if x['Node Type'] == 'Seq Scan'
+                     and x['Relation Name'] in LARGE_TABLES]
+        self.assertEqual(seq_scans, [], 'Sequential scan in query plan:\n' +
+                         json.dumps(plan, indent=2))
+
+    def assertNoSeqScanQuerySet(self, qs):
+        self.assertNoSeqScan(*qs.query.sql_with_params())
+
+    def test_search_users_by_raw_sql(self):
+        profile = self.user.profile
+        params = {'user_id': self.user.id, 'sex': 0, 'distance': 200,
+                  'lat': profile.lat, 'lng': profile.lng}
+        for order_by in ('-sr_count', '-sr_weight'):
+            self.assertNoSeqScan(*get_search_sql(self.user, params, order_by))
+
+    def test_flag_lookups(self):
+        for flag in (Flag.LIKE_FLAG, Flag.NOPE_FLAG):
+            self.assertNoSeqScanQuerySet(Flag.objects.filter(
+                flag=flag, sender=self.user, receiver=self.other))
+
+        # Users blocked by auth user, and users who liked auth user.
+        self.assertNoSeqScanQuerySet(Flag.objects.filter(
+            sender=self.user, flag=Flag.BLOCK_FLAG).values('receiver_id'))
+        self.assertNoSeqScanQuerySet(User.objects.filter(
+            flags_sent__receiver=self.user,
+            flags_sent__flag=Flag.LIKE_FLAG,
+        ).order_by('-flags_sent__created')[:500])
+
+    def test_visits_by_host(self):
+        self.assertNoSeqScanQuerySet(Visit.objects.filter(
+            host=self.user, hidden=False).order_by('-created')[:1000])
+
+    def test_messages_between_users(self):
+        self.assertNoSeqScanQuerySet(
+            Message.get_messages_list(None, self.user, self.other))
+        self.assertNoSeqScanQuerySet(
+            Message.get_messages_list(None, self.user, self.other, 1000))
+
+    def test_chat_list(self):
+        self.assertNoSeqScanQuerySet(Conversation.objects.filter(
+            Q(user1=self.user) | Q(user2=self.user),
+            last_message_at__isnull=False,
+        ).order_by('-last_message_at')[:50])
@@ -0,0 +1,179 @@
+from datetime import date
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app import utils_match_engine
+from dtr5app.models import Sr, Subscribed
+from dtr5app.utils import (get_prevnext_user,
+                           get_user_list_from_id_list,
+                           get_user_navigation)
+from dtr5app.utils_search import SearchBuffer, search_results_buffer
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class Dtr5appSearchBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username='testuser{}'.format(i),
+                                          last_login=now())
+                      for i in range(5)]
+        self.ids = [x.id for x in reversed(self.users)]
+
+    def tearDown(self):
+        pass
+
+    def test_save_and_load(self):
+        SearchBuffer(self.users[0].id, self.ids, created=123.0).save()
+        buff = SearchBuffer.load(self.users[0].id)
+        self.assertEqual(list(buff), self.ids)
+        self.assertEqual(buff.created, 123.0)
+        self.assertEqual(buff.index(self.ids[2]), 2)
+        self.assertIsNone(SearchBuffer.load(self.users[1].id).created)
+
+    def test_remove(self):
+        buff = SearchBuffer(self.users[0].id, self.ids)
+        buff.remove(self.ids[1])
+        self.assertNotIn(self.ids[1], buff)
+        self.assertEqual(buff.index(self.ids[2]), 1)
+
+    def test_merge_keeps_highest_scores(self):
+        # Ordered by rank, but cut by score, like a full search.
+        buff = SearchBuffer(self.users[0].id, self.ids[:3], [3.0, 2.0, 1.0],
+                            scores=[1.0, 5.0, 5.0])
+        buff.merge([self.ids[3]], [4.0], [3.0], 3)
+        self.assertEqual(list(buff), [self.ids[3], self.ids[1], self.ids[2]])
+        self.assertEqual(list(buff.scores), [3.0, 5.0, 5.0])
+
+        buff.merge([self.ids[1]], [], [], 3)
+        self.assertEqual(list(buff), [self.ids[3], self.ids[2]])
+
+    def test_user_list_keeps_order(self):
+        user_list = get_user_list_from_id_list(self.ids + [0])
+        self.assertEqual([x.id for x in user_list], self.ids)
+
+    def test_prevnext(self):
+        buff = SearchBuffer(self.users[0].id, self.ids)
+        prev_user, next_user = get_prevnext_user(buff, self.users[4])
+        self.assertEqual((prev_user, next_user), (self.users[0],
+                                                  self.users[3]))
+
+    def test_navigation(self):
+        buff = SearchBuffer(self.users[0].id, self.ids)
+        with self.assertNumQueries(1):
+            prev_user, next_user, user_list = get_user_navigation(
+                buff, self.users[1], 2)
+            self.assertEqual(prev_user.profile.user_id, self.users[2].id)
+        self.assertEqual(next_user, self.users[0])
+        self.assertEqual(user_list, [self.users[0], self.users[4]])
+
+        # not in buffer: begin with the first users
+        buff.remove(self.users[1].id)
+        prev_user, next_user, user_list = get_user_navigation(
+            buff, self.users[1], 2)
+        self.assertEqual(user_list, [self.users[4], self.users[3]])
+        self.assertEqual((prev_user, next_user), (self.users[3],
+                                                  self.users[4]))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SEARCH_CACHE_TIMEOUT=0,
+                   SEARCH_ASYNC=False)
+class Dtr5appSearchBufferRefreshTestCase(TestCase):
+
+    def setUp(self):
+        # User ids are reused between tests, and so are their cache keys.
+        cache.clear()
+        utils_match_engine._index = None
+        self.srs = [Sr.objects.create(id='sr{}'.format(i),
+                                      url='/r/sr{}/'.format(i),
+                                      display_name='sr{}'.format(i))
+                    for i in range(3)]
+        self.users = [self.create_user(i, self.srs[:3-i]) for i in range(3)]
+        self.request = SimpleNamespace(user=self.users[0], session={})
+
+    def tearDown(self):
+        cache.clear()
+        utils_match_engine._index = None
+
+    def create_user(self, i, srs):
+        u = User.objects.create(username='testuser{}'.format(i),
+                                last_login=now())
+        u.profile.dob = date(1990, 1, 1)
+        u.profile.save()
+        for sr in srs:
+            Subscribed.objects.create(user=u, sr=sr)
+        return u
+
+    def test_incremental_refresh(self):
+        buff = search_results_buffer(self.request)
+        self.assertEqual(list(buff), [self.users[1].id, self.users[2].id])
+        created = buff.created
+
+        # A new user with 2 subs in common is merged in before testuser2,
+        # and testuser1 doesn't match anymore after a profile change.
+        new_user = self.create_user(3, self.srs[1:])
+        self.users[1].profile.dob = date(1900, 1, 1)
+        self.users[1].profile.save()
+
+        buff = search_results_buffer(self.request, refresh=True)
+        self.assertEqual(list(buff), [new_user.id, self.users[2].id])
+        self.assertEqual(buff.created, created)
+
+        # Changed search options need a full search.
+        self.request.session['search_results_order'] = '-views_count'
+        buff = search_results_buffer(self.request, refresh=True)
+        self.assertNotEqual(buff.created, created)
+
+    @override_settings(SEARCH_ASYNC=True)
+    @patch('dtr5app.utils_search_jobs.get_queue_connection')
+    def test_async_full_search(self, get_queue_connection):
+        buff = search_results_buffer(self.request)  # first search inline
+        self.assertFalse(buff.refreshing)
+        created = buff.created
+
+        # Changed search options: return the old buffer and queue a job,
+        # but only once.
+        self.request.session['search_results_order'] = '-views_count'
+        for i in range(2):
+            buff = search_results_buffer(self.request, refresh=True)
+            self.assertTrue(buff.refreshing)
+            self.assertEqual(buff.created, created)
+        self.assertEqual(get_queue_connection().lpush.call_count, 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SEARCH_CACHE_TIMEOUT=10,
+                   SEARCH_BACKEND='index', SEARCH_ASYNC=False)
+class Dtr5appSearchBufferSnapshotTestCase(Dtr5appSearchBufferRefreshTestCase):
+    """Same tests, with a shared search cache and the match index."""
+
+    def test_refresh_after_stale_index(self):
+        # The match index doesn't know the new user yet, so the full search
+        # can't find them. The next refresh must, the new user changed after
+        # the index was built, even though before the full search.
+        utils_match_engine.get_match_index()
+        new_user = self.create_user(3, self.srs[1:])
+        buff = search_results_buffer(self.request)
+        self.assertNotIn(new_user.id, buff)
+        self.assertEqual(buff.snapshot, utils_match_engine._index.built)
+
+        buff = search_results_buffer(self.request, refresh=True)
+        self.assertIn(new_user.id, buff)
+
+    def test_snapshot_of_shared_search(self):
+        # Same favorite subreddits and search options as testuser0, so the
+        # search is shared, and keeps the time of the index it was found in.
+        other = self.create_user(4, self.srs)
+        buff = search_results_buffer(self.request)
+        utils_match_engine._index = None
+
+        other_buff = search_results_buffer(
+            SimpleNamespace(user=other, session={}))
+        self.assertIsNone(utils_match_engine._index)
+        self.assertEqual(other_buff.snapshot, buff.snapshot)
+        self.assertLess(other_buff.snapshot, other_buff.created)
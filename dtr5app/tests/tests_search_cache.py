@@ -0,0 +1,99 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Sr, Subscribed
+from dtr5app.utils_search_cache import (bulk_subscription_changes,
+                                        get_search_cache_key,
+                                        get_shared_search_results,
+                                        get_search_cache_stats,
+                                        get_sr_generations, invalidate_srs,
+                                        normalize_search_params)
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class Dtr5appSearchCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', last_login=now())
+        self.sr = Sr.objects.create(id='sr0', url='/r/sr0/',
+                                    display_name='sr0')
+        Subscribed.objects.create(user=self.user, sr=self.sr)
+        self.params = {'user_id': self.user.id, 'sex': 1, 'distance': 100,
+                       'lat': 52.5201, 'lng': 13.4051}
+
+    def tearDown(self):
+        pass
+
+    def get_key(self, params):
+        params = normalize_search_params(params)
+        return get_search_cache_key([self.sr.id], params, '-sr_count')
+
+    def test_normalized_key(self):
+        key = self.get_key(self.params)
+        other = dict(self.params, user_id=self.user.id + 1, lat=52.5202)
+        self.assertEqual(key, self.get_key(other))
+
+        other = dict(self.params, lat=48.1351, lng=11.5820)
+        self.assertNotEqual(key, self.get_key(other))
+
+        # location is irrelevant for worldwide searches
+        params = dict(self.params, distance=0)
+        other = dict(params, lat=48.1351, lng=11.5820)
+        self.assertEqual(self.get_key(params), self.get_key(other))
+
+        # ...unless the results are ordered by distance.
+        self.assertNotEqual(
+            normalize_search_params(params, 'distance'),
+            normalize_search_params(other, 'distance'))
+
+    def test_invalidate_on_subscribe(self):
+        key = self.get_key(self.params)
+        user = User.objects.create(username='testuser2', last_login=now())
+        Subscribed.objects.create(user=user, sr=self.sr)
+        self.assertNotEqual(key, self.get_key(self.params))
+
+    def test_invalidate_srs(self):
+        before = get_sr_generations(['sr0', 'sr1'])
+        invalidate_srs(['sr0', 'sr1'])
+        invalidate_srs(['sr0'])
+        after = get_sr_generations(['sr0', 'sr1'])
+        self.assertEqual([b - a for a, b in zip(before, after)], [2, 1])
+
+    def test_no_invalidation_in_bulk_changes(self):
+        key = self.get_key(self.params)
+        with bulk_subscription_changes():
+            Subscribed.objects.filter(user=self.user).delete()
+        self.assertEqual(key, self.get_key(self.params))
+
+        Subscribed.objects.create(user=self.user, sr=self.sr)
+        self.assertNotEqual(key, self.get_key(self.params))
+
+    def test_invalidate_on_profile_change(self):
+        key = self.get_key(self.params)
+        self.user.profile.f_sex = 2  # search option only, no invalidation
+        self.user.profile.save()
+        self.assertEqual(key, self.get_key(self.params))
+
+        self.user.profile.sex = 2
+        self.user.profile.save()
+        self.assertNotEqual(key, self.get_key(self.params))
+
+    def test_hits_and_misses(self):
+        calls = []
+
+        def search_fn(params):
+            calls.append(params)
+            return [self.user.id]
+
+        for i in range(3):
+            ids = get_shared_search_results(
+                [self.sr.id], self.params, '-sr_count', search_fn)
+            self.assertEqual(ids, [self.user.id])
+
+        self.assertEqual(len(calls), 1)
+        self.assertNotIn('user_id', calls[0])
+        stats = get_search_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
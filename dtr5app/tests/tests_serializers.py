@@ -0,0 +1,65 @@
+import json
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.test import TestCase
+from django.utils.timezone import now
+from dtr5app.models import Flag, Match
+from dtr5app.serializers import (BasicUserSerializer, basic_user_list_data,
+                                 basic_user_list_data_by_ids)
+from dtr5app.utils import get_matches_user_list
+
+
+class Dtr5appSerializersTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', last_login=now())
+        self.others = []
+        for i in range(4):
+            u = User.objects.create(username='testuser{}'.format(i),
+                                    last_login=now())
+            u.profile.dob = date(1980 + i, 1, 1)
+            u.profile.lat, u.profile.lng = 52.5 + i, 13.4
+            u.profile.sex = i
+            u.profile.accessed = now() if i % 2 else None
+            u.profile.pics = [{'url': 'https://example.com/{}.jpg'.format(i)}
+                              ] if i else []
+            u.profile.save()
+            self.others.append(u)
+            Flag.set_flag(u, self.user, 'like')
+        Flag.set_flag(self.user, self.others[2], 'like')
+
+    def tearDown(self):
+        pass
+
+    def assertSameJSON(self, data, drf_data):
+        self.assertEqual(json.dumps(data), json.dumps(drf_data))
+
+    def test_basic_user_list_data(self):
+        qs = User.objects.filter(
+            flags_sent__receiver=self.user, flags_sent__flag=Flag.LIKE_FLAG,
+        ).annotate(flag_created=F('flags_sent__created')) \
+            .order_by('-flags_sent__created')[:3]
+
+        with self.assertNumQueries(1):
+            data = basic_user_list_data(qs)
+        self.assertEqual(len(data), 3)
+        self.assertSameJSON(data, BasicUserSerializer(qs, many=True).data)
+
+    def test_basic_user_list_data_matches(self):
+        qs = Match.objects.filter(user=self.user).order_by('-created')
+        data = basic_user_list_data(qs, prefix='match_user__',
+                                    flag_created='created')
+        drf_data = BasicUserSerializer(get_matches_user_list(self.user),
+                                       many=True).data
+        self.assertEqual(len(data), 1)
+        self.assertSameJSON(data, drf_data)
+
+    def test_basic_user_list_data_by_ids(self):
+        ids = [self.others[2].id, 0, self.others[0].id, self.others[3].id]
+        data = basic_user_list_data_by_ids(ids)
+        self.assertEqual([x['id'] for x in data], [x for x in ids if x])
+        drf_data = BasicUserSerializer(
+            [self.others[2], self.others[0], self.others[3]], many=True).data
+        self.assertSameJSON(data, drf_data)
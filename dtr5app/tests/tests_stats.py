@@ -0,0 +1,44 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Flag, Profile
+from dtr5app.utils_stats import get_active_users_counts, get_stats_snapshot
+
+LOCMEM_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, STATS_CACHE_TIMEOUT=60)
+@patch('dtr5app.utils_stats.count_active_users', return_value=None)
+class Dtr5appStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username='testuser{}'.format(i),
+                                          last_login=now())
+                      for i in range(3)]
+        for i, user in enumerate(self.users):
+            Profile.objects.filter(user=user).update(
+                accessed=now() - timedelta(days=i * 10, minutes=1))
+
+    def tearDown(self):
+        pass
+
+    def test_active_users_counts(self, count_active_users):
+        with self.assertNumQueries(1):
+            counts = get_active_users_counts()
+        self.assertEqual((counts['1m'], counts['1h'], counts['7d'],
+                          counts['30d'], counts['1y']), (0, 1, 1, 3, 3))
+
+    def test_snapshot_is_cached(self, count_active_users):
+        Flag.set_flag(self.users[0], self.users[1], 'like')
+        Flag.set_flag(self.users[1], self.users[0], 'like')
+        snapshot = get_stats_snapshot()
+        self.assertEqual(snapshot['likes_count'], 2)
+        self.assertEqual(snapshot['matches_count'], 1)
+        self.assertEqual(snapshot['users_active_24h'], 1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_stats_snapshot(), snapshot)
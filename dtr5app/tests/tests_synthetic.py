@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils.timezone import now
+from dtr5app.models import Profile, Sr, Subscribed
+from dtr5app.utils_synthetic import (delete_synthetic_data,
+                                     get_zipf_probabilities,
+                                     make_synthetic_data)
+
+
+class Dtr5appSyntheticTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', last_login=now())
+        self.sr = Sr.objects.create(id='sr0', url='/r/sr0/',
+                                    display_name='sr0')
+        Subscribed.objects.create(user=self.user, sr=self.sr)
+
+    def tearDown(self):
+        pass
+
+    def test_zipf_probabilities(self):
+        p = get_zipf_probabilities(100)
+        self.assertAlmostEqual(p.sum(), 1.0)
+        self.assertTrue((p[:-1] > p[1:]).all())
+
+    def test_make_and_delete_synthetic_data(self):
+        self.assertEqual(make_synthetic_data(users=30, srs=10, batch_size=20),
+                         30)
+        self.assertEqual(make_synthetic_data(users=10, srs=10, seed=1), 10)
+
+        synth = User.objects.exclude(pk=self.user.pk)
+        self.assertEqual(synth.count(), 40)
+        self.assertEqual(Profile.objects.filter(geo_cell__isnull=True)
+                         .exclude(user=self.user).count(), 0)
+        # The first subreddits are the most popular.
+        counts = dict(Sr.objects.values_list('id', 'subscribers_here'))
+        self.assertGreater(counts['S0'], counts['S9'])
+
+        self.assertEqual(delete_synthetic_data(), 40)
+        self.assertEqual(list(User.objects.all()), [self.user])
+        self.assertEqual(list(Sr.objects.values_list('id', 'subscribers_here')),
+                         [('sr0', 1)])
@@ -0,0 +1,153 @@
+import math
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.utils.timezone import now
+from dtr5app.models import Flag, Sr, Subscribed
+from dtr5app.utils import (add_relationship_flags, count_subscribers_here,
+                           dedup_subscriptions,
+                           update_list_of_subscribed_subreddits,
+                           update_sr_weights)
+
+
+class Dtr5appUtilsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', last_login=now())
+        self.others = [User.objects.create(username='testuser{}'.format(i),
+                                           last_login=now())
+                       for i in range(4)]
+
+    def tearDown(self):
+        pass
+
+    def test_add_relationship_flags(self):
+        a, b, c, d = self.others
+        Flag.set_flag(self.user, a, 'like')
+        Flag.set_flag(a, self.user, 'like')
+        Flag.set_flag(self.user, b, 'like')
+        Flag.set_flag(c, self.user, 'like')
+        Flag.set_flag(self.user, d, 'nope')
+
+        with self.assertNumQueries(1):
+            ul = add_relationship_flags(list(self.others), self.user)
+
+        self.assertEqual([x.is_like_sent for x in ul],
+                         [True, True, False, False])
+        self.assertEqual([x.is_like_recv for x in ul],
+                         [True, False, True, False])
+        self.assertEqual([x.is_match for x in ul],
+                         [True, False, False, False])
+        self.assertEqual([x.is_nope for x in ul],
+                         [False, False, False, True])
+
+    def get_subscribed_row(self, sr_id, **kwargs):
+        row = {'id': sr_id, 'display_name': sr_id, 'created_utc': 1262304000,
+               'url': '/r/{}/'.format(sr_id), 'over18': False, 'lang': 'en',
+               'title': sr_id, 'subreddit_type': 'public', 'subscribers': 100,
+               'user_is_contributor': False, 'user_is_moderator': False,
+               'user_is_subscriber': True, 'user_is_banned': False,
+               'user_is_muted': False}
+        row.update(kwargs)
+        return row
+
+    def test_update_list_of_subscribed_subreddits(self):
+        a, b = self.others[:2]
+        update_list_of_subscribed_subreddits(a, [self.get_subscribed_row(x)
+                                                 for x in ('s1', 's2')])
+        update_list_of_subscribed_subreddits(self.user, [
+            self.get_subscribed_row(x) for x in ('s1', 's2', 's3')])
+        Subscribed.objects.filter(user=self.user, sr_id='s1') \
+            .update(is_favorite=False)
+
+        # Keep s1, update s2, leave s3, join s4 and s5.
+        subscribed = [self.get_subscribed_row('s1'),
+                      self.get_subscribed_row('s2', user_is_moderator=True),
+                      self.get_subscribed_row('s4'),
+                      self.get_subscribed_row('s5')]
+        with self.assertNumQueries(13):
+            update_list_of_subscribed_subreddits(self.user, subscribed)
+
+        subs = {x.sr_id: x for x in Subscribed.objects.filter(user=self.user)}
+        self.assertEqual(sorted(subs), ['s1', 's2', 's4', 's5'])
+        self.assertFalse(subs['s1'].is_favorite)
+        self.assertTrue(subs['s2'].user_is_moderator)
+        self.assertEqual(
+            dict(Sr.objects.values_list('id', 'subscribers_here')),
+            {'s1': 2, 's2': 2, 's3': 0, 's4': 1, 's5': 1})
+
+        # The same list again changes nothing.
+        with self.assertNumQueries(4):
+            update_list_of_subscribed_subreddits(self.user, subscribed)
+        self.assertEqual(Sr.objects.get(id='s4').subscribers_here, 1)
+        self.assertEqual(b.subs.count(), 0)
+
+    def test_concurrent_subscribe(self):
+        update_list_of_subscribed_subreddits(self.others[0], [
+            self.get_subscribed_row('s1')])
+        bulk_create = Subscribed.objects.bulk_create
+
+        def concurrent_bulk_create(objs, **kwargs):
+            # Another request of the same user subscribed in the meantime.
+            Subscribed.objects.create(user=self.user, sr_id='s1')
+            Sr.objects.filter(id='s1').update(subscribers_here=2)
+            return bulk_create(objs, **kwargs)
+
+        with patch.object(Subscribed.objects, 'bulk_create',
+                          concurrent_bulk_create):
+            update_list_of_subscribed_subreddits(self.user, [
+                self.get_subscribed_row('s1')])
+        self.assertEqual(Subscribed.objects.filter(sr_id='s1').count(), 2)
+        self.assertEqual(Sr.objects.get(id='s1').subscribers_here, 2)
+
+    def test_count_subscribers_here(self):
+        a, b = self.others[:2]
+        update_list_of_subscribed_subreddits(a, [self.get_subscribed_row(x)
+                                                 for x in ('s1', 's2')])
+        update_list_of_subscribed_subreddits(b, [self.get_subscribed_row('s1')])
+        Sr.objects.update(subscribers_here=7)
+
+        self.assertEqual(dedup_subscriptions(), [])
+        self.assertEqual(count_subscribers_here(['s1']), 1)
+        self.assertEqual(
+            dict(Sr.objects.values_list('id', 'subscribers_here')),
+            {'s1': 2, 's2': 7})
+        self.assertEqual(count_subscribers_here(), 2)
+        self.assertEqual(Sr.objects.get(id='s2').subscribers_here, 1)
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'Needs transactional DDL, to allow doubles in the test.')
+    def test_dedup_subscriptions(self):
+        Sr.objects.create(id='s1', url='/r/s1/')
+        with connection.schema_editor() as editor:
+            editor.alter_unique_together(Subscribed, [('user', 'sr')], [])
+        a, b = self.others[:2]
+        for user, favs in ((a, [False, True, False]), (b, [False, False])):
+            for fav in favs:
+                Subscribed.objects.create(user=user, sr_id='s1',
+                                          is_favorite=fav)
+        first_a = Subscribed.objects.filter(user=a).order_by('id').first()
+
+        self.assertEqual(dedup_subscriptions(batch_size=1), ['s1'])
+        self.assertEqual(
+            list(Subscribed.objects.order_by('user_id')
+                           .values_list('id', 'user_id', 'is_favorite')),
+            [(first_a.id, a.id, True),
+             (Subscribed.objects.get(user=b).id, b.id, False)])
+
+    def test_update_sr_weights(self):
+        for i, n in enumerate((0, 2, 9)):
+            Sr.objects.create(id='sr{}'.format(i), url='/r/sr{}/'.format(i),
+                              subscribers_here=n)
+
+        # 5 searchable users: ln(6 / (subscribers_here + 1)), at least 0.
+        self.assertEqual(update_sr_weights(['sr0', 'sr2'], refresh=True), 2)
+        weights = dict(Sr.objects.values_list('id', 'weight'))
+        self.assertAlmostEqual(weights['sr0'], math.log(6))
+        self.assertEqual((weights['sr1'], weights['sr2']), (0.0, 0.0))
+
+        update_sr_weights()
+        self.assertAlmostEqual(Sr.objects.get(id='sr1').weight, math.log(2))
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from dtr5app.models import Visit
+from dtr5app.utils_visitors import (NO_VISITORS, add_visit,
+                                    get_recent_visitors, get_visitors_list)
+
+
+@override_settings(VISITORS_LIST_MAX=1000, VISITORS_TIMEOUT=3600)
+@patch('dtr5app.utils_visitors.get_visitors_connection')
+class Dtr5appVisitorsTestCase(TestCase):
+
+    def setUp(self):
+        self.host = User.objects.create(username='testuser', last_login=now())
+        self.others = [User.objects.create(username='testuser{}'.format(i),
+                                           last_login=now())
+                       for i in range(3)]
+
+    def tearDown(self):
+        pass
+
+    def test_add_visitor_host(self, get_visitors_connection):
+        t = now() - timedelta(hours=1)
+        with self.assertNumQueries(1):
+            Visit.add_visitor_host(self.others[0], self.host, t)
+        Visit.objects.update(hidden=True)
+        with self.assertNumQueries(1):
+            Visit.add_visitor_host(self.others[0], self.host)
+
+        visit = Visit.objects.get()
+        self.assertGreater(visit.created, t)
+        self.assertFalse(visit.hidden)
+
+    def test_add_visit(self, get_visitors_connection):
+        conn = get_visitors_connection.return_value
+        pipe = conn.pipeline.return_value
+        pipe.execute.return_value = [1, 1, 0, 0, True]
+
+        add_visit(self.others[0], self.host)
+        key = 'visitors:{}'.format(self.host.id)
+        self.assertEqual(list(pipe.zadd.call_args[0][1]), [self.others[0].id])
+        pipe.zrem.assert_called_once_with(key, NO_VISITORS)
+        pipe.zremrangebyrank.assert_called_once_with(key, 0, -1001)
+        pipe.expire.assert_called_once_with(key, 3600)
+        pipe.execute.assert_called_once_with()
+        conn.exists.assert_not_called()
+
+    def test_add_visit_rebuilds_missing(self, get_visitors_connection):
+        conn = get_visitors_connection.return_value
+        pipe = conn.pipeline.return_value
+        pipe.execute.return_value = [0, 1, 0, 0, True]
+
+        Visit.add_visitor_host(self.others[1], self.host,
+                               now() - timedelta(hours=1))
+        add_visit(self.others[0], self.host)
+        pipe.delete.assert_called_once_with('visitors:{}'.format(self.host.id))
+        self.assertEqual(list(pipe.zadd.call_args[0][1]),
+                         [self.others[0].id, self.others[1].id])
+
+    def test_get_recent_visitors(self, get_visitors_connection):
+        conn = get_visitors_connection.return_value
+        t = now().replace(microsecond=0)
+        conn.zrevrange.return_value = [(b'5', t.timestamp()),
+                                       (b'3', t.timestamp() - 60)]
+        self.assertEqual(get_recent_visitors(self.host.id),
+                         [(5, t), (3, t - timedelta(seconds=60))])
+
+        # Without a sorted set, the visitors are read from the database.
+        conn.zrevrange.return_value = []
+        Visit.add_visitor_host(self.others[1], self.host, t)
+        self.assertEqual(get_recent_visitors(self.host.id),
+                         [(self.others[1].id, t)])
+
+    def test_get_recent_visitors_none(self, get_visitors_connection):
+        conn = get_visitors_connection.return_value
+        pipe = conn.pipeline.return_value
+        conn.zrevrange.return_value = []
+        self.assertEqual(get_recent_visitors(self.host.id), [])
+        pipe.zadd.assert_called_once_with('visitors:{}'.format(self.host.id),
+                                          {NO_VISITORS: 0})
+
+        # The empty list is read from Redis, without a rebuild.
+        conn.zrevrange.return_value = [(NO_VISITORS, 0.0)]
+        with self.assertNumQueries(0):
+            self.assertEqual(get_recent_visitors(self.host.id), [])
+        pipe.delete.assert_called_once()
+
+    def test_get_visitors_list(self, get_visitors_connection):
+        self.others[1].is_active = False
+        self.others[1].save()
+        t = now()
+        visits = [(self.others[2].id, t), (self.others[1].id, t),
+                  (self.others[0].id, t - timedelta(hours=1)), (0, t)]
+
+        with self.assertNumQueries(1):
+            user_list = get_visitors_list(visits)
+            self.assertEqual(user_list[1].profile.user_id, self.others[0].id)
+        self.assertEqual([x.id for x in user_list],
+                         [self.others[2].id, self.others[0].id])
+        self.assertEqual(user_list[1].visit_created, t - timedelta(hours=1))
@@ -6,11 +6,21 @@ import requests
 from datetime import datetime
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage
+from django.db import transaction
+from django.db.models import (Count, F, FloatField, Max, Min, OuterRef, Q,
+                              Subquery, Value)
+from django.db.models.functions import Cast, Coalesce, Greatest, Ln
 from django.http import Http404
-from .models import Sr, Subscribed, Flag
+from .models import Sr, Subscribed, Flag, Match
+from .utils_search_cache import (bulk_subscription_changes, invalidate_srs,
+                                 touch_user_search)
 from toolbox import force_int
 
+SUBSCRIBED_FLAGS = ('user_is_contributor', 'user_is_moderator',
+                    'user_is_subscriber', 'user_is_banned', 'user_is_muted')
+
 
 def get_subs_for_user(user):
     if user.is_authenticated:
@@ -63,138 +73,244 @@ def update_list_of_subscribed_subreddits(user, subscribed):
     list. Do NOT simply remove all and then add the current list,
     because that would lose the user's "is_favorite" value that is
     part of the Subscribed model.
+
+    The list is compared with the user's current subscriptions in memory,
+    and the changes are written with a fixed number of bulk queries, no
+    matter how many subreddits the user is subscribed to.
+    """
+    rows = {row['id']: row for row in subscribed}
+
+    with transaction.atomic():
+        # Create all subreddits that are new to this site. Conflicts are
+        # subreddits created by a concurrent request in the meantime, or
+        # with an url already in use, which are skipped like before.
+        known_sr_ids = set(Sr.objects.filter(id__in=rows)
+                           .values_list('id', flat=True))
+        new_srs = [Sr(
+            id=sr_id,
+            name=row['display_name'][:50],  # display_name
+            created=datetime.utcfromtimestamp(int(row['created_utc'])
+                                              ).replace(tzinfo=pytz.utc),
+            url=row['url'][:50],
+            over18=row['over18'],
+            lang=row['lang'],
+            title=row['title'][:100],
+            display_name=row['display_name'],
+            subreddit_type=row['subreddit_type'][:50],
+            subscribers=row['subscribers'],
+        ) for sr_id, row in rows.items() if sr_id not in known_sr_ids]
+        if new_srs:
+            Sr.objects.bulk_create(new_srs, ignore_conflicts=True)
+            known_sr_ids = set(Sr.objects.filter(id__in=rows)
+                               .values_list('id', flat=True))
+
+        subs = {x.sr_id: x for x in Subscribed.objects.filter(user=user)}
+
+        added_ids, changed = [], []
+        for sr_id, row in rows.items():
+            if sr_id not in known_sr_ids:
+                continue
+            flags = {k: bool(row[k]) for k in SUBSCRIBED_FLAGS}
+            sub = subs.get(sr_id)
+            if sub is None:
+                added_ids.append(sr_id)
+            elif any(getattr(sub, k) != v for k, v in flags.items()):
+                for k, v in flags.items():
+                    setattr(sub, k, v)
+                changed.append(sub)
+        removed_ids = [sr_id for sr_id in subs if sr_id not in rows]
+        del_ids = [subs[sr_id].pk for sr_id in removed_ids]
+
+        # Conflicts are subscriptions added by a concurrent request.
+        Subscribed.objects.bulk_create([
+            Subscribed(user=user, sr_id=sr_id,
+                       **{k: bool(rows[sr_id][k]) for k in SUBSCRIBED_FLAGS})
+            for sr_id in added_ids], ignore_conflicts=True)
+        if changed:
+            Subscribed.objects.bulk_update(changed, SUBSCRIBED_FLAGS)
+        if del_ids:
+            # The search cache is invalidated once below, not per row.
+            with bulk_subscription_changes():
+                Subscribed.objects.filter(pk__in=del_ids).delete()
+
+        # Count the local users (users of the sr who are also users on this
+        # site) of the subreddits they joined or left again. Not just +1 or
+        # -1, a concurrent request may have added or removed the same rows.
+        if added_ids or removed_ids:
+            count_subscribers_here(added_ids + removed_ids)
+
+    # Refresh the search weights and cached searches of all subreddits that
+    # gained or lost a subscriber.
+    changed_sr_ids = added_ids + removed_ids
+    if changed_sr_ids:
+        update_sr_weights(changed_sr_ids)
+        invalidate_srs(changed_sr_ids)
+        touch_user_search(user.id)
+
+
+def get_searchable_users_count(refresh=False):
+    """
+    Return the number of active users, i.e. users that can show up in search
+    results. Cached for an hour, it's only used for the subreddit weights.
     """
-    for row in subscribed:
-        # Fetch this subreddit onject or create it.
-        sr, sr_created = Sr.objects.get_or_create(id=row['id'], defaults={
-            'name': row['display_name'][:50],  # display_name
-            'created': datetime.utcfromtimestamp(int(row['created_utc'])
-                                                 ).replace(tzinfo=pytz.utc),
-            'url': row['url'][:50],
-            'over18': row['over18'],
-            'lang': row['lang'],
-            'title': row['title'][:100],
-            'display_name': row['display_name'],
-            'subreddit_type': row['subreddit_type'][:50],
-            'subscribers': row['subscribers'], })
-
-        # Add the user as subscriber to the subredit object, if that's
-        # not already the case.
-        default = {'user_is_contributor': bool(row['user_is_contributor']),
-                   'user_is_moderator': bool(row['user_is_moderator']),
-                   'user_is_subscriber': bool(row['user_is_subscriber']),
-                   'user_is_banned': bool(row['user_is_banned']),
-                   'user_is_muted': bool(row['user_is_muted']), }
-        try:
-            sub, sub_created = Subscribed.objects.get_or_create(
-                user=user, sr=sr, defaults=default)
-
-        except Subscribed.MultipleObjectsReturned:
-            # There are a couple of users who have "double subscriptions" to
-            # some (not all) of their subreddits. These users will cause this
-            # exception whe trying to update their Subscribed list. Fetch the
-            # double subscription and deleted it, then add it again.
-            # TODO: fix all doubles, then fix db schema (unique_together).
-            sub_created = False  # no new subreddit added
-            Subscribed.objects.filter(user=user, sr=sr).delete()
-            Subscribed.objects.create(user=user, sr=sr, **default)
-
-        # If the user was newly added to the subreddit, count it as
-        # a local user for that subreddit. (a user of the sr who is
-        # also a user on this site)
-        if sub_created:
-            sr.subscribers_here += 1
-            sr.save()
-
-    # After adding the user to all subs from their new subscribed list, now
-    # check if they are still added to any subs they were previously
-    # subscribed to, but not anymore. That is, any subscription not part of the
-    # new subscribed list.
-    sr_ids = [row['id'] for row in subscribed]
-    to_del = Subscribed.objects.filter(user=user).exclude(sr__in=sr_ids)
-    for row in to_del:
-        if row.sr.subscribers_here > 0:
-            row.sr.subscribers_here -= 1
-        row.sr.save()
-        row.delete()
-
-
-def get_user_list_after(request, view_user, n=5):
-    """
-    From the search buffer, return a list of "n" user objects after view_user.
-    """
-    buff = request.session['search_results_buffer']
+    n = None if refresh else cache.get('searchable_users_count', None)
+    if n is None:
+        n = User.objects.filter(is_active=True,
+                                last_login__isnull=False).count()
+        cache.set('searchable_users_count', n, 60 * 60)
+    return n
 
-    try:
-        idx = buff.index(view_user.username)
-    except ValueError:  # view_user is not part of buffer, begin at index 0
-        return get_user_list_from_username_list(buff[:n])
 
-    if (len(buff)-1) <= n:
-        # buff minus view_user is n? then use entire list minus view_user
-        return get_user_list_from_username_list(buff[:idx] + buff[idx+1:])
+def update_sr_weights(sr_ids=None, refresh=False):
+    """
+    Set Sr.weight, the inverse frequency of a subreddit among the users of
+    this site, to ln(users / subscribers_here), for all subreddits with an id
+    in the sr_ids list, or for all subreddits if sr_ids is None. Used by the
+    "-sr_weight" search order, so that sharing a small subreddit counts more
+    than sharing one of the large default subs.
 
-    usernames = buff[idx+1:idx+1+n]  # get n users after view_user
-    if len(usernames) < n:  # if end-of-list was reached, wrap around
-        n2 = n - len(usernames)
-        usernames += buff[0:n2]
-    return get_user_list_from_username_list(usernames)
+    :refresh: recount the users, instead of using the cached number.
 
+    Returns the number of subreddits updated.
+    """
+    n = get_searchable_users_count(refresh)
+    weight = Greatest(Ln(Value(n + 1.0) / (
+        Cast('subscribers_here', FloatField()) + Value(1.0))), Value(0.0))
+
+    qs = Sr.objects.all()
+    if sr_ids is not None:
+        qs = qs.filter(id__in=sr_ids)
+    return qs.update(weight=weight)
 
-def get_user_list_from_username_list(username_list):
+
+def dedup_subscriptions(batch_size=1000):
     """
-    Return a list of user objects with prefetched profiles and subs, from
-    a list of usernames. Important: must be are in the same order as the
-    username_list.
+    Delete all "double subscriptions", i.e. more than one Subscribed row for
+    the same user and subreddit. The first row is kept, and it is marked
+    is_favorite if any of the doubles was. Each batch of batch_size doubles
+    is deleted in its own short transaction, so that this can run while the
+    site is online.
+
+    Returns a list of the ids of all subreddits that had double subscriptions.
+    """
+    doubles = list(Subscribed.objects.order_by().values('user_id', 'sr_id')
+                   .annotate(n=Count('id'), first_id=Min('id'),
+                             fav=Count('id', filter=Q(is_favorite=True)))
+                   .filter(n__gt=1)
+                   .values_list('user_id', 'sr_id', 'first_id', 'fav'))
+
+    for i in range(0, len(doubles), batch_size):
+        batch = doubles[i:i+batch_size]
+        keep = {(user_id, sr_id): first_id
+                for user_id, sr_id, first_id, fav in batch}
+        fav_ids = [first_id for user_id, sr_id, first_id, fav in batch if fav]
+        with transaction.atomic():
+            rows = Subscribed.objects.filter(
+                user_id__in={x[0] for x in batch},
+                sr_id__in={x[1] for x in batch},
+            ).values_list('pk', 'user_id', 'sr_id')
+            del_ids = [pk for pk, user_id, sr_id in rows
+                       if keep.get((user_id, sr_id), pk) != pk]
+            # The subscriptions themselves don't change, so there is no need
+            # to invalidate the search cache.
+            with bulk_subscription_changes():
+                Subscribed.objects.filter(pk__in=fav_ids, is_favorite=False) \
+                    .update(is_favorite=True)
+                Subscribed.objects.filter(pk__in=del_ids).delete()
+
+        if settings.DEBUG:
+            print('dedup_subscriptions() --> deleted {} rows'.format(
+                len(del_ids)))
+
+    return sorted({row[1] for row in doubles})
+
+
+def count_subscribers_here(sr_ids=None):
+    """
+    Set Sr.subscribers_here to the actual number of subscriptions of all
+    subreddits with an id in sr_ids, or of all subreddits if sr_ids is None,
+    with a single UPDATE query. Returns the number of subreddits updated.
     """
-    # Look up complete info on the users on that list.
-    li = User.objects.filter(
-        username__in=username_list).prefetch_related('profile', 'subs')
+    n = Subscribed.objects.filter(sr=OuterRef('pk')).order_by() \
+        .values('sr').annotate(n=Count('id')).values('n')
 
-    user_list = []
-    for x in username_list:
-        for y in li:
-            if y.username == x:
-                user_list.append(y)
-                break
+    qs = Sr.objects.all()
+    if sr_ids is not None:
+        qs = qs.filter(id__in=sr_ids)
+    return qs.update(subscribers_here=Coalesce(Subquery(n), Value(0)))
 
-    return user_list
+
+def get_user_navigation(buff, view_user, n=5):
+    """
+    From the search buffer, return the previous and next users relative to
+    view_user, and a list of "n" user objects after view_user, all fetched
+    with a single query by primary key. The list wraps around at the end of
+    the buffer.
+
+    If view_user is not part of the buffer, the list begins with the first
+    user of the buffer, and previous and next are the last and first users
+    of that list.
+
+    :buff: auth user's SearchBuffer.
+    """
+    idx = buff.index(view_user.id)
+    prev_id = next_id = None
+
+    if idx is None:  # view_user is not part of buffer, begin at index 0
+        ids = list(buff[:n])
+    elif (len(buff)-1) <= n:
+        # buff minus view_user is n? then use entire list minus view_user
+        ids = list(buff[:idx] + buff[idx+1:])
+    else:
+        ids = list(buff[idx+1:idx+1+n])  # get n users after view_user
+        if len(ids) < n:  # if end-of-list was reached, wrap around
+            ids += buff[0:n - len(ids)]
+
+    if idx is not None:
+        prev_id = buff[idx-1]
+        next_id = buff[(idx+1) % len(buff)]
+
+    users = User.objects.select_related('profile') \
+                        .in_bulk(ids + [prev_id, next_id])
+    user_list = [users[x] for x in ids if x in users]
+
+    prev_user = users.get(prev_id, None)
+    next_user = users.get(next_id, None)
+    if not prev_user and user_list:
+        prev_user = user_list[-1]
+    if not next_user and user_list:
+        next_user = user_list[0]
+
+    return prev_user, next_user, user_list
 
 
-def get_prevnext_user(request, view_user):
+def get_user_list_from_id_list(id_list):
+    """
+    Return a list of user objects with prefetched profiles and subs, from
+    a list of user ids, in the same order as the id_list. Ids of users that
+    don't exist anymore are skipped.
+    """
+    users = User.objects.prefetch_related('profile', 'subs') \
+                        .in_bulk(list(id_list))
+    return [users[x] for x in id_list if x in users]
+
+
+def get_prevnext_user(buff, view_user):
     """
     Return previous and next users, relative to view user, from the
-    search results list of users.
+    search results list of users. At the end of the list, start over with
+    the first user, and at the beginning, with the last user.
+
+    :buff: auth user's SearchBuffer.
     """
-    username_list = request.session['search_results_buffer']
-    try:
-        idx = [username_list.index(row) for row in username_list
-               if view_user.username == row][0]
-    except IndexError:
+    idx = buff.index(view_user.id)
+    if idx is None:
         return None, None
-    try:
-        # Try one user to the right.
-        next_user = username_list[idx+1]
-    except IndexError:
-        # End of list? Then start over with the first user, NOT of the
-        # user list subset, but of the search result user list in the
-        # session cache.
-        next_user = username_list[0]
-    except UnboundLocalError:
-        # View user wasn't on the list (no idx)? Return first user.
-        next_user = username_list[0]
-    try:
-        # Try one user to the left.
-        prev_user = username_list[idx-1]
-    except IndexError:
-        # Beginning of list? Start over with the last user.
-        prev_user = username_list[-1]
-    except UnboundLocalError:
-        # View user wasn't on the list (no idx)? Return first user.
-        prev_user = view_user
-    # Return the user objects of both.
-    return (User.objects.get(username__iexact=prev_user),
-            User.objects.get(username__iexact=next_user))
+
+    prev_id = buff[idx-1]
+    next_id = buff[(idx+1) % len(buff)]
+    users = User.objects.in_bulk([prev_id, next_id])
+    return users.get(prev_id), users.get(next_id)
 
 
 def add_auth_user_latlng(user, user_list):
@@ -210,84 +326,101 @@ def count_matches(user):
     """
     Return the number of matches (mututal likes) of User :user:.
     """
-    return get_matches_user_queryset(user).distinct().count()
+    return Match.objects.filter(user=user).count()
 
 
 def get_matches_user_queryset(user):
     """
     Return a queryset that finds all matches for user.
     """
-    return User.objects.filter(
-        flags_sent__receiver=user, flags_sent__flag=Flag.LIKE_FLAG,
-        flags_received__sender=user, flags_received__flag=Flag.LIKE_FLAG)
+    return User.objects.filter(matches__match_user=user)
 
 
 def get_matches_user_list(user):
     """
-    Return a user_list with all mutual likes for 'user'.
+    Return a user_list with all mutual likes for 'user', latest first.
     """
-    user_list = list(get_matches_user_queryset(user))
-    for x in user_list:
-        # set the datetime they matched
-        c1 = x.flags_sent.get(receiver=user.pk).created
-        c2 = user.flags_sent.get(receiver=x.pk).created
-        setattr(x, 'matched', c1 if c1 > c2 else c2)
+    user_list = []
+    for match in Match.objects.filter(user=user).order_by('-created') \
+            .select_related('match_user', 'match_user__profile'):
+        x = match.match_user
+        setattr(x, 'matched', match.created)  # the datetime they matched
         setattr(x, 'flag_created', x.matched)  # need for serializer
-    user_list.sort(key=lambda row: row.matched, reverse=True)
+        user_list.append(x)
     return user_list
 
 
-def add_likes_sent(user_list, user):
+def rebuild_matches(batch_size=1000):
     """
-    Look at it from the perspective of :user: and add a "is_like_sent"
-    attribut to all User objects in the user_list list who
-    received a "like" from :user:.
+    Rebuild the Match table from all mutual like Flags. Return the number of
+    matches found, each one stored once for both users.
 
-    :user_list: a list of User objects.
-    :user: a single User object.
+    The Match rows of batch_size user ids are replaced in one short
+    transaction each, so that this can run while the site is online and
+    Flag.set_flag() adds matches concurrently.
     """
-    if user.is_authenticated:
-        li = User.objects.filter(username__in=[x.username for x in user_list],
-                                 flags_received__sender=user,
-                                 flags_received__flag=Flag.LIKE_FLAG
-                                 ).values_list('username', flat=True)
-        for x in user_list:
-            setattr(x, 'is_like_sent', x.username in li)
-
-    return user_list
-
-
-def add_likes_recv(user_list, user):
+    # Every mutual like is found twice, once from each side, which gives
+    # exactly the two Match rows it needs.
+    pairs = Flag.objects.filter(
+        flag=Flag.LIKE_FLAG,
+        receiver__flags_sent__receiver=F('sender'),
+        receiver__flags_sent__flag=Flag.LIKE_FLAG,
+    ).values_list('sender_id', 'receiver_id', 'created',
+                  'receiver__flags_sent__created')
+
+    count = 0
+    last_id = User.objects.aggregate(Max('id'))['id__max'] or 0
+    for first_id in range(0, last_id + 1, batch_size):
+        last = first_id + batch_size
+        with transaction.atomic():
+            Match.objects.filter(user_id__gte=first_id,
+                                 user_id__lt=last).delete()
+            batch = [Match(user_id=sender_id, match_user_id=receiver_id,
+                           created=max(created1, created2))
+                     for sender_id, receiver_id, created1, created2 in
+                     pairs.filter(sender_id__gte=first_id,
+                                  sender_id__lt=last)]
+            # A concurrent set_match() may have added some of them already.
+            Match.objects.bulk_create(batch, ignore_conflicts=True)
+        count += len(batch)
+
+    return count // 2
+
+
+def add_relationship_flags(user_list, user):
     """
-    Look at it from the perspective of :user: and add a "is_like_recv"
-    attribut to all User objects in the user_list list who
-    sent a "like" to :user:.
+    Look at it from the perspective of :user: and add the attributes
+    "is_like_sent", "is_like_recv", "is_match" and "is_nope" to all User
+    objects in the user_list list. All Flag rows between :user: and the
+    users on the list are fetched with one query.
 
     :user_list: a list of User objects.
     :user: a single User object.
     """
-    if user.is_authenticated:
-        li = User.objects.filter(username__in=[x.username for x in user_list],
-                                 flags_sent__receiver=user,
-                                 flags_sent__flag=Flag.LIKE_FLAG
-                                 ).values_list('username', flat=True)
-        for x in user_list:
-            setattr(x, 'is_like_recv', x.username in li)
+    if not user.is_authenticated:
+        return user_list
+
+    ids = [x.id for x in user_list]
+    flags = Flag.objects.filter(
+        Q(sender=user, receiver_id__in=ids) |
+        Q(receiver=user, sender_id__in=ids)
+    ).values_list('sender_id', 'receiver_id', 'flag')
+
+    likes_sent, likes_recv, nopes = set(), set(), set()
+    for sender_id, receiver_id, flag in flags:
+        if sender_id == user.id:
+            if flag == Flag.LIKE_FLAG:
+                likes_sent.add(receiver_id)
+            elif flag == Flag.NOPE_FLAG:
+                nopes.add(receiver_id)
+        elif flag == Flag.LIKE_FLAG:
+            likes_recv.add(sender_id)
 
-    return user_list
-
-
-def add_matches_to_user_list(user_list, user):
-    """
-    Add a "is_match" attribut to all User objects in the user_list list
-    who are a match (mutual like) with user and return the user_list.
-    """
-    if user.is_authenticated:
-        li = [x.username for x in user_list]
-        qs = get_matches_user_queryset(user).filter(username__in=li)
-        li = [x.username for x in qs]
-        for x in user_list:
-            setattr(x, 'is_match', x.username in li)
+    for x in user_list:
+        setattr(x, 'is_like_sent', x.id in likes_sent)
+        setattr(x, 'is_like_recv', x.id in likes_recv)
+        setattr(x, 'is_match', x.is_like_sent and x.is_like_recv)
+        setattr(x, 'is_nope', x.id in nopes)
 
     return user_list
 
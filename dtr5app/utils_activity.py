@@ -0,0 +1,119 @@
+"""
+Write-behind tracking of users' last activity, see Profile.accessed.
+
+Every request of an auth user only sets their score in a sorted set
+"user id -> unix time" in the Redis server of the default cache. Once every
+ACTIVITY_FLUSH_INTERVAL seconds, one request writes all users active since
+the last flush to Profile.accessed, with a single bulk UPDATE per batch. So
+there is at most one database write per user and interval.
+
+The sorted set keeps the past ACTIVITY_LIVE_WINDOW seconds of activity, and
+get_active_users() counts short time windows directly from it.
+
+With a cache backend that is not django_redis, e.g. in development, every
+request writes Profile.accessed directly, and there is no live activity.
+"""
+from datetime import datetime
+from time import time as unixtime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from pytz import utc
+
+from dtr5app.models import Profile
+
+ACTIVITY_KEY = 'activity:users'
+FLUSHED_KEY = 'activity:flushed'
+FLUSH_LOCK_KEY = 'activity:flush_lock'
+
+
+def get_activity_connection():
+    """
+    Return the Redis client of the default cache, or None if the default
+    cache is not a django_redis cache.
+    """
+    try:
+        # Imported here, so that other cache backends work without
+        # django_redis.
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def track_user_activity(user_id):
+    """
+    Remember that user_id is active now, and write all recent activity to
+    the database, if the last flush is ACTIVITY_FLUSH_INTERVAL seconds ago.
+    """
+    conn = get_activity_connection()
+    if conn is None:
+        Profile.objects.filter(user_id=user_id).update(accessed=now())
+        return
+
+    ts = unixtime()
+    conn.zadd(ACTIVITY_KEY, {user_id: ts})
+
+    interval = getattr(settings, 'ACTIVITY_FLUSH_INTERVAL', 60)
+    if cache.add(FLUSH_LOCK_KEY, ts, interval):
+        flush_user_activity(ts)
+
+
+def flush_user_activity(until=None, batch_size=1000):
+    """
+    Write the last activity of all users active since the last flush and
+    up to "until" to Profile.accessed. Return the number of users written.
+    """
+    conn = get_activity_connection()
+    if conn is None:
+        return 0
+    until = until or unixtime()
+    since = cache.get(FLUSHED_KEY, 0)
+
+    # Read one flush interval from before the last flush again, for the
+    # activity of requests that took their time before, but were added to
+    # the sorted set after the last flush read it. Writing a user's last
+    # activity twice does no harm.
+    interval = getattr(settings, 'ACTIVITY_FLUSH_INTERVAL', 60)
+    rows = conn.zrangebyscore(ACTIVITY_KEY, max(since - interval, 0), until,
+                              withscores=True)
+    profiles = [Profile(user_id=int(user_id),
+                        accessed=datetime.fromtimestamp(ts, tz=utc))
+                for user_id, ts in rows]
+    Profile.objects.bulk_update(profiles, ['accessed'], batch_size=batch_size)
+    cache.set(FLUSHED_KEY, until, None)
+
+    window = getattr(settings, 'ACTIVITY_LIVE_WINDOW', 15 * 60)
+    conn.zremrangebyscore(ACTIVITY_KEY, '-inf', until - window)
+
+    if settings.DEBUG:
+        print('flush_user_activity() --> {} users'.format(len(profiles)))
+    return len(profiles)
+
+
+def count_active_users(seconds):
+    """
+    Return the number of users active over the past "seconds", or None if
+    that is longer than the ACTIVITY_LIVE_WINDOW kept in the sorted set.
+    """
+    if seconds > getattr(settings, 'ACTIVITY_LIVE_WINDOW', 15 * 60):
+        return None
+    conn = get_activity_connection()
+    if conn is None:
+        return None
+    return conn.zcount(ACTIVITY_KEY, unixtime() - seconds, '+inf')
+
+
+def get_active_user_ids(seconds):
+    """
+    Return the ids of the users active over the past "seconds", or None if
+    that is longer than the ACTIVITY_LIVE_WINDOW kept in the sorted set.
+    """
+    if seconds > getattr(settings, 'ACTIVITY_LIVE_WINDOW', 15 * 60):
+        return None
+    conn = get_activity_connection()
+    if conn is None:
+        return None
+    return [int(x) for x in
+            conn.zrangebyscore(ACTIVITY_KEY, unixtime() - seconds, '+inf')]
@@ -0,0 +1,165 @@
+"""
+Time the hot code paths of the site against the current database, usually
+filled with synthetic users, see utils_synthetic. The results are a dict
+that is written as JSON by the "run_benchmark" command, so that runs at
+different sizes, or before and after a change, can be compared.
+
+Views are requested through the Django test client, with all middleware,
+logged in as a sample of synthetic users.
+"""
+import statistics
+from time import perf_counter
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+
+from dtr5app.models import Conversation, Flag, Message, Subscribed, Visit
+from dtr5app.serializers import (BasicUserSerializer, MessageSerializer,
+                                 basic_user_list_data)
+from dtr5app.utils_search import search_users
+from dtr5app.utils_synthetic import SYNTHETIC_PREFIX
+
+BENCHMARKS = ('search_users', 'results_list', 'user_detail', 'matches_api',
+              'flag_api', 'chats_init', 'chat_init')
+SERIALIZER_SIZES = (20, 500, 5000)
+
+
+def get_timings(times):
+    """Return a dict with the statistics of a list of times in seconds."""
+    ms = sorted(x * 1000 for x in times)
+    return {
+        'calls': len(ms),
+        'min_ms': round(ms[0], 3),
+        'median_ms': round(statistics.median(ms), 3),
+        'mean_ms': round(statistics.mean(ms), 3),
+        'p95_ms': round(ms[min(int(len(ms) * 0.95), len(ms) - 1)], 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def get_sample_users(n, seed=0):
+    """
+    Return up to n pairs of synthetic users (user, other_user), picked
+    evenly from all synthetic users.
+    """
+    qs = User.objects.filter(username__startswith=SYNTHETIC_PREFIX)
+    ids = list(qs.order_by('id').values_list('id', flat=True))
+    step = max(len(ids) // (n + 1), 1)
+    picked = ids[seed % step::step][:n + 1]
+    users = User.objects.in_bulk(picked)
+    return [(users[a], users[b]) for a, b in zip(picked, picked[1:])]
+
+
+def get_population():
+    """Return the row counts of the tables the benchmarks depend on."""
+    return {
+        'users': User.objects.count(),
+        'synthetic_users': User.objects.filter(
+            username__startswith=SYNTHETIC_PREFIX).count(),
+        'subscribed': Subscribed.objects.count(),
+        'flags': Flag.objects.count(),
+        'visits': Visit.objects.count(),
+        'conversations': Conversation.objects.count(),
+        'messages': Message.objects.count(),
+    }
+
+
+def run_benchmark(users=20, repeat=3, names=BENCHMARKS, seed=0):
+    """
+    Run every benchmark in names "repeat" times for each of "users" sample
+    users, and return a dict with the population and the timings.
+    """
+    pairs = get_sample_users(users, seed)
+    if not pairs:
+        raise ValueError('No synthetic users, run make_synthetic_data first.')
+
+    # Any host name that passes ALLOWED_HOSTS, wildcards allow "localhost".
+    host = next((x for x in settings.ALLOWED_HOSTS if x[:1] not in '*.'),
+                'localhost')
+    client = Client(HTTP_HOST=host)
+    times = {x: [] for x in names}
+    errors = {x: 0 for x in names}
+
+    def timed(name, fn):
+        t0 = perf_counter()
+        response = fn()
+        times[name].append(perf_counter() - t0)
+        # Redirects are a failed login, they don't time the view.
+        if getattr(response, 'status_code', 200) >= 300:
+            errors[name] += 1
+
+    # Searches run in the request, so that results_list times the search,
+    # not only queueing a search job for the worker.
+    with override_settings(SEARCH_ASYNC=False):
+        for user, other in pairs:
+            client.force_login(user)
+            for _ in range(repeat):
+                if 'search_users' in times:
+                    request = SimpleNamespace(user=user, session={})
+                    timed('search_users', lambda: search_users(request))
+                if 'results_list' in times:
+                    timed('results_list', lambda: client.get(
+                        reverse('results_list_api'), {'page': 1}))
+                if 'user_detail' in times:
+                    timed('user_detail', lambda: client.get(
+                        reverse('api_user_detail', args=[other.username])))
+                if 'matches_api' in times:
+                    timed('matches_api', lambda: client.get(
+                        reverse('matches_api')))
+                if 'flag_api' in times:
+                    url = reverse('flag_api', args=['like', other.username])
+                    timed('flag_api', lambda: client.post(url))
+                    timed('flag_api', lambda: client.delete(url))
+                run_chat_benchmarks(timed, times, user, other)
+            client.logout()
+
+    return {
+        'created': now().isoformat(),
+        'database': connection.vendor,
+        'search_backend': getattr(settings, 'SEARCH_BACKEND', 'sql'),
+        'population': get_population(),
+        'sample_users': len(pairs),
+        'repeat': repeat,
+        'results': {k: dict(get_timings(v), errors=errors[k])
+                    for k, v in times.items() if v},
+    }
+
+
+def run_chat_benchmarks(timed, times, user, other):
+    """Time the database work of the chat consumers' init actions."""
+    if 'chats_init' in times:
+        timed('chats_init', lambda: Conversation.get_chat_list(user, 50))
+    if 'chat_init' in times:
+        timed('chat_init', lambda: MessageSerializer(
+            Message.get_messages_list(None, user, other), many=True).data)
+
+
+def run_serializer_benchmark(sizes=SERIALIZER_SIZES, repeat=5):
+    """
+    Time user lists of each size in sizes, serialized by BasicUserSerializer
+    from User objects ("drf"), and by basic_user_list_data() ("values"), both
+    including their database query.
+    """
+    qs = User.objects.filter(username__startswith=SYNTHETIC_PREFIX) \
+                     .order_by('id')
+    results = {}
+    for size in sizes:
+        drf, values = [], []
+        for _ in range(repeat):
+            t0 = perf_counter()
+            BasicUserSerializer(list(qs.select_related('profile')[:size]),
+                                many=True).data
+            drf.append(perf_counter() - t0)
+
+            t0 = perf_counter()
+            basic_user_list_data(qs[:size])
+            values.append(perf_counter() - t0)
+
+        results[size] = {'drf': get_timings(drf),
+                         'values': get_timings(values)}
+    return results
@@ -0,0 +1,115 @@
+"""
+Profile counters, like views_count and new_likes_count, that are increased
+by other users' actions.
+
+Increments are applied as F() expression updates, so that concurrent
+requests never overwrite each other's counts, and only the counter columns
+are written. With settings.PROFILE_COUNTERS_BUFFERED, increments are first
+added up in a hash per profile in the Redis server of the default cache, and
+written to the database in batches by the "flush_profile_counters" command.
+Popular profiles then get one UPDATE per flush, instead of one per view.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from dtr5app.models import Profile
+
+COUNTER_FIELDS = ('views_count', 'matches_count', 'new_matches_count',
+                  'new_likes_count', 'new_views_count')
+COUNTERS_KEY = 'profile_counters:{}'
+DIRTY_KEY = 'profile_counters:dirty'
+
+
+def get_counters_connection():
+    # Imported here, so that other cache backends work without django_redis.
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def update_profile_counters(user_ids, **deltas):
+    """
+    Add the deltas to the counter fields of the profiles of all user_ids,
+    with a single UPDATE query.
+    """
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas or not user_ids:
+        return 0
+
+    # Decrements stop at 0, the counters are positive fields.
+    qs = Profile.objects.filter(user_id__in=user_ids)
+    for k, v in deltas.items():
+        if v < 0:
+            qs = qs.filter(**{k + '__gte': -v})
+
+    return qs.update(**{k: F(k) + v for k, v in deltas.items()})
+
+
+def incr_profile_counters(user_id, **deltas):
+    """
+    Increase the counters of user_id's profile, e.g.
+
+        incr_profile_counters(view_user.id, views_count=1, new_views_count=1)
+
+    With PROFILE_COUNTERS_BUFFERED, the increments are only buffered and
+    become visible after the next flush_profile_counters().
+    """
+    for k in deltas:
+        if k not in COUNTER_FIELDS:
+            raise ValueError('Not a profile counter: {}'.format(k))
+
+    if not getattr(settings, 'PROFILE_COUNTERS_BUFFERED', False):
+        return update_profile_counters([user_id], **deltas)
+
+    pipe = get_counters_connection().pipeline()
+    for k, v in deltas.items():
+        if v:
+            pipe.hincrby(COUNTERS_KEY.format(user_id), k, v)
+    pipe.sadd(DIRTY_KEY, user_id)
+    pipe.execute()
+
+
+def pop_buffered_counters(batch_size):
+    """
+    Remove up to batch_size profiles from the buffer and return a dict
+    {user_id: {field: delta}} of their buffered increments.
+    """
+    conn = get_counters_connection()
+    user_ids = [int(x) for x in conn.spop(DIRTY_KEY, batch_size) or []]
+    if not user_ids:
+        return {}
+
+    # Read and delete in one transaction, so that no increment is lost.
+    pipe = conn.pipeline(transaction=True)
+    for user_id in user_ids:
+        pipe.hgetall(COUNTERS_KEY.format(user_id))
+        pipe.delete(COUNTERS_KEY.format(user_id))
+    values = pipe.execute()[::2]
+
+    return {user_id: {k.decode(): int(v) for k, v in data.items()}
+            for user_id, data in zip(user_ids, values) if data}
+
+
+def flush_profile_counters(batch_size=1000):
+    """
+    Write all buffered counter increments to the database. Profiles with
+    the same increments are updated with one query. Return the number of
+    profiles updated.
+    """
+    count = 0
+    while True:
+        buffered = pop_buffered_counters(batch_size)
+
+        groups = defaultdict(list)
+        for user_id, deltas in buffered.items():
+            groups[tuple(sorted(deltas.items()))].append(user_id)
+
+        with transaction.atomic():
+            for deltas, user_ids in groups.items():
+                count += update_profile_counters(user_ids, **dict(deltas))
+
+        # Increments added meanwhile are left for the next flush.
+        if len(buffered) < batch_size:
+            return count
@@ -0,0 +1,122 @@
+"""
+Distance search over the Profile.geo_cell grid index.
+
+A distance search first selects the candidates in the grid cells that cover
+the search area, which are a few index range scans on Profile.geo_cell, see
+toolbox.get_geo_cell_ranges(), further narrowed down to the lat/lng box
+around the search area. Then the exact great circle distance of all
+candidates is calculated at once with numpy, and those too far away are
+dropped.
+"""
+import numpy as np
+from django.db.models import Q
+
+from toolbox import EARTH_RADIUS_KM, get_geo_cell_ranges, get_latlng_box
+
+
+def is_distance_search(params):
+    """
+    Return True if the search params filter on distance. Values too close
+    are inaccurate because of location fuzzying, so only distances above
+    5 km are searched, and anything below is "worldwide".
+    """
+    return params.get('distance', 0) > 5 and 'lat' in params \
+        and 'lng' in params
+
+
+def get_distances(lat, lng, lats, lngs):
+    """
+    Return an array with the distance in km between lat/lng and each of the
+    locations in the lats/lngs arrays (haversine formula).
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lats - lat) / 2) ** 2 + \
+        np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def get_search_distances(params, lats, lngs):
+    """
+    Return an array with the distance in km between the search location in
+    params and each of the locations in lats/lngs, or all zeros if params
+    have no location.
+    """
+    if 'lat' not in params or 'lng' not in params:
+        return np.zeros(len(lats), dtype=np.float64)
+    return get_distances(params['lat'], params['lng'], lats, lngs)
+
+
+def get_distance_mask(params, lats, lngs):
+    """
+    Return a boolean array that is True for every location in lats/lngs
+    within the search distance in params.
+    """
+    return get_distances(params['lat'], params['lng'], lats, lngs) <= \
+        params['distance']
+
+
+def get_geo_cell_q(params, prefix='profile__'):
+    """
+    Return a Q object that finds all profiles in the grid cells around the
+    search location in params, or an empty Q() if that's the whole world.
+    """
+    ranges = get_geo_cell_ranges(params['lat'], params['lng'],
+                                 params['distance'])
+    q = Q()
+    for first, last in ranges or []:
+        q |= Q(**{prefix + 'geo_cell__range': (first, last)})
+    return q
+
+
+def get_geo_cell_sql(params, column='p.geo_cell'):
+    """
+    Same as get_geo_cell_q(), but return an SQL condition and its list of
+    query params, for raw SQL queries.
+    """
+    ranges = get_geo_cell_ranges(params['lat'], params['lng'],
+                                 params['distance'])
+    if not ranges:
+        return '', []
+
+    sql = ' OR '.join(['{} BETWEEN %s AND %s'.format(column)] * len(ranges))
+    return ' AND ({}) '.format(sql), [x for r in ranges for x in r]
+
+
+def get_latlng_box_q(params, prefix='profile__'):
+    """
+    Return a Q object that finds all profiles in the lat/lng box around the
+    search location in params, see toolbox.get_latlng_box(). A box across
+    the antimeridian continues on the other side.
+    """
+    lat_min, lng_min, lat_max, lng_max = get_latlng_box(
+        params['lat'], params['lng'], params['distance'])
+    q = Q(**{prefix + 'lat__gte': lat_min, prefix + 'lat__lte': lat_max})
+    if lng_min < -180:
+        return q & (Q(**{prefix + 'lng__gte': lng_min + 360}) |
+                    Q(**{prefix + 'lng__lte': lng_max}))
+    if lng_max > 180:
+        return q & (Q(**{prefix + 'lng__gte': lng_min}) |
+                    Q(**{prefix + 'lng__lte': lng_max - 360}))
+    return q & Q(**{prefix + 'lng__gte': lng_min,
+                    prefix + 'lng__lte': lng_max})
+
+
+def get_latlng_box_sql(params, table='p'):
+    """
+    Same as get_latlng_box_q(), but return an SQL condition and its list of
+    query params, for raw SQL queries.
+    """
+    lat_min, lng_min, lat_max, lng_max = get_latlng_box(
+        params['lat'], params['lng'], params['distance'])
+    sql = ' AND {0}.lat >= %s AND {0}.lat <= %s '
+    if lng_min < -180:
+        sql += 'AND ({0}.lng >= %s OR {0}.lng <= %s) '
+        lng_min += 360
+    elif lng_max > 180:
+        sql += 'AND ({0}.lng >= %s OR {0}.lng <= %s) '
+        lng_max -= 360
+    else:
+        sql += 'AND {0}.lng >= %s AND {0}.lng <= %s '
+    return sql.format(table), [lat_min, lat_max, lng_min, lng_max]
@@ -0,0 +1,111 @@
+"""
+User map tiles: the active users within one map tile, aggregated into a
+grid of clusters, or as single points once zoomed in far enough.
+
+Tiles use the usual "slippy map" z/x/y numbering of the map tile servers,
+and the users are read from the in-memory match index of this process, see
+utils_match_engine, so a tile needs no database query. Every tile is cached
+for MAP_TILE_TIMEOUT seconds per zoom, tile and activity time window.
+
+The last activity in the match index is as old as the index, so activity
+time windows up to ACTIVITY_LIVE_WINDOW are read from the live activity of
+utils_activity instead, and without it, windows shorter than the age of the
+index are widened to the next longer window.
+"""
+import math
+from time import time as unixtime
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from dtr5app.utils_activity import get_active_user_ids
+from dtr5app.utils_match_engine import get_match_index
+
+TILE_KEY = 'map_tile:{}:{}:{}:{}'
+# Activity time windows in minutes, as offered on the map page, 0 == all.
+T_WINDOWS = (0, 5, 60, 1440, 10080, 525600)
+CLUSTER_GRID = 8  # clusters per tile, in each direction
+MAX_ZOOM = 18
+
+
+def get_tile_bounds(z, x, y):
+    """Return west, south, east, north of map tile z/x/y."""
+    n = 2 ** z
+
+    def lat(tile_y):
+        mercator_y = math.pi * (1 - 2 * tile_y / n)
+        return math.degrees(math.atan(math.sinh(mercator_y)))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def get_mercator_y(lats):
+    """Return the web mercator y of each of lats, 0.0 at the top of the map."""
+    lats = np.radians(np.clip(lats, -85.0511, 85.0511))
+    return (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / np.pi) / 2
+
+
+def normalize_t_window(t):
+    """Return the largest T_WINDOWS time window not longer than t."""
+    return max([x for x in T_WINDOWS if x <= t] or [0])
+
+
+def build_map_tile(z, x, y, t=0):
+    """
+    Return a dict with the "clusters" as [lat, lng, count] lists, and the
+    "users" as [username, lat, lng] lists, of all users located in map tile
+    z/x/y, who were active within the past t minutes. The time window "t"
+    that was actually used is returned too, see above.
+    """
+    idx = get_match_index()
+    west, south, east, north = get_tile_bounds(z, x, y)
+
+    mask = (idx.lat >= south) & (idx.lat < north) & \
+           (idx.lng >= west) & (idx.lng < east)
+    # Users who never set their location are at about 0/0.
+    mask &= ~((idx.lat >= -0.1) & (idx.lat <= 1.1) &
+              (idx.lng >= -0.1) & (idx.lng <= 1.1))
+    if t > 0:
+        active_ids = get_active_user_ids(t * 60)
+        if active_ids is not None:
+            mask &= np.isin(idx.ids, active_ids)
+        else:
+            age = unixtime() - idx.built
+            t = min(x for x in T_WINDOWS if x >= t and x * 60 >= age)
+            mask &= idx.accessed >= unixtime() - t * 60
+    rows = np.flatnonzero(mask)
+
+    max_points = getattr(settings, 'MAP_POINTS_MAX', 250)
+    if z >= getattr(settings, 'MAP_POINTS_ZOOM', 10) and \
+            len(rows) <= max_points:
+        return {'t': t, 'clusters': [], 'users': [
+            [idx.usernames[row], idx.lat[row], idx.lng[row]] for row in rows]}
+
+    # Sort the users into a grid of cells over the tile, and return one
+    # cluster per cell, at the average location of its users.
+    n = 2 ** z
+    lats, lngs = idx.lat[rows], idx.lng[rows]
+    cx = ((lngs + 180) / 360 * n - x) * CLUSTER_GRID
+    cy = (get_mercator_y(lats) * n - y) * CLUSTER_GRID
+    cells = np.clip(cy.astype(np.int64), 0, CLUSTER_GRID - 1) * CLUSTER_GRID \
+        + np.clip(cx.astype(np.int64), 0, CLUSTER_GRID - 1)
+
+    size = CLUSTER_GRID ** 2
+    counts = np.bincount(cells, minlength=size)
+    sum_lat = np.bincount(cells, weights=lats, minlength=size)
+    sum_lng = np.bincount(cells, weights=lngs, minlength=size)
+    return {'t': t, 'users': [], 'clusters': [
+        [round(sum_lat[i] / counts[i], 4), round(sum_lng[i] / counts[i], 4),
+         int(counts[i])] for i in np.flatnonzero(counts)]}
+
+
+def get_map_tile(z, x, y, t=0):
+    """Same as build_map_tile(), but cached."""
+    t = normalize_t_window(t)
+    key = TILE_KEY.format(z, x, y, t)
+    tile = cache.get(key)
+    if tile is None:
+        tile = build_map_tile(z, x, y, t)
+        cache.set(key, tile, getattr(settings, 'MAP_TILE_TIMEOUT', 60))
+    return tile
@@ -0,0 +1,336 @@
+"""
+In-memory subreddit co-membership index, used by search_users() in place of
+the raw SQL self-join over the dtr5app_subscribed table.
+
+The index keeps one sorted array of user rows per subreddit (an inverted
+index sr_id -> users) and one column array per Profile value the search
+filters on. A search adds up the member arrays of auth user's favorite
+subreddits into a sparse count vector and then applies the search options
+as vectorized masks over the column arrays. No intermediate join rows are
+produced, so large default subs don't blow up the work per search.
+
+Every process holds its own copy of the index. Once it is older than
+settings.MATCH_INDEX_TIMEOUT minutes, it is rebuilt in a background thread
+while searches keep using the old copy.
+"""
+import threading
+from time import time as unixtime
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from dtr5app.models import Sr, Subscribed
+from dtr5app.utils_geo import (get_distance_mask, get_search_distances,
+                               is_distance_search)
+from toolbox import get_dob_range
+
+# Map the "search_results_order" session value to a column of the index,
+# and whether to sort that column descending. Default is "-sr_count".
+ORDER_COLUMNS = {
+    '-sr_count': ('sr_count', True),
+    '-sr_weight': ('sr_weight', True),
+    '-accessed': ('accessed', True),
+    'accessed': ('accessed', False),
+    '-date_joined': ('date_joined', True),
+    'date_joined': ('date_joined', False),
+    '-views_count': ('views_count', True),
+    'views_count': ('views_count', False),
+    'distance': ('distance', False),  # from the search location
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _timestamp(dt):
+    return dt.timestamp() if dt else 0.0
+
+
+def get_rank(order_by, values):
+    """
+    Return the rank of one search result for "order_by", the same way as
+    MatchIndex.search_ranked() does: higher ranks come first.
+
+    :values: dict with the user's values of the ORDER_COLUMNS columns.
+    """
+    column, reverse = ORDER_COLUMNS.get(order_by, ('sr_count', True))
+    value = values.get(column, None)
+    if hasattr(value, 'timestamp'):
+        value = _timestamp(value)
+    value = float(value or 0)
+    return value if reverse else -value
+
+
+def get_score(order_by, values):
+    """
+    Return the score of one search result, the value that the "limit"
+    results of a search are selected by: the sum of weights of the
+    subreddits in common for "-sr_weight", their number for any other order.
+
+    :values: dict with the user's "sr_count" and "sr_weight".
+    """
+    column = 'sr_weight' if order_by == '-sr_weight' else 'sr_count'
+    return float(values.get(column, None) or 0)
+
+
+class MatchIndex:
+    """
+    Immutable snapshot of all searchable users and their subscriptions.
+
+    Users are stored as "rows", ordered by User.id, so that the row of any
+    user id can be found with a binary search over self.ids.
+    """
+
+    def __init__(self):
+        self.built = unixtime()
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.usernames = []
+        self.sex = np.zeros(0, dtype=np.int16)
+        self.dob = np.zeros(0, dtype=np.int32)  # date.toordinal(), 0 == none
+        self.lat = np.zeros(0, dtype=np.float64)
+        self.lng = np.zeros(0, dtype=np.float64)
+        self.has_verified_email = np.zeros(0, dtype=bool)
+        self.has_pic = np.zeros(0, dtype=bool)
+        self.accessed = np.zeros(0, dtype=np.float64)
+        self.date_joined = np.zeros(0, dtype=np.float64)
+        self.views_count = np.zeros(0, dtype=np.int32)
+        # Inverted index: rows of members of the subreddit with position i
+        # are members[offsets[i]:offsets[i+1]].
+        self.sr_pos = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.members = np.zeros(0, dtype=np.int32)
+        self.sr_weight = np.zeros(0, dtype=np.float64)  # see Sr.weight
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls):
+        """Load all searchable users and subscriptions from the database."""
+        idx = cls()
+
+        # Same basic filters as the raw SQL search: only active users who
+        # didn't delete their account.
+        rows = list(
+            User.objects.filter(is_active=True, last_login__isnull=False)
+            .order_by('id')
+            .values_list('id', 'username', 'date_joined', 'profile__sex',
+                         'profile__dob', 'profile__lat', 'profile__lng',
+                         'profile__has_verified_email', 'profile__pic_count',
+                         'profile__accessed', 'profile__views_count')
+            .iterator(chunk_size=10000))
+        n = len(rows)
+
+        idx.ids = np.fromiter((r[0] for r in rows), np.int64, n)
+        idx.usernames = [r[1] for r in rows]
+        idx.date_joined = np.fromiter(
+            (_timestamp(r[2]) for r in rows), np.float64, n)
+        idx.sex = np.fromiter((r[3] or 0 for r in rows), np.int16, n)
+        idx.dob = np.fromiter(
+            (r[4].toordinal() if r[4] else 0 for r in rows), np.int32, n)
+        idx.lat = np.fromiter((r[5] or 0.0 for r in rows), np.float64, n)
+        idx.lng = np.fromiter((r[6] or 0.0 for r in rows), np.float64, n)
+        idx.has_verified_email = np.fromiter(
+            (bool(r[7]) for r in rows), bool, n)
+        idx.has_pic = np.fromiter((bool(r[8]) for r in rows), bool, n)
+        idx.accessed = np.fromiter(
+            (_timestamp(r[9]) for r in rows), np.float64, n)
+        idx.views_count = np.fromiter(
+            (r[10] or 0 for r in rows), np.int32, n)
+        del rows
+
+        if n == 0:
+            return idx
+
+        # Fetch all subscriptions and turn them into the inverted index.
+        subs = Subscribed.objects.values_list('sr_id', 'user_id')
+        sr_list, user_list = [], []
+        for sr_id, user_id in subs.iterator(chunk_size=50000):
+            sr_list.append(sr_id)
+            user_list.append(user_id)
+
+        sr_codes = np.fromiter(
+            (idx.sr_pos.setdefault(x, len(idx.sr_pos)) for x in sr_list),
+            np.int64, len(sr_list))
+        user_ids = np.fromiter(user_list, np.int64, len(user_list))
+        del sr_list, user_list
+
+        # Drop subscriptions of users who are not searchable.
+        user_rows = np.searchsorted(idx.ids, user_ids)
+        user_rows[user_rows == n] = 0
+        valid = idx.ids[user_rows] == user_ids
+
+        # Sorting the combined key orders the memberships by subreddit, then
+        # by user row, and removes any double subscriptions on the way.
+        keys = np.unique(sr_codes[valid] * n + user_rows[valid])
+        idx.members = (keys % n).astype(np.int32)
+        idx.offsets = np.searchsorted(
+            keys // n, np.arange(len(idx.sr_pos) + 1)).astype(np.int64)
+
+        idx.sr_weight = np.zeros(len(idx.sr_pos), dtype=np.float64)
+        for sr_id, weight in Sr.objects.values_list('id', 'weight'):
+            if sr_id in idx.sr_pos:
+                idx.sr_weight[idx.sr_pos[sr_id]] = weight
+
+        return idx
+
+    def get_sr_count(self, sr_ids, weighted=False, min_weight=0.0):
+        """
+        Return a vector with the number of the given subreddits each user row
+        is subscribed to, or the sum of the subreddits' weights, if
+        "weighted" is True. Subreddits with a weight below "min_weight" are
+        ignored.
+        """
+        positions = [self.sr_pos[x] for x in sr_ids if x in self.sr_pos]
+        positions = [i for i in positions if self.sr_weight[i] >= min_weight]
+        slices = [self.members[self.offsets[i]:self.offsets[i+1]]
+                  for i in positions]
+
+        if not slices:
+            return np.zeros(len(self), dtype=np.int64)
+
+        weights = None
+        if weighted:
+            weights = np.repeat(self.sr_weight[positions],
+                                [len(x) for x in slices])
+
+        return np.bincount(np.concatenate(slices), weights=weights,
+                           minlength=len(self))
+
+    def get_row(self, user_id):
+        """Return the row of user_id, or None if user_id is not indexed."""
+        row = int(np.searchsorted(self.ids, user_id))
+        if row < len(self) and self.ids[row] == user_id:
+            return row
+        return None
+
+    def get_filter_mask(self, params, exclude_ids=()):
+        """
+        Return a boolean vector of user rows that match the search options
+        in the "params" dict. Same keys as search_users_by_options_queryset().
+
+        :exclude_ids: list of user ids to exclude, e.g. users blocked by auth
+            user.
+        """
+        mask = np.ones(len(self), dtype=bool)
+
+        # search option: sex
+        if params.get('sex', 0):
+            mask &= self.sex == params['sex']
+
+        # search option: age
+        dob_earliest, dob_latest = get_dob_range(params.get('minage', 18),
+                                                 params.get('maxage', 100))
+        mask &= self.dob >= dob_earliest.toordinal()
+        mask &= self.dob <= dob_latest.toordinal()
+
+        # have at least one picture URL
+        if params.get('hide_no_pic', False):
+            mask &= self.has_pic
+
+        # only users with a verified email on reddit
+        if params.get('has_verified_email', False):
+            mask &= self.has_verified_email
+
+        # exclude auth user themself and any other listed users
+        for user_id in list(exclude_ids) + [params.get('user_id', None)]:
+            row = self.get_row(user_id) if user_id else None
+            if row is not None:
+                mask[row] = False
+
+        # search option: distance, only calculated for the rows left over.
+        if is_distance_search(params):
+            rows = np.flatnonzero(mask)
+            mask[rows] = get_distance_mask(params, self.lat[rows],
+                                           self.lng[rows])
+
+        return mask
+
+    def search(self, *args, **kwargs):
+        """
+        Return the rows of up to "limit" users that share the most of the
+        subreddits "sr_ids" and match the search options in "params", in the
+        order requested by "order_by". For the "-sr_weight" order, users
+        sharing the highest sum of subreddit weights are returned instead.
+        """
+        return self.search_ranked(*args, **kwargs)[0]
+
+    def search_ranked(self, sr_ids, params, exclude_ids=(), order_by='',
+                      limit=1000, min_weight=0.0):
+        """
+        Same as search(), but return the rows, a vector of their ranks,
+        i.e. the value they are ordered by, negative for ascending orders,
+        and a vector of their scores, see get_score().
+        """
+        scores = {'sr_count': self.get_sr_count(sr_ids, False, min_weight)}
+        scores['sr_weight'] = scores['sr_count']
+        if order_by == '-sr_weight':
+            scores['sr_weight'] = self.get_sr_count(sr_ids, True, min_weight)
+
+        mask = self.get_filter_mask(params, exclude_ids)
+        rows = np.flatnonzero(mask & (scores['sr_count'] > 0))
+
+        # Keep the "limit" users with most (weighted) subs in common.
+        if len(rows) > limit:
+            top = np.argpartition(-scores['sr_weight'][rows], limit - 1)
+            rows = rows[top[:limit]]
+
+        # Then re-order those by the value stored in the user's session.
+        column, reverse = ORDER_COLUMNS.get(order_by, ('sr_count', True))
+        if column == 'distance':
+            ranks = get_search_distances(params, self.lat[rows],
+                                         self.lng[rows])
+        else:
+            values = scores[column] if column in scores \
+                else getattr(self, column)
+            ranks = values[rows].astype(np.float64)
+        if not reverse:
+            ranks = -ranks
+        order = np.argsort(-ranks, kind='stable')
+        rows = rows[order]
+        return rows, ranks[order], scores['sr_weight'][rows].astype(np.float64)
+
+    def search_ids(self, *args, **kwargs):
+        """
+        Same as search_ranked() but return a list of user ids, a list of
+        their ranks, and a list of their scores.
+        """
+        rows, ranks, scores = self.search_ranked(*args, **kwargs)
+        return self.ids[rows].tolist(), ranks.tolist(), scores.tolist()
+
+    def search_usernames(self, *args, **kwargs):
+        """Same as search() but return a list of usernames."""
+        return [self.usernames[row] for row in self.search(*args, **kwargs)]
+
+
+def _rebuild_match_index():
+    global _index
+    try:
+        _index = MatchIndex.build()
+    finally:
+        _index_lock.release()
+
+
+def get_match_index():
+    """
+    Return the current match index of this process. Build it, if there is
+    none yet, or start a rebuild in the background, if it is too old.
+    """
+    global _index
+    mt = getattr(settings, 'MATCH_INDEX_TIMEOUT', 10)
+
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if settings.DEBUG:
+                    print('get_match_index() --> No index, build it now!')
+                _index = MatchIndex.build()
+
+    elif _index.built + mt * 60 < unixtime():
+        if _index_lock.acquire(blocking=False):
+            if settings.DEBUG:
+                print('get_match_index() --> Index timeout, rebuild!')
+            threading.Thread(target=_rebuild_match_index, daemon=True).start()
+
+    return _index
@@ -0,0 +1,217 @@
+"""
+Per-view request metrics: wall time, number and time of database queries,
+cache hits and misses, and response size, see RequestMetricsMiddleware.
+
+The values are added up in histograms in the memory of this process, so
+recording a request costs a few additions and no I/O. Every web server
+process has its own metrics, read them with the staff only "mod/metrics"
+views, as JSON or as Prometheus text.
+
+Queries are only counted and timed. The SQL of every query is kept for a
+sample of METRICS_QUERY_SAMPLE_RATE requests only, and the slowest of those
+are listed per view.
+"""
+import random
+import threading
+from time import perf_counter
+
+from django.conf import settings
+
+# Histogram bucket upper bounds, the last one is +Inf.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1000, 10000, 50000, 100000, 500000, 1000000)
+HISTOGRAMS = (
+    ('duration_seconds', DURATION_BUCKETS, 'Request wall time.'),
+    ('queries', QUERIES_BUCKETS, 'Database queries per request.'),
+    ('query_seconds', DURATION_BUCKETS, 'Database time per request.'),
+    ('response_bytes', SIZE_BUCKETS, 'Response body size.'),
+)
+COUNTERS = (
+    ('cache_hits', 'Cache lookups that found a value.'),
+    ('cache_misses', 'Cache lookups that found nothing.'),
+)
+SLOW_QUERIES_MAX = 10  # slowest sampled queries kept per view
+
+_lock = threading.Lock()
+_views = {}  # view name --> ViewMetrics
+_local = threading.local()  # the current request's RequestMetrics
+
+
+class Histogram:
+    """Counts of observed values in buckets, with their sum."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def as_dict(self):
+        return {'buckets': list(self.buckets) + ['+Inf'],
+                'counts': list(self.counts), 'sum': self.sum}
+
+
+class ViewMetrics:
+    """All metrics of one view."""
+
+    def __init__(self):
+        self.requests = 0
+        self.histograms = {name: Histogram(buckets)
+                           for name, buckets, _ in HISTOGRAMS}
+        self.counters = {name: 0 for name, _ in COUNTERS}
+        self.slow_queries = []  # (seconds, sql) of sampled requests
+
+    def add(self, rm):
+        self.requests += 1
+        for name, _, _ in HISTOGRAMS:
+            self.histograms[name].observe(getattr(rm, name))
+        for name, _ in COUNTERS:
+            self.counters[name] += getattr(rm, name)
+        if rm.captured:
+            self.slow_queries = sorted(self.slow_queries + rm.captured,
+                                       reverse=True)[:SLOW_QUERIES_MAX]
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'histograms': {k: v.as_dict() for k, v in self.histograms.items()},
+            'counters': dict(self.counters),
+            'slow_queries': [{'seconds': round(t, 6), 'sql': sql}
+                             for t, sql in self.slow_queries],
+        }
+
+
+class RequestMetrics:
+    """The metrics of the current request, see start_request()."""
+
+    def __init__(self, sample=False):
+        self.t0 = perf_counter()
+        self.sample = sample
+        self.captured = []  # (seconds, sql) of all queries, if sampled
+        self.duration_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.response_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def execute(self, execute, sql, params, many, context):
+        """Database execute wrapper, see connection.execute_wrapper()."""
+        t0 = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            t = perf_counter() - t0
+            self.queries += 1
+            self.query_seconds += t
+            if self.sample:
+                self.captured.append((t, sql))
+
+
+def get_request_metrics():
+    """Return the RequestMetrics of the current request, or None."""
+    return getattr(_local, 'request', None)
+
+
+def start_request():
+    """Start recording the metrics of a request in this thread."""
+    rate = getattr(settings, 'METRICS_QUERY_SAMPLE_RATE', 0.01)
+    _local.request = RequestMetrics(sample=random.random() < rate)
+    return _local.request
+
+
+def finish_request(view_name, response_bytes):
+    """Add the current request's metrics to those of view_name."""
+    rm = get_request_metrics()
+    if rm is None:
+        return
+    _local.request = None
+    rm.duration_seconds = perf_counter() - rm.t0
+    rm.response_bytes = response_bytes
+
+    with _lock:
+        if view_name not in _views:
+            _views[view_name] = ViewMetrics()
+        _views[view_name].add(rm)
+
+
+def record_cache_lookup(hits, misses):
+    """Count cache hits and misses of the current request, if any."""
+    rm = get_request_metrics()
+    if rm is not None:
+        rm.cache_hits += hits
+        rm.cache_misses += misses
+
+
+def get_metrics():
+    """Return a dict with the metrics of all views."""
+    with _lock:
+        return {k: v.as_dict() for k, v in sorted(_views.items())}
+
+
+def reset_metrics():
+    with _lock:
+        _views.clear()
+
+
+def get_prometheus_metrics(prefix='dtr5_request_'):
+    """Return the metrics of all views in the Prometheus text format."""
+    metrics = get_metrics()
+    lines = []
+
+    for name, buckets, doc in HISTOGRAMS:
+        lines += ['# HELP {}{} {}'.format(prefix, name, doc),
+                  '# TYPE {}{} histogram'.format(prefix, name)]
+        for view, data in metrics.items():
+            hist = data['histograms'][name]
+            total = 0
+            for le, count in zip(hist['buckets'], hist['counts']):
+                total += count
+                lines.append('{}{}_bucket{{view="{}",le="{}"}} {}'.format(
+                    prefix, name, view, le, total))
+            lines.append('{}{}_sum{{view="{}"}} {}'.format(
+                prefix, name, view, hist['sum']))
+            lines.append('{}{}_count{{view="{}"}} {}'.format(
+                prefix, name, view, total))
+
+    for name, doc in COUNTERS:
+        lines += ['# HELP {}{}_total {}'.format(prefix, name, doc),
+                  '# TYPE {}{}_total counter'.format(prefix, name)]
+        for view, data in metrics.items():
+            lines.append('{}{}_total{{view="{}"}} {}'.format(
+                prefix, name, view, data['counters'][name]))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsCacheMixin:
+    """
+    Cache backend mixin that counts hits and misses of get() and get_many()
+    for the request metrics, see dtr5app.cache_backends.
+    """
+    _missing = object()
+
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super().get(key, self._missing, version=version, **kwargs)
+        hit = value is not self._missing
+        record_cache_lookup(int(hit), int(not hit))
+        return value if hit else default
+
+    def get_many(self, keys, version=None, **kwargs):
+        keys = list(keys)
+        # Some backends' get_many() calls get() for every key, don't count
+        # those lookups twice.
+        rm, _local.request = get_request_metrics(), None
+        try:
+            values = super().get_many(keys, version=version, **kwargs)
+        finally:
+            _local.request = rm
+        record_cache_lookup(len(values), len(keys) - len(values))
+        return values
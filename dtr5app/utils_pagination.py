@@ -0,0 +1,131 @@
+"""
+Keyset ("cursor") pagination for long user lists, like the likes, matches,
+visitors, and subreddit members lists of the API.
+
+Django's Paginator counts all rows and skips the rows of all earlier pages
+with OFFSET, so every page costs more than the one before. A keyset page
+instead continues after the ordering values of the last row of the previous
+page, e.g. (created, id), which are handed to the client as an opaque
+cursor string. With an index on the ordering columns, every page is one
+index range read of per_page rows, no matter how deep.
+
+The total number of rows is only shown approximately, from a count that is
+cached for KEYSET_COUNT_TIMEOUT seconds, or from a counter column.
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404
+
+COUNT_KEY = 'keyset_count:{}'
+
+
+class KeysetPage:
+    """One page of rows, with the cursor of the next page, if any."""
+
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(values):
+    """Return an opaque, URL safe string for a list of ordering values."""
+    # Datetimes with microseconds, unlike DjangoJSONEncoder, or the next page
+    # would repeat rows created within the same millisecond.
+    values = [x.isoformat() if hasattr(x, 'isoformat') else x for x in values]
+    data = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+    Return the list of length ordering values of a cursor string, or None
+    for an empty cursor, i.e. the first page. If the cursor is invalid, it
+    raises Http404, like a page number out of range.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise Http404
+    if not isinstance(values, list) or len(values) != length:
+        raise Http404
+    return values
+
+
+def get_keyset_q(ordering, values):
+    """
+    Return a Q object that finds all rows after the row with the ordering
+    values, e.g. for ordering ('-created', '-id'):
+
+        created <= c AND (created < c OR (created = c AND id < i))
+
+    The leading "created <= c" is redundant, but lets the database read the
+    index range of the first column only.
+    """
+    fields = [x.lstrip('-') for x in ordering]
+    ops = ['__lt' if x.startswith('-') else '__gt' for x in ordering]
+
+    after = Q()
+    for i, (field, op) in enumerate(zip(fields, ops)):
+        equal = {fields[j]: values[j] for j in range(i)}
+        after |= Q(**equal, **{field + op: values[i]})
+    return Q(**{fields[0] + ops[0] + 'e': values[0]}) & after
+
+
+def get_keyset_page(queryset, ordering, cursor=None, columns=(),
+                    per_page=None):
+    """
+    Return a KeysetPage with one page of values_list() rows of columns, from
+    queryset, ordered by ordering, after the row of cursor.
+
+    The ordering fields must be unique together, usually with the primary
+    key last, and they must never be NULL.
+
+    :queryset: any queryset, e.g. of Users or of Flags.
+    :ordering: a tuple of order_by() field names, e.g. ('-created', '-id').
+    :cursor: the "next_cursor" of the previous page, or empty for page 1.
+    :columns: the values_list() columns of the rows.
+    """
+    per_page = per_page or getattr(settings, 'USERS_PER_PAGE', 20)
+    fields = [x.lstrip('-') for x in ordering]
+    values = decode_cursor(cursor, len(fields))
+
+    qs = queryset.prefetch_related(None).order_by(*ordering)
+    if values is not None:
+        qs = qs.filter(get_keyset_q(ordering, values))
+    rows = list(qs.values_list(*columns, *fields)[:per_page + 1])
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(list(rows[-1][len(columns):]))
+    return KeysetPage([row[:len(columns)] for row in rows], next_cursor)
+
+
+def get_approximate_count(name, queryset):
+    """
+    Return the number of rows of queryset, cached as name for
+    KEYSET_COUNT_TIMEOUT seconds. Changes show up only after the count
+    expired, that is good enough for "about 120 users" in a list header.
+    """
+    key = COUNT_KEY.format(name)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, getattr(settings, 'KEYSET_COUNT_TIMEOUT', 300))
+    return count
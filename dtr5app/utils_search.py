@@ -1,19 +1,31 @@
 """
 All profile search-realted functions.
 """
-from datetime import timedelta
+import hashlib
+import json
+from array import array
+from datetime import datetime, timezone
+from time import time as unixtime
+
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import transaction
 from django.utils.datastructures import MultiValueDictKeyError
 
-from dtr5app.models import Flag
-from dtr5app.utils import normalize_sr_names
-from toolbox import (to_iso8601,
-                     from_iso8601,
-                     get_dob_range,
-                     get_latlng_bounderies, force_int, sr_str_to_list)
+from django.db.models import Count, Sum
+
+from dtr5app.models import Flag, Profile
+from dtr5app.utils import normalize_sr_names, get_user_list_from_id_list
+from dtr5app.utils_geo import (get_geo_cell_q, get_geo_cell_sql,
+                               get_latlng_box_q, get_latlng_box_sql,
+                               get_search_distances, is_distance_search)
+from dtr5app.utils_match_engine import (ORDER_COLUMNS, get_match_index,
+                                        get_rank, get_score)
+from dtr5app.utils_search_cache import get_shared_search_results
+from dtr5app.utils_search_jobs import queue_search_job
+from toolbox import get_dob_range, force_int, sr_str_to_list
 
 
 def search_subreddit_users(params, sr):
@@ -67,12 +79,8 @@ def search_users_by_options_queryset(params, include_flagged=False):
     # "distance" must be at least 1, so that the signup flow doesn't intercept
     # it because it has no value set! Leave this to only search distances
     # above 5 km or so, and return "worldwide" for any value below 5 km.
-    if 'distance' in params and 'lat' in params and \
-                    'lng' in params and params['distance'] > 5:
-        lat_min, lng_min, lat_max, lng_max = get_latlng_bounderies(
-            params['lat'], params['lng'], params['distance'])
-        li = li.filter(profile__lat__gte=lat_min, profile__lat__lte=lat_max,
-                       profile__lng__gte=lng_min, profile__lng__lte=lng_max)
+    if is_distance_search(params):
+        li = li.filter(get_geo_cell_q(params), get_latlng_box_q(params))
 
     # 5 exclude auth user themself
     if 'user_id' in params:
@@ -98,7 +106,7 @@ def search_users_by_options_queryset(params, include_flagged=False):
 
     # 8 have at least one picture URL,
     if 'hide_no_pic' in params and params['hide_no_pic']:
-        li = li.exclude(profile___pics__in=('', '[]', ))
+        li = li.filter(profile__pic_count__gt=0)
 
     # 9 only users with a verified email on reddit?
     if 'has_verified_email' in params and params['has_verified_email']:
@@ -120,17 +128,138 @@ def search_users_by_options_queryset(params, include_flagged=False):
 #    return list(li[:BUFFER_LEN].values_list('username', flat=True))
 
 
-def search_users(request, usernames_only=True):
+def search_users(request, ids_only=True):
     """
-    Return a list of usernames that are matches for auth user's selected
+    Return a list of user ids that are matches for auth user's selected
     search options and also are subscribes to one or more of the same
-    subreddits as auth user. The returned username list is ordered by the
+    subreddits as auth user. The returned user id list is ordered by the
     number of subreddits they share with auth user, with the largest number
     first.
 
     Search options are used only if auth user selected it, otherwise it will
     be ignored.
 
+    Depending on settings.SEARCH_BACKEND, the search runs on the in-memory
+    match index ("index") or as a raw SQL query ("sql").
+
+    With settings.SEARCH_CACHE_TIMEOUT set, the search runs without auth
+    user specific exclusions, and its results are shared with every user who
+    searches the same, see utils_search_cache. Auth user and the users they
+    blocked are then removed from the shared list.
+    """
+    order_by = request.session.get('search_results_order', '')
+    ids = search_users_ranked(
+        request.user, *get_search_options(request.user, order_by))[0]
+
+    # default return a list of only user ids
+    if ids_only:
+        return ids
+    return get_user_list_from_id_list(ids)
+
+
+def search_users_ranked(user, fav_sr_ids, params, order_by):
+    """
+    Same as search_users(), but return a list of user ids, a list of their
+    ranks and a list of their scores, see utils_match_engine.get_rank() and
+    get_score(), and the unixtime of the data that was searched, see
+    run_search().
+    """
+    if getattr(settings, 'SEARCH_CACHE_TIMEOUT', 0):
+        ids, ranks, scores, built = get_shared_search_results(
+            fav_sr_ids, params, order_by,
+            lambda p: run_search(user, fav_sr_ids, p, order_by))
+        exclude = set(Flag.objects.filter(sender=user, flag=Flag.BLOCK_FLAG)
+                                  .values_list('receiver_id', flat=True))
+        exclude.add(user.id)
+        keep = [i for i, x in enumerate(ids) if x not in exclude]
+        return ([ids[i] for i in keep], [ranks[i] for i in keep],
+                [scores[i] for i in keep], built)
+
+    return run_search(user, fav_sr_ids, params, order_by)
+
+
+def get_search_options(user, order_by):
+    """
+    Return user's favorite subreddit ids, their search parameters, and the
+    search result order "order_by", as used by search_users_ranked().
+    """
+    fav_sr_ids = list(user.subs.filter(is_favorite=True)
+                               .values_list('sr_id', flat=True))
+    return fav_sr_ids, get_search_params(user), order_by
+
+
+def get_search_key(fav_sr_ids, params, order_by):
+    """Return a hash of search options, to find out if they changed."""
+    data = [sorted(fav_sr_ids), sorted(params.items()), order_by]
+    data = json.dumps(data, default=str, separators=(',', ':'))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def get_search_params(user):
+    """
+    Return auth user's search options as a dict of search parameters, with
+    the same keys as used by search_users_by_options_queryset().
+    """
+    p = user.profile
+    return {
+        'user_id': user.id,
+        'sex': p.f_sex,
+        'minage': p.f_minage,
+        'maxage': p.f_maxage,
+        'distance': p.f_distance,
+        'lat': p.lat,
+        'lng': p.lng,
+        'hide_no_pic': p.f_hide_no_pic,
+        'has_verified_email': p.f_has_verified_email,
+    }
+
+
+def run_search(user, fav_sr_ids, params, order_by):
+    """
+    Return a list of user ids, a list of their ranks and a list of their
+    scores, found with the search options in "params" on the
+    settings.SEARCH_BACKEND. If there is no "user_id" in params, auth user
+    and the users they blocked are not excluded from the results.
+
+    Also return the unixtime of the data that was searched: when the match
+    index was built, or when the SQL query started. Users that changed after
+    that are merged in by the next refresh of a search buffer.
+    """
+    if getattr(settings, 'SEARCH_BACKEND', 'sql') == 'index':
+        return search_users_by_match_index(user, fav_sr_ids, params, order_by)
+
+    built = unixtime()
+    users = search_users_by_raw_sql(user, params, order_by)
+    return ([x.id for x in users], [x.rank for x in users],
+            [x.score for x in users], built)
+
+
+def search_users_by_match_index(user, fav_sr_ids, params, order_by):
+    """
+    Return a list of user ids, their ranks and scores, same as the raw SQL
+    search, but looked up on this process' in-memory match index. Also
+    return the unixtime the index was built.
+    """
+    blocked_ids = []
+    if 'user_id' in params:
+        # exclude only users who have a BLOCK_FLAG ("hide") from auth user
+        blocked_ids = Flag.objects.filter(sender=user, flag=Flag.BLOCK_FLAG) \
+                                  .values_list('receiver_id', flat=True)
+
+    idx = get_match_index()
+    ids, ranks, scores = idx.search_ids(
+        fav_sr_ids, params, exclude_ids=list(blocked_ids), order_by=order_by,
+        limit=getattr(settings, 'RESULTS_BUFFER_LEN', 1000),
+        min_weight=getattr(settings, 'SR_WEIGHT_MIN', 0.0))
+    return ids, ranks, scores, idx.built
+
+
+def get_search_sql(user, params, order_by):
+    """
+    Return the raw SQL query and its list of query params, that finds the
+    users who share favorite subreddits with auth user and match the search
+    options in "params", see search_users_by_raw_sql().
+
     The query is build as raw() SQL because there doesn't seem to be a way to
     build the subreddit subscription counting and ordering in Django.
 
@@ -141,18 +270,22 @@ def search_users(request, usernames_only=True):
     is_filter_block_flag_only = True
     query_params = []
     query_string = ''
+    # Without a "user_id", results may be shared with other users, so don't
+    # exclude auth user or anybody they blocked, see search_users().
+    is_exclude_user = 'user_id' in params
 
     # part 1
     query_params += []
     query_string += '''
         SELECT
-            au.id, au.username, ap.created, ap.accessed, ap.views_count,
-            COUNT(r1.user_id) AS sr_count
+            au.id, au.username, au.date_joined,
+            ap.created, ap.accessed, ap.views_count, ap.lat, ap.lng,
+            COUNT(r1.user_id) AS sr_count, SUM(sr.weight) AS sr_weight
 
         FROM dtr5app_subscribed r1
 
         INNER JOIN dtr5app_subscribed r2
-            ON r1.sr_id = r2.sr_id AND r1.user_id <> r2.user_id
+            ON r1.sr_id = r2.sr_id
 
         INNER JOIN auth_user au
             ON r2.user_id = au.id
@@ -199,11 +332,20 @@ def search_users(request, usernames_only=True):
     query_params += []
     query_string += ''' AND r1.is_favorite '''
 
+    # part 1.4
+    # Ignore subreddits with a very low weight, i.e. subreddits that most
+    # users here are subscribed to. They add very little to a match, but
+    # they are the most expensive part of the join.
+    sr_weight_min = getattr(settings, 'SR_WEIGHT_MIN', 0.0)
+    if sr_weight_min > 0:
+        query_params += [sr_weight_min]
+        query_string += ''' AND sr.weight >= %s '''
+
     # part 1.9
     # Set r1 to be the auth user, and r2 to be the users we are searching for,
     # then do a sub-query to join them with their profiles, so we can search
     # the profile for auth user's search settings.
-    query_params += [request.user.id]
+    query_params += [user.id]
     query_string += ''' AND r1.user_id = %s AND au.id IN (
                             SELECT id FROM auth_user u
                             INNER JOIN dtr5app_profile p
@@ -212,13 +354,13 @@ def search_users(request, usernames_only=True):
 
     # part 2: sex --> TODO: search by gender!
     # li = li.filter(profile__sex=request.user.profile.f_sex)
-    if request.user.profile.f_sex > 0:
-        query_params += [request.user.profile.f_sex]
+    if params.get('sex', 0) > 0:
+        query_params += [params['sex']]
         query_string += ''' AND p.sex = %s '''
 
     # part 3: date of birth
-    dob_earliest, dob_latest = get_dob_range(request.user.profile.f_minage,
-                                             request.user.profile.f_maxage)
+    dob_earliest, dob_latest = get_dob_range(params.get('minage', 18),
+                                             params.get('maxage', 100))
     query_params += [dob_earliest, dob_latest]
     query_string += ''' AND p.dob >= %s AND p.dob <= %s '''
 
@@ -231,31 +373,35 @@ def search_users(request, usernames_only=True):
     # it because it has no value set! Leave this to only search distances
     # above 5 km or so, and return "worldwide" for any value below 5 km.
     #
-    if request.user.profile.f_distance > 5:
-        lat_min, lng_min, lat_max, lng_max = get_latlng_bounderies(
-            request.user.profile.lat,
-            request.user.profile.lng,
-            request.user.profile.f_distance)
-        query_params += [lat_max, lng_min, lat_min, lng_max]
-        query_string += ''' AND p.lat <= %s AND p.lng >= %s
-                            AND p.lat >= %s AND p.lng <= %s '''
+    # Only the grid cells around auth user, and within them the lat/lng box
+    # of the search area, are searched here. The exact distance is checked
+    # on the results.
+    is_distance = is_distance_search(params)
+    if is_distance:
+        sql, sql_params = get_geo_cell_sql(params, 'p.geo_cell')
+        query_params += sql_params
+        query_string += sql
+        sql, sql_params = get_latlng_box_sql(params, 'p')
+        query_params += sql_params
+        query_string += sql
 
     # part 5: exclude auth user themself
     # li = li.exclude(pk=request.user.pk)
-    query_params += [request.user.id]
-    query_string += ''' AND NOT (u.id = %s) '''
+    if is_exclude_user:
+        query_params += [user.id]
+        query_string += ''' AND NOT (u.id = %s) '''
 
     # part 6: exclude users who already have a like/nope flag from auth user
     # li = li.exclude(flags_received__sender=request.user)
-    if is_filter_block_flag_only:
+    if is_exclude_user and is_filter_block_flag_only:
         # exclude only users who have a BLOCK_FLAG ("hide") from auth user
-        query_params += [Flag.BLOCK_FLAG, request.user.id]
+        query_params += [Flag.BLOCK_FLAG, user.id]
         query_string += ''' AND NOT (u.id IN (SELECT U1.receiver_id AS Col1
                             FROM dtr5app_flag U1
                             WHERE U1.flag = %s AND U1.sender_id = %s)) '''
-    else:
+    elif is_exclude_user:
         # Exclude all users flagged by auth user: LIKE_FLAG, BLOCK_FLAG, etc.
-        query_params += [request.user.id]
+        query_params += [user.id]
         query_string += ''' AND NOT (u.id IN (SELECT U1.receiver_id AS Col1
                             FROM dtr5app_flag U1 WHERE U1.sender_id = %s)) '''
 
@@ -264,89 +410,357 @@ def search_users(request, usernames_only=True):
     # --> TODO: currently empty.
     pass
 
-    # part 8: have at least one picture URL in the JSON string
-    # li = li.exclude(profile___pics='[]')
+    # part 8: have at least one picture, see Profile.pic_count
+    # li = li.filter(profile__pic_count__gt=0)
     #
     # TODO: for now, allow no-picture profiles, to make testing easier
-    #
-    # Note: there was an error causing an empty pic list to be written as [] to
-    #       the field.
-    if request.user.profile.f_hide_no_pic:
+    if params.get('hide_no_pic', False):
         query_params += []
-        query_string += ''' AND p._pics NOT IN ('', '[]') '''
+        query_string += ''' AND p.pic_count > 0 '''
 
     # part 9: only users with a verified email on reddit
     # li = li.filter(profile__has_verified_email=True)
-    if request.user.profile.f_has_verified_email:
+    if params.get('has_verified_email', False):
         query_params += []
         query_string += ''' AND p.has_verified_email '''
 
-    # finish up: fetch 1000 matches with most subs in common
+    # finish up: fetch 1000 matches with most subs in common, or with the
+    # highest sum of weights of the subs in common.
     query_params += [getattr(settings, 'RESULTS_BUFFER_LEN', 1000)]
-    query_string += ''' ) GROUP BY r1.user_id, au.id, ap.user_id
-                          ORDER BY sr_count DESC LIMIT %s '''
-    users = User.objects.raw(query_string, query_params)
+    query_string += ''' ) GROUP BY r1.user_id, au.id, ap.user_id '''
+    if order_by == '-sr_weight':
+        query_string += ''' ORDER BY sr_weight DESC LIMIT %s '''
+    else:
+        query_string += ''' ORDER BY sr_count DESC LIMIT %s '''
 
-    # re-order the results: re-order the 1000 matches by the value stored in the
-    # user's session, so they can see seemingly different kinds of lists.
-    order_by = request.session.get('search_results_order', '')
+    return query_string, query_params
+
+
+def search_users_by_raw_sql(user, params, order_by):
+    """
+    Return a list of User objects found with a raw SQL query, that share
+    favorite subreddits with auth user and match the search options in
+    "params", ordered by "order_by".
+    """
+    query_string, query_params = get_search_sql(user, params, order_by)
+    users = list(User.objects.raw(query_string, query_params))
+
+    # Distances of all results at once, to cut them at the exact search
+    # distance, and for the "distance" order.
+    distances = get_search_distances(params, [u.lat for u in users],
+                                     [u.lng for u in users])
+    for u, distance in zip(users, distances.tolist()):
+        u.distance = distance
+    if is_distance_search(params):
+        users = [u for u in users if u.distance <= params['distance']]
 
-    if order_by == '-accessed':  # most recently accessed first
-        users = sorted(users, key=lambda u: u.accessed, reverse=True)
-    elif order_by == 'accessed':  # most recently accessed last
-        users = sorted(users, key=lambda u: u.accessed, reverse=False)
-    elif order_by == 'date_joined':  # oldest redddate account
-        users = sorted(users, key=lambda u: u.date_joined, reverse=True)
-    elif order_by == '-date_joined':  # most recent redddate acccount
-        users = sorted(users, key=lambda u: u.date_joined, reverse=True)
-    # Not posstible because of the "created" bug when it fetched a unixtime of
-    # "0" from reddit. There are still many accounts that have a "created" date
-    # set to "1970-01-01T00:00:00".
+    # re-order the results: re-order the 1000 matches by the value stored in the
+    # user's session, so they can see seemingly different kinds of lists. The
+    # orders are the same as on the match index, see ORDER_COLUMNS.
     #
-    # elif order_by == 'reddit_joined':  # oldest REDDIT account
-    #     users = sorted(users, key=lambda u: u.created, reverse=False)
-    # elif order_by == '-reddit_joined':  # most recent REDDIT account
-    #     users = sorted(users, key=lambda u: u.created, reverse=True)
-    elif order_by == '-views_count':  # most views first
-        users = sorted(users, key=lambda u: u.views_count, reverse=True)
-    elif order_by == 'views_count':  # most views last
-        users = sorted(users, key=lambda u: u.views_count, reverse=False)
-    else:  # -sr_count (default): most subs in common first
-        users = sorted(users, key=lambda u: u.sr_count, reverse=True)
-
-    # default return a list of only usernames
-    if usernames_only:
-        return [x.username for x in users]
-    else:
-        return users
+    # Not posstible by "reddit_joined" because of the "created" bug when it
+    # fetched a unixtime of "0" from reddit. There are still many accounts
+    # that have a "created" date set to "1970-01-01T00:00:00".
+    for u in users:
+        u.rank = get_rank(order_by, {x[0]: getattr(u, x[0], None)
+                                     for x in ORDER_COLUMNS.values()})
+        u.score = get_score(order_by, {'sr_count': u.sr_count,
+                                       'sr_weight': u.sr_weight})
+    users = sorted(users, key=lambda u: u.rank, reverse=True)
+
+    return users
+
+
+class SearchBuffer:
+    """
+    Auth user's search results, as a packed array of user ids. The buffer is
+    stored as bytes under its own cache key, not in the session, so that the
+    session doesn't grow by a thousand usernames that are re-serialized on
+    every request.
+
+    Every user id has a rank, the value the results are ordered by, so that
+    changed users can be merged into the list at their position, see
+    refresh_search_results_buffer(). It also has a score, the value the
+    full search selected the results by, so that a merge keeps the same
+    users as a full search would.
+
+    Supports len(), iteration, "user_id in buff", and indexing or slicing,
+    which returns user ids or an array of user ids.
+    """
+    TYPECODE = 'I'
+    CACHE_KEY = 'search_buffer:2:{}'  # 2: with scores and snapshot
+    CACHE_TIMEOUT = 60 * 60 * 24  # keep, even if too old for a page of results
+
+    def __init__(self, user_id, ids=(), ranks=(), created=None, key='',
+                 order_by='', scores=(), snapshot=None):
+        self.user_id = user_id
+        self.ids = array(self.TYPECODE, ids)
+        self.ranks = array('d', ranks or [0.0] * len(self.ids))
+        self.scores = array('d', scores or [0.0] * len(self.ids))
+        self.created = created  # unixtime of the full search, None if never
+        self.updated = created  # unixtime of the last (incremental) refresh
+        # unixtime of the data the results were searched in, which may be
+        # older than "created", e.g. a match index or a shared search
+        self.snapshot = snapshot or created
+        self.key = key  # see get_search_key()
+        self.order_by = order_by
+        self.refreshing = False  # a search job is queued for this buffer
+        self._pos = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, item):
+        return self.ids[item]
+
+    def __contains__(self, user_id):
+        return self.index(user_id) is not None
+
+    @classmethod
+    def load(cls, user_id):
+        """Return the user's buffer from cache, or an empty buffer."""
+        data = cache.get(cls.CACHE_KEY.format(user_id))
+        buff = cls(user_id)
+        if data is not None:
+            buff.created, buff.updated, buff.snapshot, buff.key, \
+                buff.order_by, ids, ranks, scores = data
+            buff.ids.frombytes(ids)
+            buff.ranks.frombytes(ranks)
+            buff.scores.frombytes(scores)
+        return buff
+
+    def save(self):
+        data = (self.created, self.updated, self.snapshot, self.key,
+                self.order_by, self.ids.tobytes(), self.ranks.tobytes(),
+                self.scores.tobytes())
+        cache.set(self.CACHE_KEY.format(self.user_id), data,
+                  self.CACHE_TIMEOUT)
+
+    def index(self, user_id):
+        """Return the position of user_id in the buffer, or None."""
+        if self._pos is None:
+            self._pos = {x: i for i, x in enumerate(self.ids)}
+        return self._pos.get(user_id, None)
+
+    def remove(self, user_id):
+        """Remove user_id from the buffer, if it is there."""
+        idx = self.index(user_id)
+        if idx is not None:
+            del self.ids[idx]
+            del self.ranks[idx]
+            del self.scores[idx]
+            self._pos = None
+
+    def merge(self, ids, ranks, scores, limit):
+        """
+        Remove all "ids" from the buffer, then insert those that have a rank
+        in "ranks" at their position. Cut the buffer to the "limit" entries
+        with the highest scores, like the full search.
+        """
+        drop = set(ids)
+        li = [t for t in zip(self.ranks, self.scores, self.ids)
+              if t[2] not in drop]
+        li += zip(ranks, scores, ids)
+        if len(li) > limit:
+            top = sorted(range(len(li)), key=lambda i: li[i][1],
+                         reverse=True)[:limit]  # stable: old ones first
+            li = [li[i] for i in sorted(top)]
+        li.sort(key=lambda t: t[0], reverse=True)  # stable: old ones first
+
+        self.ids = array(self.TYPECODE, [x for r, s, x in li])
+        self.ranks = array('d', [r for r, s, x in li])
+        self.scores = array('d', [s for r, s, x in li])
+        self._pos = None
+
+
+def search_users_by_id_list(user, fav_sr_ids, params, order_by, user_ids):
+    """
+    Return a list of user ids, a list of their ranks and a list of their
+    scores, like search_users_ranked(), but only search the users in
+    "user_ids". Used to update a search buffer with users that changed,
+    without running the full search.
+    """
+    # All conditions on "subs" in one filter(), so they use the same join.
+    subs_filter = {'subs__sr_id__in': fav_sr_ids}
+    sr_weight_min = getattr(settings, 'SR_WEIGHT_MIN', 0.0)
+    if sr_weight_min > 0:
+        subs_filter['subs__sr__weight__gte'] = sr_weight_min
+
+    # Same filters as the full search, which unlike the Sr view user list
+    # doesn't filter on karma.
+    li = User.objects.filter(pk__in=user_ids, is_active=True,
+                             last_login__isnull=False, **subs_filter)
+
+    if params.get('sex', 0):
+        li = li.filter(profile__sex=params['sex'])
+
+    dob_earliest, dob_latest = get_dob_range(params.get('minage', 18),
+                                             params.get('maxage', 100))
+    li = li.filter(profile__dob__gte=dob_earliest,
+                   profile__dob__lte=dob_latest)
+
+    if is_distance_search(params):
+        li = li.filter(get_geo_cell_q(params), get_latlng_box_q(params))
+
+    if 'user_id' in params:
+        li = li.exclude(pk=params['user_id'])
 
+    if params.get('hide_no_pic', False):
+        li = li.filter(profile__pic_count__gt=0)
 
-def search_results_buffer(request, force=False):
+    if params.get('has_verified_email', False):
+        li = li.filter(profile__has_verified_email=True)
+
+    # exclude only users who have a BLOCK_FLAG ("hide") from auth user
+    li = li.exclude(pk__in=Flag.objects.filter(sender=user,
+                                               flag=Flag.BLOCK_FLAG)
+                                       .values('receiver_id'))
+
+    li = li.annotate(sr_count=Count('subs__sr', distinct=True),
+                     sr_weight=Sum('subs__sr__weight')) \
+           .values('id', 'sr_count', 'sr_weight', 'date_joined',
+                   'profile__accessed', 'profile__views_count',
+                   'profile__lat', 'profile__lng')
+
+    rows = list(li)
+    distances = get_search_distances(params,
+                                     [x['profile__lat'] for x in rows],
+                                     [x['profile__lng'] for x in rows])
+    for row, distance in zip(rows, distances.tolist()):
+        row['distance'] = distance
+    if is_distance_search(params):
+        rows = [x for x in rows if x['distance'] <= params['distance']]
+
+    ids, ranks, scores = [], [], []
+    for row in rows:
+        row['accessed'] = row['profile__accessed']
+        row['views_count'] = row['profile__views_count']
+        ids.append(row['id'])
+        ranks.append(get_rank(order_by, row))
+        scores.append(get_score(order_by, row))
+    return ids, ranks, scores
+
+
+def refresh_search_results_buffer(user, buff):
+    """
+    Bring user's search buffer up to date without a full search. Only
+    the users whose Profile or subscriptions changed, or who joined since
+    the buffer's snapshot, are searched and merged into the ranked list.
+    Users they blocked since then are removed.
+
+    Return False if that's not possible and a full search is needed, i.e.
+    the search options changed, or too many users changed.
+    """
+    fav_sr_ids, params, order_by = get_search_options(user, buff.order_by)
+    if buff.key != get_search_key(fav_sr_ids, params, order_by):
+        return False
+
+    limit = getattr(settings, 'RESULTS_BUFFER_LEN', 1000)
+    since = datetime.fromtimestamp(buff.snapshot, tz=timezone.utc)
+    updated = unixtime()
+
+    changed_ids = list(Profile.objects.filter(search_updated__gt=since)
+                                      .values_list('user_id', flat=True)
+                                      [:limit + 1])
+    if len(changed_ids) > limit:
+        return False
+
+    blocked_ids = list(Flag.objects.filter(sender=user,
+                                           flag=Flag.BLOCK_FLAG,
+                                           created__gt=since)
+                                   .values_list('receiver_id', flat=True))
+    ids, ranks, scores = search_users_by_id_list(user, fav_sr_ids, params,
+                                                 order_by, changed_ids)
+
+    buff.merge(changed_ids + blocked_ids, [], [], limit)
+    buff.merge(ids, ranks, scores, limit)
+    buff.updated = updated
+    buff.snapshot = updated
+    return True
+
+
+def search_results_buffer(request, force=False, refresh=False):
+    """
+    Return auth user's SearchBuffer, up to date as requested, see
+    update_search_results_buffer(). With settings.SEARCH_ASYNC, a full search
+    is left to the search worker, and the last buffer is returned with its
+    "refreshing" flag set.
+    """
+    # The buffer used to be stored in the session, remove it from there.
+    if 'search_results_buffer' in request.session:
+        del request.session['search_results_buffer']
+        request.session.pop('search_results_buffer_time', None)
+
+    return update_search_results_buffer(
+        request.user, request.session.get('search_results_order', ''),
+        force=force, refresh=refresh,
+        run_async=getattr(settings, 'SEARCH_ASYNC', False))
+
+
+def update_search_results_buffer(user, order_by, force=False, refresh=False,
+                                 run_async=False):
     """
-    Check if there are search results in session cache. If there are
-    not, or 'force' is True, run a search and load the usernames into
-    the buffer.
+    Return user's SearchBuffer for the search results order "order_by". If
+    there are no search results in the buffer, or they are older than
+    RESULTS_BUFFER_MAX_AGE, or 'force' is True, run a full search and load
+    the user ids into the buffer.
+
+    If the buffer was not updated for RESULTS_BUFFER_TIMEOUT minutes, or
+    'refresh' is True, update it incrementally, see
+    refresh_search_results_buffer().
+
+    With 'run_async', a full search is queued for the search worker instead,
+    and the old buffer is returned with buff.refreshing set, see
+    utils_search_jobs. Only if there is no old buffer, or the worker doesn't
+    keep up, the search runs here.
     """
-    bt = request.session.get('search_results_buffer_time', None)
+    buff = SearchBuffer.load(user.id)
     mt = getattr(settings, 'RESULTS_BUFFER_TIMEOUT', 5)
+    max_age = getattr(settings, 'RESULTS_BUFFER_MAX_AGE', mt)
 
-    if not bt or from_iso8601(bt) + timedelta(minutes=mt) < from_iso8601():
+    if buff.created is None:
+        if settings.DEBUG:
+            print('search_results_buffer() --> No buffer, fill first time!')
+        force = True  # no buffer ever set, then do a search
+
+    elif buff.created + max_age * 60 < unixtime():
         if settings.DEBUG:
             print('search_results_buffer() --> Cache timeout, new search!')
         force = True  # if buffer is old, force refresh
 
-    if request.session.get('search_results_buffer', None) is None:
+    elif buff.order_by != order_by:
+        force = True  # a different order may contain different users
+
+    elif not force and (refresh or buff.updated + mt * 60 < unixtime()):
         if settings.DEBUG:
-            print('search_results_buffer() --> No buffer, fill first time!')
-        force = True  # no buffer ever set, then do a search
+            print('search_results_buffer() --> Incremental refresh!')
+        if refresh_search_results_buffer(user, buff):
+            buff.save()
+        else:
+            force = True  # search options changed, or too many changes
+
+    if force and run_async and buff.created is not None:
+        if queue_search_job(user.id, order_by, force=True):
+            if settings.DEBUG:
+                print('search_results_buffer() --> Search job queued!')
+            buff.refreshing = True
+            return buff
 
     if force:
         if settings.DEBUG:
             print('search_results_buffer() --> "force" is true, do search!')
 
-        request.session['search_results_buffer'] = search_users(request)
-        request.session['search_results_buffer_time'] = to_iso8601()
-        request.session.modified = True
+        created = unixtime()
+        options = get_search_options(user, order_by)
+        ids, ranks, scores, built = search_users_ranked(user, *options)
+        buff = SearchBuffer(user.id, ids, ranks, created,
+                            get_search_key(*options), order_by, scores, built)
+        buff.save()
+
+    return buff
 
 
 def update_search_settings(request):
@@ -424,6 +838,11 @@ def update_search_settings(request):
         else:
             messages.warning(request, 'no subreddits selected for search!')
 
+    # Only the search settings, not the counters that other users' requests
+    # increase meanwhile, see utils_counters.
     request.user.profile = p
-    request.user.profile.save()
+    request.user.profile.save(update_fields=[
+        'f_sex', 'f_distance', 'f_minage', 'f_maxage', 'f_hide_no_pic',
+        'f_has_verified_email', 'f_over_18', '_f_ignore_sr_li',
+        'f_ignore_sr_max', '_f_exclude_sr_li'])
     return request
@@ -0,0 +1,209 @@
+"""
+Search results shared between all users who search with the same favorite
+subreddits and the same search options.
+
+A shared search runs without any auth user specific exclusions, and its
+list of user ids is stored in the cache under a hash of the normalized
+search: the sorted favorite sr ids, the search options, auth user's
+location rounded to a geo cell, and the result order. Every user that
+produces the same hash gets the same list, and only removes themself and
+the users they blocked from it.
+
+Every subreddit has a "generation" counter in the cache that is part of the
+hash. The counter is increased whenever a user subscribes to or leaves that
+subreddit, or one of its subscribers changes a Profile field that others
+filter their search on. That makes all cached searches over that subreddit
+unreachable, and they simply time out after SEARCH_CACHE_TIMEOUT minutes.
+"""
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from math import floor
+from time import time as unixtime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from dtr5app.models import Profile, Subscribed
+from dtr5app.utils_geo import is_distance_search
+
+SR_GENERATION_KEY = 'search_cache_sr_gen:{}'
+RESULTS_KEY = 'search_cache:2:{}'  # 2: with scores and snapshot time
+STATS_KEY = 'search_cache_stats:{}'
+STATS_NAMES = ('hits', 'misses', 'build_ms', 'invalidations')
+
+_local = threading.local()
+
+
+def incr_stat(name, delta=1):
+    """Add delta to one of the shared search cache counters."""
+    key = STATS_KEY.format(name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:  # counter doesn't exist yet
+        cache.set(key, delta, None)
+
+
+def get_search_cache_stats():
+    """Return a dict with the shared search cache counters."""
+    keys = [STATS_KEY.format(x) for x in STATS_NAMES]
+    values = cache.get_many(keys)
+    stats = {x: values.get(k, 0) for x, k in zip(STATS_NAMES, keys)}
+
+    searches = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / searches if searches else 0.0
+    stats['avg_build_ms'] = \
+        stats['build_ms'] / stats['misses'] if stats['misses'] else 0.0
+    return stats
+
+
+def get_sr_generations(sr_ids):
+    """Return a list with the current generation of each of sr_ids."""
+    keys = [SR_GENERATION_KEY.format(x) for x in sr_ids]
+    values = cache.get_many(keys)
+    return [values.get(k, 0) for k in keys]
+
+
+def invalidate_srs(sr_ids):
+    """
+    Increase the generation of all subreddits in sr_ids, so that no cached
+    search over any of these subreddits is found anymore.
+    """
+    sr_ids = list(sr_ids)
+    if not sr_ids:
+        return
+
+    # Atomic increments, so that no concurrent invalidation is lost. add()
+    # only creates the counters that don't exist yet.
+    keys = [SR_GENERATION_KEY.format(x) for x in sr_ids]
+    for key in keys:
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:  # evicted in the meantime
+            cache.set(key, 1, None)
+    incr_stat('invalidations', len(keys))
+
+
+def invalidate_user_srs(user_id):
+    """Invalidate all cached searches that may contain user_id."""
+    invalidate_srs(Subscribed.objects.filter(user_id=user_id)
+                                     .values_list('sr_id', flat=True))
+
+
+@contextmanager
+def bulk_subscription_changes():
+    """
+    Skip the search cache invalidation per row for Subscribed rows deleted
+    or created in this block, in this thread. For bulk changes, where the
+    caller invalidates the subreddits and touches the user once afterwards.
+    """
+    _local.bulk = True
+    try:
+        yield
+    finally:
+        _local.bulk = False
+
+
+def touch_user_search(user_id):
+    """
+    Set Profile.search_updated of user_id, so that incremental search buffer
+    refreshes pick up the changed user, see utils_search.
+    """
+    Profile.objects.filter(user_id=user_id).update(search_updated=now())
+
+
+def snap_to_geo_cell(lat, lng, distance):
+    """
+    Return lat/lng moved to the center of their geo cell. The size of a cell
+    is a fraction SEARCH_CACHE_GEO_CELL of the search distance, so that the
+    error is about the same for short and long distance searches.
+    """
+    fraction = getattr(settings, 'SEARCH_CACHE_GEO_CELL', 0.05)
+    cell = max(distance * fraction, 1) / 111.2  # in degrees, approx.
+    return ((floor(lat / cell) + 0.5) * cell,
+            (floor(lng / cell) + 0.5) * cell)
+
+
+def normalize_search_params(params, order_by=''):
+    """
+    Return a copy of params without the auth user specific values, and the
+    location rounded to its geo cell or removed, if not used for the search
+    or the "distance" order.
+    """
+    params = {k: v for k, v in params.items() if k != 'user_id'}
+
+    if is_distance_search(params) or (
+            order_by == 'distance' and 'lat' in params and 'lng' in params):
+        params['lat'], params['lng'] = snap_to_geo_cell(
+            params['lat'], params['lng'], params.get('distance', 0))
+    else:
+        params.pop('lat', None)
+        params.pop('lng', None)
+        params.pop('distance', None)
+
+    return params
+
+
+def get_search_cache_key(sr_ids, params, order_by):
+    """Return the cache key for a search with normalized params."""
+    sr_ids = sorted(set(sr_ids))
+    data = [sr_ids, get_sr_generations(sr_ids), sorted(params.items()),
+            order_by, getattr(settings, 'SR_WEIGHT_MIN', 0.0)]
+    data = json.dumps(data, default=str, separators=(',', ':'))
+    return RESULTS_KEY.format(hashlib.sha1(data.encode()).hexdigest())
+
+
+def get_shared_search_results(sr_ids, params, order_by, search_fn):
+    """
+    Return the shared search result, the user ids, their ranks and scores
+    and the unixtime of the searched data, see utils_search.run_search(),
+    from cache or by calling search_fn(normalized_params) and caching its
+    result. A cached result keeps the unixtime of the search that built it.
+    """
+    params = normalize_search_params(params, order_by)
+    key = get_search_cache_key(sr_ids, params, order_by)
+
+    ids = cache.get(key)
+    if ids is not None:
+        incr_stat('hits')
+        return ids
+
+    if settings.DEBUG:
+        print('get_shared_search_results() --> Not cached, search now!')
+
+    t0 = unixtime()
+    ids = search_fn(params)
+    mt = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 10)
+    cache.set(key, ids, mt * 60)
+
+    incr_stat('misses')
+    incr_stat('build_ms', int((unixtime() - t0) * 1000))
+    return ids
+
+
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Subscribed)
+def subscribed_saved(sender, instance, created, **kwargs):
+    if created and not getattr(_local, 'bulk', False):
+        invalidate_srs([instance.sr_id])
+        touch_user_search(instance.user_id)
+
+
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Subscribed)
+def subscribed_deleted(sender, instance, **kwargs):
+    if not getattr(_local, 'bulk', False):
+        invalidate_srs([instance.sr_id])
+        touch_user_search(instance.user_id)
+
+
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, created, **kwargs):
+    if not created and instance.search_fields_changed():
+        invalidate_user_srs(instance.user_id)
@@ -0,0 +1,101 @@
+"""
+Queue of search buffer jobs, run by the "search_worker" management command
+outside of the web processes.
+
+A job recomputes the search buffer of one user ahead of time, e.g. after
+they logged in or changed their search settings, see
+utils_search.update_search_results_buffer(). Meanwhile, requests return the
+user's last search buffer with its "refreshing" flag set.
+
+The queue is a list in the Redis server of the default cache. Every queued
+user has a marker in the cache, so that a user is never queued twice. If a
+job waits longer than SEARCH_JOB_TIMEOUT seconds, the worker is probably not
+running, and the request runs the search itself.
+"""
+import json
+from time import time as unixtime
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.dispatch import receiver
+
+QUEUE_KEY = 'search_jobs:queue'
+QUEUED_KEY = 'search_jobs:queued:{}'
+STATS_KEY = 'search_jobs:stats:{}'
+STATS_NAMES = ('queued', 'done', 'failed', 'wait_ms', 'run_ms')
+
+
+def get_queue_connection():
+    # Imported here, so that other cache backends work without django_redis.
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def incr_stat(name, delta=1):
+    """Add delta to one of the search job counters."""
+    key = STATS_KEY.format(name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:  # counter doesn't exist yet
+        cache.set(key, delta, None)
+
+
+def get_search_job_stats():
+    """Return a dict with the queue depth and search job counters."""
+    keys = [STATS_KEY.format(x) for x in STATS_NAMES]
+    values = cache.get_many(keys)
+    stats = {x: values.get(k, 0) for x, k in zip(STATS_NAMES, keys)}
+
+    stats['queue_depth'] = get_queue_connection().llen(QUEUE_KEY)
+    finished = stats['done'] + stats['failed']
+    stats['avg_wait_ms'] = stats['wait_ms'] / finished if finished else 0.0
+    stats['avg_run_ms'] = stats['run_ms'] / finished if finished else 0.0
+    stats['avg_latency_ms'] = stats['avg_wait_ms'] + stats['avg_run_ms']
+    return stats
+
+
+def queue_search_job(user_id, order_by='', force=False):
+    """
+    Queue a search buffer job for user_id. Return True if the job is queued,
+    or was queued recently, and False if a queued job for the user is older
+    than SEARCH_JOB_TIMEOUT seconds, so the caller should not wait for it.
+    """
+    timeout = getattr(settings, 'SEARCH_JOB_TIMEOUT', 60)
+    queued = unixtime()
+
+    if not cache.add(QUEUED_KEY.format(user_id), queued, timeout * 10):
+        return cache.get(QUEUED_KEY.format(user_id), 0) + timeout > queued
+
+    job = {'user_id': user_id, 'order_by': order_by, 'force': force,
+           'queued': queued}
+    get_queue_connection().lpush(QUEUE_KEY, json.dumps(job))
+    incr_stat('queued')
+    return True
+
+
+def get_search_job(timeout=5):
+    """
+    Return the next queued job as a dict, waiting for up to "timeout"
+    seconds, or None if there is none.
+    """
+    item = get_queue_connection().brpop(QUEUE_KEY, timeout)
+    if item is None:
+        return None
+    return json.loads(item[1])
+
+
+def finish_search_job(job, started, failed=False):
+    """Remove the user's queued marker and count the finished job."""
+    cache.delete(QUEUED_KEY.format(job['user_id']))
+    incr_stat('failed' if failed else 'done')
+    incr_stat('wait_ms', int((started - job['queued']) * 1000))
+    incr_stat('run_ms', int((unixtime() - started) * 1000))
+
+
+# noinspection PyUnusedLocal
+@receiver(user_logged_in)
+def queue_search_job_on_login(sender, request, user, **kwargs):
+    if getattr(settings, 'SEARCH_ASYNC', False):
+        queue_search_job(user.id, request.session.get(
+            'search_results_order', ''))
@@ -1,11 +1,24 @@
+import threading
 import pytz
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from datetime import time as dt_time
-from django.db.models import Count
+from time import time as unixtime
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Q
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
-from dtr5app.models import Flag
+from dtr5app.models import Flag, Match, Profile
+from dtr5app.utils_activity import count_active_users
+
+# Time windows of the "active users" stats, name and minutes.
+ACTIVE_WINDOWS = (('1m', 1), ('5m', 5), ('15m', 15), ('1h', 60),
+                  ('24h', 24 * 60), ('7d', 7 * 24 * 60), ('30d', 30 * 24 * 60),
+                  ('90d', 90 * 24 * 60), ('1y', 356 * 24 * 60))
+SNAPSHOT_KEY = 'stats:snapshot'
+SNAPSHOT_LOCK_KEY = 'stats:snapshot_lock'
 
 
 def get_users_by_sex():
@@ -76,17 +89,103 @@ def get_nopes_count():
 
 def get_matches_count():
     """Return the total number of matches (mututal likes)."""
-
-    return ''
-    """
-    TODO: count matches
-    dtr5app_flag.sender
-    dtr5app_flag.receiver
-    dtr5app_flag.flag
-    """
+    return Match.objects.count() // 2
 
 
 def get_active_users(mins):
     """Return number of users active over the past "mins" minutes."""
+    count = count_active_users(mins * 60)
+    if count is not None:
+        return count
+
+    # Older activity is only in the database, accurate to the last flush.
     min_dt = now() - timedelta(minutes=mins)
     return User.objects.filter(profile__accessed__gte=min_dt).count()
+
+
+def get_flags_counts():
+    """Return a dict with the total numbers of likes and nopes."""
+    return Flag.objects.aggregate(
+        likes=Count('pk', filter=Q(flag=Flag.LIKE_FLAG)),
+        nopes=Count('pk', filter=Q(flag=Flag.NOPE_FLAG)))
+
+
+def get_active_users_counts(windows=ACTIVE_WINDOWS):
+    """
+    Return a dict with the number of active users for each of the named
+    time windows. Windows that are not counted live by count_active_users()
+    are all counted in one pass over the profiles.
+    """
+    counts, db_windows = {}, {}
+    for name, mins in windows:
+        count = count_active_users(mins * 60)
+        if count is None:
+            db_windows[name] = now() - timedelta(minutes=mins)
+        else:
+            counts[name] = count
+
+    if db_windows:
+        qs = Profile.objects.filter(accessed__gte=min(db_windows.values()))
+        counts.update(qs.aggregate(**{
+            name: Count('pk', filter=Q(accessed__gte=min_dt))
+            for name, min_dt in db_windows.items()}))
+
+    return counts
+
+
+def build_stats_snapshot():
+    """Return a dict with all values shown on the stats page."""
+    today = date.today()
+    flags = get_flags_counts()
+    snapshot = {
+        'now_utc': now(),
+        'users_by_sex': get_users_by_sex(),
+        'likes_count': flags['likes'],
+        'nopes_count': flags['nopes'],
+        'matches_count': get_matches_count(),
+        'signups_per_day': list(get_signups_per_day_for_range(
+            today - timedelta(days=30), today)),
+    }
+    for name, count in get_active_users_counts().items():
+        snapshot['users_active_' + name] = count
+    return snapshot
+
+
+def refresh_stats_snapshot():
+    """Build a new stats snapshot and store it in the cache."""
+    mt = getattr(settings, 'STATS_CACHE_TIMEOUT', 60)
+    snapshot = build_stats_snapshot()
+    # Keep it longer than its timeout, to show while it is refreshed.
+    cache.set(SNAPSHOT_KEY, (unixtime(), snapshot), mt * 10)
+    return snapshot
+
+
+def _refresh_stats_snapshot():
+    try:
+        refresh_stats_snapshot()
+    finally:
+        cache.delete(SNAPSHOT_LOCK_KEY)
+        connection.close()
+
+
+def get_stats_snapshot():
+    """
+    Return the cached stats snapshot. Build it now, if there is none yet,
+    or start a refresh in the background, if it is older than
+    STATS_CACHE_TIMEOUT seconds.
+    """
+    mt = getattr(settings, 'STATS_CACHE_TIMEOUT', 60)
+    cached = cache.get(SNAPSHOT_KEY)
+
+    if cached is None:
+        if settings.DEBUG:
+            print('get_stats_snapshot() --> No snapshot, build it now!')
+        return refresh_stats_snapshot()
+
+    created, snapshot = cached
+    if created + mt < unixtime() and cache.add(SNAPSHOT_LOCK_KEY, 1, mt):
+        if settings.DEBUG:
+            print('get_stats_snapshot() --> Snapshot timeout, refresh!')
+        threading.Thread(target=_refresh_stats_snapshot, daemon=True).start()
+
+    return snapshot
@@ -0,0 +1,216 @@
+"""
+Synthetic users, to measure the site at a realistic scale, see the
+"make_synthetic_data" and "run_benchmark" commands.
+
+All synthetic usernames begin with SYNTHETIC_PREFIX and all synthetic
+subreddit ids with SYNTHETIC_SR_PREFIX, so they can be deleted again without
+touching real data. Users live around a few large cities, and subscribe to
+subreddits with Zipf distributed popularity, like on reddit, where a few
+default subs have most of the subscribers.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils.timezone import now
+
+from dtr5app.models import (Conversation, Flag, Message, Profile, Sr,
+                            Subscribed, Visit)
+from dtr5app.utils import (count_subscribers_here, rebuild_matches,
+                           update_sr_weights)
+from toolbox import get_geo_cell
+
+SYNTHETIC_PREFIX = 'synth_'
+SYNTHETIC_SR_PREFIX = 'S'  # real subreddit ids are lowercase base36
+# Cities as (lat, lng, share of users). The remaining users are spread
+# evenly over the world.
+CITIES = (
+    (40.71, -74.01, 0.15), (34.05, -118.24, 0.10), (51.51, -0.13, 0.10),
+    (52.52, 13.40, 0.08), (48.86, 2.35, 0.07), (43.65, -79.38, 0.06),
+    (-33.87, 151.21, 0.05), (41.88, -87.63, 0.05), (59.33, 18.07, 0.04),
+    (35.68, 139.69, 0.04))
+CITY_SPREAD = 1.5  # standard deviation in degrees around a city
+
+
+def get_zipf_probabilities(n, exponent=1.1):
+    """Return the probabilities of ranks 1 to n of a Zipf distribution."""
+    p = 1.0 / np.arange(1, n + 1) ** exponent
+    return p / p.sum()
+
+
+def get_locations(rng, n):
+    """Return arrays of n lat and n lng values."""
+    shares = np.array([x[2] for x in CITIES] + [1 - sum(x[2] for x in CITIES)])
+    city = rng.choice(len(shares), size=n, p=shares)
+    lat = rng.uniform(-60, 70, n)
+    lng = rng.uniform(-180, 180, n)
+
+    in_city = city < len(CITIES)
+    centers = np.array([x[:2] for x in CITIES])[city[in_city]]
+    lat[in_city] = centers[:, 0] + rng.normal(0, CITY_SPREAD, in_city.sum())
+    lng[in_city] = centers[:, 1] + rng.normal(0, CITY_SPREAD, in_city.sum())
+    return np.clip(lat, -90, 90), (lng + 180) % 360 - 180
+
+
+def get_pairs(rng, user_ids, target_ids, per_user, p=None):
+    """
+    Return a list of unique (user_id, target_id) tuples, with about per_user
+    random targets for every user, drawn with probabilities p.
+    """
+    if not per_user or not len(target_ids):
+        return []
+    counts = rng.poisson(per_user, len(user_ids))
+    users = np.repeat(np.asarray(user_ids), counts)
+    targets = np.asarray(target_ids)[
+        rng.choice(len(target_ids), size=len(users), p=p)]
+    return sorted({(int(a), int(b) if isinstance(b, np.integer) else str(b))
+                   for a, b in zip(users, targets) if a != b})
+
+
+def create_synthetic_srs(n_srs):
+    """Create the synthetic subreddits, in order of popularity."""
+    t = now()
+    Sr.objects.bulk_create([Sr(
+        id='{}{:x}'.format(SYNTHETIC_SR_PREFIX, i),
+        name='{}sr{}'.format(SYNTHETIC_PREFIX, i),
+        display_name='{}sr{}'.format(SYNTHETIC_PREFIX, i),
+        url='/r/{}sr{}/'.format(SYNTHETIC_PREFIX, i),
+        created=t.date(),
+        subscribers=max(1000000 // (i + 1), 10),
+    ) for i in range(n_srs)], ignore_conflicts=True)
+    return ['{}{:x}'.format(SYNTHETIC_SR_PREFIX, i) for i in range(n_srs)]
+
+
+def create_synthetic_users(rng, first, n):
+    """
+    Create n synthetic users with their profiles, numbered from first on.
+    Return the list of their user ids.
+    """
+    t = now()
+    accessed = rng.exponential(3 * 24 * 3600, n)  # seconds ago
+    users = User.objects.bulk_create([User(
+        username='{}{}'.format(SYNTHETIC_PREFIX, first + i),
+        date_joined=t - timedelta(seconds=float(accessed[i]) + 3600),
+        last_login=t - timedelta(seconds=float(accessed[i])),
+    ) for i in range(n)])
+
+    lat, lng = get_locations(rng, n)
+    sex = rng.choice([x[0] for x in settings.SEX], size=n)
+    dob = rng.integers(18 * 365, 60 * 365, n)  # days old
+    distance = rng.choice((0, 50, 200, 1000), size=n)
+    Profile.objects.bulk_create([Profile(
+        user=u,
+        name=u.username[:20],
+        created=(t - timedelta(days=int(dob[i]) // 3)).date(),
+        accessed=u.last_login,
+        search_updated=t,
+        dob=date.today() - timedelta(days=int(dob[i])),
+        sex=int(sex[i]),
+        lat=float(lat[i]),
+        lng=float(lng[i]),
+        geo_cell=get_geo_cell(float(lat[i]), float(lng[i])),
+        f_distance=int(distance[i]),
+    ) for i, u in enumerate(users)])
+    return [u.id for u in users]
+
+
+def create_synthetic_messages(pairs, t, batch_size):
+    """
+    Create one unread message from a to b for each (a, b) in pairs, with
+    their conversations. None of the pairs may have a conversation yet.
+    """
+    conversations = {}
+    for a, b in pairs:
+        pair = (min(a, b), max(a, b))
+        if pair not in conversations:
+            conversations[pair] = Conversation(
+                user1_id=pair[0], user2_id=pair[1], created=t,
+                last_message_at=t)
+        unread = 'user1_unread' if b == pair[0] else 'user2_unread'
+        setattr(conversations[pair], unread,
+                getattr(conversations[pair], unread) + 1)
+    Conversation.objects.bulk_create(conversations.values(),
+                                     batch_size=batch_size)
+
+    messages = Message.objects.bulk_create([
+        Message(sender_id=a, receiver_id=b, created=t,
+                conversation=conversations[(min(a, b), max(a, b))],
+                msg='Synthetic message {}.'.format(i))
+        for i, (a, b) in enumerate(pairs)], batch_size=batch_size)
+    for message in messages:
+        message.conversation.last_message_id = message.id
+    Conversation.objects.bulk_update(conversations.values(),
+                                     ['last_message_id'],
+                                     batch_size=batch_size)
+
+
+def make_synthetic_data(users=10000, srs=2000, subs_per_user=25,
+                        flags_per_user=10, visits_per_user=10,
+                        messages_per_user=5, seed=0, batch_size=5000):
+    """
+    Add a synthetic population of "users" users to the database, with their
+    profiles, subscriptions, flags, visits and messages. The numbers per user
+    are averages. Users of earlier runs are kept, and the new ones flag,
+    visit and message them too. Return the number of users created.
+    """
+    rng = np.random.default_rng(seed)
+    t = now()
+    sr_ids = create_synthetic_srs(srs)
+    sr_p = get_zipf_probabilities(len(sr_ids))
+
+    first = User.objects.filter(username__startswith=SYNTHETIC_PREFIX).count()
+    all_ids = list(User.objects.filter(username__startswith=SYNTHETIC_PREFIX)
+                               .values_list('id', flat=True))
+
+    for offset in range(0, users, batch_size):
+        n = min(batch_size, users - offset)
+        with transaction.atomic():
+            user_ids = create_synthetic_users(rng, first + offset, n)
+            all_ids += user_ids
+
+            Subscribed.objects.bulk_create([
+                Subscribed(user_id=user_id, sr_id=sr_id)
+                for user_id, sr_id in get_pairs(
+                    rng, user_ids, sr_ids, subs_per_user, sr_p)],
+                batch_size=batch_size, ignore_conflicts=True)
+
+            pairs = get_pairs(rng, user_ids, all_ids, flags_per_user)
+            flags = rng.choice((Flag.LIKE_FLAG, Flag.NOPE_FLAG),
+                               size=len(pairs), p=(0.7, 0.3))
+            Flag.objects.bulk_create([
+                Flag(sender_id=a, receiver_id=b, flag=int(flag), created=t)
+                for (a, b), flag in zip(pairs, flags)],
+                batch_size=batch_size, ignore_conflicts=True)
+
+            Visit.objects.bulk_create([
+                Visit(visitor_id=a, host_id=b, created=t)
+                for a, b in get_pairs(rng, user_ids, all_ids,
+                                      visits_per_user)],
+                batch_size=batch_size)
+
+            create_synthetic_messages(get_pairs(
+                rng, user_ids, all_ids, messages_per_user), t, batch_size)
+
+        if settings.DEBUG:
+            print('make_synthetic_data() --> {} users'.format(offset + n))
+
+    count_subscribers_here(sr_ids)
+    update_sr_weights(refresh=True)
+    rebuild_matches()
+    return users
+
+
+def delete_synthetic_data():
+    """
+    Delete all synthetic users and subreddits, with all their data. Return
+    the number of users deleted.
+    """
+    _, counts = User.objects.filter(
+        username__startswith=SYNTHETIC_PREFIX).delete()
+    Sr.objects.filter(id__startswith=SYNTHETIC_SR_PREFIX,
+                      name__startswith=SYNTHETIC_PREFIX).delete()
+    count_subscribers_here()
+    update_sr_weights(refresh=True)
+    return counts.get('auth.User', 0)
@@ -0,0 +1,104 @@
+"""
+The recent visitors of every user's profile page.
+
+Visit rows are the complete log, with one row per visitor and host that is
+upserted on every profile view. Additionally, a sorted set "visitor id ->
+unix time" per host in the Redis server of the default cache holds the
+VISITORS_LIST_MAX most recent visitors, so that the visitors list is read
+with one ZREVRANGE, and the users of a page with one query. A missing or
+expired sorted set is rebuilt from the Visit rows. The set of a host without
+any visitors holds only the NO_VISITORS member, so that it isn't rebuilt on
+every request.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.timezone import now
+from pytz import utc
+
+from dtr5app.models import Visit
+
+VISITORS_KEY = 'visitors:{}'
+NO_VISITORS = b'none'  # the only member of an empty list of visitors
+
+
+def get_visitors_connection():
+    # Imported here, so that other cache backends work without django_redis.
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def rebuild_recent_visitors(host_id):
+    """
+    Set the sorted set of host_id's recent visitors from the Visit rows,
+    and return them as a list of (visitor_id, unix time), most recent first.
+    """
+    max_len = getattr(settings, 'VISITORS_LIST_MAX', 1000)
+    visits = [(visitor_id, created.timestamp()) for visitor_id, created in
+              Visit.objects.filter(host_id=host_id, hidden=False)
+                           .order_by('-created')
+                           .values_list('visitor_id', 'created')[:max_len]]
+
+    key = VISITORS_KEY.format(host_id)
+    pipe = get_visitors_connection().pipeline()
+    pipe.delete(key)
+    pipe.zadd(key, dict(visits) or {NO_VISITORS: 0})
+    pipe.expire(key, getattr(settings, 'VISITORS_TIMEOUT', 30 * 86400))
+    pipe.execute()
+    return visits
+
+
+def add_visit(visitor, host):
+    """
+    Remember the visit of visitor to host's profile page, with one upsert
+    query and one Redis round trip. Only if host's sorted set was missing,
+    it is rebuilt from the Visit rows, with another query and round trip.
+    """
+    created = Visit.add_visitor_host(visitor, host, now())
+    key = VISITORS_KEY.format(host.id)
+    max_len = getattr(settings, 'VISITORS_LIST_MAX', 1000)
+    pipe = get_visitors_connection().pipeline(transaction=False)
+    pipe.exists(key)
+    pipe.zadd(key, {visitor.id: created.timestamp()})
+    pipe.zrem(key, NO_VISITORS)
+    pipe.zremrangebyrank(key, 0, -max_len - 1)
+    pipe.expire(key, getattr(settings, 'VISITORS_TIMEOUT', 30 * 86400))
+    existed = pipe.execute()[0]
+    if not existed:  # the new set only holds this visit, add all the others
+        rebuild_recent_visitors(host.id)
+
+
+def get_recent_visitors(host_id):
+    """
+    Return a list of (visitor_id, visit time) of the most recent visitors
+    of host_id, most recent first.
+    """
+    rows = get_visitors_connection().zrevrange(
+        VISITORS_KEY.format(host_id), 0, -1, withscores=True)
+    if rows:
+        visits = [(int(visitor_id), ts) for visitor_id, ts in rows
+                  if visitor_id != NO_VISITORS]
+    else:
+        visits = rebuild_recent_visitors(host_id)
+    return [(visitor_id, datetime.fromtimestamp(ts, tz=utc))
+            for visitor_id, ts in visits]
+
+
+def get_visitors_list(visits):
+    """
+    Return the User objects of visits, a list of (visitor_id, visit time),
+    with their profiles and a "visit_created" attribute, in the same order.
+    Visitors who deleted their account or were banned are left out.
+    """
+    users = User.objects.filter(
+        id__in=[visitor_id for visitor_id, _ in visits],
+        is_active=True, last_login__isnull=False,
+    ).select_related('profile').in_bulk()
+
+    user_list = []
+    for visitor_id, created in visits:
+        if visitor_id in users:
+            users[visitor_id].visit_created = created
+            user_list.append(users[visitor_id])
+    return user_list
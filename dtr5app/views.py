@@ -1,6 +1,5 @@
-from datetime import datetime, timedelta, date
+from datetime import date
 
-import pytz
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -12,27 +11,27 @@ from django.http import (
     HttpResponseRedirect,
 )
 from django.shortcuts import redirect, render, get_object_or_404
+from django.views.decorators.cache import cache_control
 from django.views.decorators.http import require_http_methods
 
 from simple_reddit_oauth import api
 from toolbox import force_int
-from . import utils_stats
-from .models import Sr, Flag, Visit
+from . import utils_map, utils_stats
+from .models import Sr, Flag
 from .utils import (
     add_auth_user_latlng,
     count_matches,
     get_matches_user_list,
-    get_prevnext_user,
     get_user_and_related_or_404,
     get_paginated_user_list,
     prepare_paginated_user_list,
-    add_matches_to_user_list,
-    get_user_list_from_username_list,
-    get_user_list_after,
-    add_likes_sent,
-    add_likes_recv,
+    get_user_list_from_id_list,
+    get_user_navigation,
+    add_relationship_flags,
     get_subs_for_user,
 )
+from .utils_counters import incr_profile_counters
+from .utils_visitors import add_visit, get_recent_visitors, get_visitors_list
 from .utils_search import search_results_buffer, search_subreddit_users
 
 
@@ -54,13 +53,11 @@ def results_view(request, template_name="dtr5app/results.html"):
     pg = int(request.GET.get("page", 1))
     order_by = request.session.get("search_results_order", "")
 
-    search_results_buffer(request)
-    ul = request.session["search_results_buffer"]
-    ul = prepare_paginated_user_list(ul, pg)
-    ul.object_list = get_user_list_from_username_list(ul.object_list)
+    buff = search_results_buffer(request)
+    ul = prepare_paginated_user_list(buff, pg)
+    ul.object_list = get_user_list_from_id_list(ul.object_list)
     ul.object_list = add_auth_user_latlng(request.user, ul.object_list)
-    ul.object_list = add_likes_sent(ul.object_list, request.user)
-    ul.object_list = add_likes_recv(ul.object_list, request.user)
+    ul.object_list = add_relationship_flags(ul.object_list, request.user)
 
     sr_names = []
     for row in request.user.subs.all().prefetch_related("sr"):
@@ -68,7 +65,12 @@ def results_view(request, template_name="dtr5app/results.html"):
         fav = 1 if row.is_favorite else 0
         sr_names.append({"name": row.sr.display_name, "fav": fav})
 
-    ctx = {"user_list": ul, "order_by": order_by, "sr_names": sr_names}
+    ctx = {
+        "user_list": ul,
+        "order_by": order_by,
+        "sr_names": sr_names,
+        "refreshing": buff.refreshing,
+    }
     return render(request, template_name, ctx)
 
 
@@ -94,16 +96,10 @@ def profile_view(request, username, template_name="dtr5app/profile.html"):
     setattr(view_user, "pics_list", view_user.profile.pics[:10])
     view_user.pics_list += [None] * (10 - len(view_user.pics_list))
 
-    # Get the next five users to be displayed at the end of the profile page.
-    search_results_buffer(request)
-    user_list = get_user_list_after(request, view_user, 5)
-
-    # Find previous and next user on the list, relative to view user.
-    prev_user, next_user = get_prevnext_user(request, view_user)
-    if not prev_user and user_list:
-        prev_user = user_list[-1]
-    if not next_user and user_list:
-        next_user = user_list[0]
+    # Find previous and next user on the list, relative to view user, and
+    # the next five users to be displayed at the end of the profile page.
+    buff = search_results_buffer(request)
+    prev_user, next_user, user_list = get_user_navigation(buff, view_user, 5)
 
     # Count the profile view, unless auth user is viewing their own profile.
     if request.user.pk != view_user.pk:
@@ -114,13 +110,11 @@ def profile_view(request, username, template_name="dtr5app/profile.html"):
         try:
             request.session["last_viewed_users"].remove(view_user.pk)
         except ValueError:
-            view_user.profile.views_count += 1
-            view_user.profile.new_views_count += 1
-            view_user.profile.save(update_fields=["views_count", "new_views_count"])
+            incr_profile_counters(view_user.id, views_count=1, new_views_count=1)
         request.session["last_viewed_users"].append(view_user.pk)
 
         # remember the view for visitor history
-        Visit.add_visitor_host(request.user, view_user)
+        add_visit(request.user, view_user)
 
     # there was an error with the "created" timestamp handling, so some were
     # set to "0", i.e. Epoch time 1970-01-01. Filter those out.
@@ -195,9 +189,7 @@ def sr_view(request, sr, template_name="dtr5app/sr.html"):
 
     # Paginate and add "is_like_recv" and "is_like"sent"
     ul = get_paginated_user_list(ul, pg, request.user)
-    ul.object_list = add_likes_sent(ul.object_list, request.user)
-    ul.object_list = add_likes_recv(ul.object_list, request.user)
-    ul.object_list = add_matches_to_user_list(ul.object_list, request.user)
+    ul.object_list = add_relationship_flags(ul.object_list, request.user)
 
     ctx = {
         "view_sr": view_sr,
@@ -232,37 +224,18 @@ def viewed_me_view(request, template_name="dtr5app/viewed_me.html"):
     """
     pg = int(request.GET.get("page", 1))
 
-    # fetch last 1000 visitors list
-    vl = (
-        request.user.was_visited.filter(
-            visitor__last_login__isnull=False, visitor__is_active=True, hidden=False
-        )
-        .order_by("-visitor")
-        .distinct("visitor")
-        .prefetch_related("visitor")
-        .values_list("visitor__username", "created")[:1000]
-    )
-
-    # fetch the User qs
-    ul = User.objects.filter(username__in=[x[0] for x in vl])
-    ul = get_paginated_user_list(ul, pg, request.user)
-    ul.object_list = add_likes_sent(ul.object_list, request.user)
-    ul.object_list = add_likes_recv(ul.object_list, request.user)
-    ul.object_list = add_matches_to_user_list(ul.object_list, request.user)
-
-    # attach "visited" property to each user
-    for u in ul.object_list:
-        try:
-            v = [x[1] for x in vl if x[0] == u.username][0]
-            setattr(u, "visit_created", v)
-        except IndexError:
-            setattr(u, "visit_created", None)
+    # Paginate the recent visitors, most recent first, and fetch only the
+    # users of the page, with their "visit_created" time.
+    ul = prepare_paginated_user_list(get_recent_visitors(request.user.id), pg)
+    ul.object_list = get_visitors_list(ul.object_list)
+    ul.object_list = add_auth_user_latlng(request.user, ul.object_list)
+    ul.object_list = add_relationship_flags(ul.object_list, request.user)
 
     # Reset the new_views_count value
     request.user.profile.new_views_count = 0
     request.user.profile.save(update_fields=["new_views_count"])
 
-    ctx = {"user_list": sorted(ul, key=lambda x: x.visit_created, reverse=True)}
+    ctx = {"user_list": ul}
 
     return render(request, template_name, ctx)
 
@@ -279,7 +252,7 @@ def likes_sent_view(request, template_name="dtr5app/likes_sent.html"):
         flags_received__sender=request.user, flags_received__flag=Flag.LIKE_FLAG
     ).prefetch_related("profile")
     ul = get_paginated_user_list(ul, pg, request.user)
-    ul.object_list = add_matches_to_user_list(ul.object_list, request.user)
+    ul.object_list = add_relationship_flags(ul.object_list, request.user)
 
     ctx = {"user_list": ul}
 
@@ -312,7 +285,7 @@ def likes_recv_view(request, template_name="dtr5app/likes_recv.html"):
     )
 
     ul = get_paginated_user_list(ul, pg, request.user)
-    ul.object_list = add_matches_to_user_list(ul.object_list, request.user)
+    ul.object_list = add_relationship_flags(ul.object_list, request.user)
 
     # Reset the "new_likes_count" value
     request.user.profile.new_likes_count = 0
@@ -349,26 +322,7 @@ def matches_view(request, template_name="dtr5app/matches.html"):
 
 
 def stats_view(request, template_name="dtr5app/stats.html"):
-
-    ctx = {
-        "users_by_sex": utils_stats.get_users_by_sex(),
-        "likes_count": utils_stats.get_likes_count(),
-        "nopes_count": utils_stats.get_nopes_count(),
-        "matches_count": utils_stats.get_matches_count(),
-        # active users in the past 1, 5, and 15 minutes
-        "users_active_1m": utils_stats.get_active_users(1),
-        "users_active_5m": utils_stats.get_active_users(5),
-        "users_active_15m": utils_stats.get_active_users(15),
-        "users_active_1h": utils_stats.get_active_users(60),  # past hour
-        "users_active_24h": utils_stats.get_active_users(24 * 60),  # past 24h
-        "users_active_7d": utils_stats.get_active_users(7 * 24 * 60),  # past 7d
-        "users_active_30d": utils_stats.get_active_users(30 * 24 * 60),  # past 30d
-        "users_active_90d": utils_stats.get_active_users(90 * 24 * 60),  # past 90d
-        "users_active_1y": utils_stats.get_active_users(356 * 24 * 60),  # past 1y
-        "signups_per_day": utils_stats.get_signups_per_day_for_range(
-            (date.today() - timedelta(days=30)), date.today()
-        ),
-    }
+    ctx = utils_stats.get_stats_snapshot()
 
     return render(request, template_name, ctx)
 
@@ -376,39 +330,20 @@ def stats_view(request, template_name="dtr5app/stats.html"):
 @login_required
 @require_http_methods(["GET"])
 def usermap_view(request, template_name="dtr5app/usermap.html"):
-    if request.is_ajax():
-        west = request.GET.get("west", None)
-        south = request.GET.get("south", None)
-        east = request.GET.get("east", None)
-        north = request.GET.get("north", None)
-        t = force_int(request.GET.get("t", 0))
-
-        if settings.DEBUG:
-            print(west, north, east, south, t)
-
-        users = User.objects.exclude(
-            profile__lat__gte=-0.1,
-            profile__lng__gte=-0.1,
-            profile__lat__lte=1.1,
-            profile__lng__lte=1.1,
-        ).filter(
-            profile__lat__gte=south,
-            profile__lng__gte=west,
-            profile__lat__lte=north,
-            profile__lng__lte=east,
-            is_active=True,
-            last_login__isnull=False,
-        )
-
-        if t > 0:
-            tmin = datetime.now().replace(tzinfo=pytz.utc) - timedelta(minutes=t)
-            users = users.filter(profile__accessed__gte=tmin)
+    return render(request, template_name)
 
-        users = [
-            [u.username, u.profile.lat, u.profile.lng]
-            for u in users.prefetch_related("profile")[:250]
-        ]
 
-        return JsonResponse({"users": users})
+@login_required
+@require_http_methods(["GET"])
+@cache_control(private=True, max_age=60)
+def usermap_tile_view(request, z, x, y):
+    """
+    Return the user clusters, or the single users at high zoom levels, of
+    map tile z/x/y, see utils_map.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if z > utils_map.MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404
 
-    return render(request, template_name)
+    t = force_int(request.GET.get("t", 0), min=0)
+    return JsonResponse(utils_map.get_map_tile(z, x, y, t))
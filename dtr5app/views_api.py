@@ -19,10 +19,11 @@ from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 
 from dtr5app.models import (
-    Visit,
     Sr,
     Flag,
+    Match,
     PushNotificationEndpoint,
+    Conversation,
     Message,
     Subscribed,
 )
@@ -30,32 +31,39 @@ from dtr5app.serializers import (
     SubscribedSerializer,
     AuthUserSerializer,
     BasicUserSerializer,
+    basic_user_list_data,
+    basic_user_list_data_by_ids,
+    get_basic_user_columns,
+    get_basic_user_data,
     ViewUserSerializer,
     ViewSrSerializer,
     MessageSerializer,
 )
 from dtr5app.templatetags.dtr5tags import prefdist
 from dtr5app.utils import (
-    add_likes_sent,
-    add_likes_recv,
-    add_matches_to_user_list,
+    add_relationship_flags,
     add_auth_user_latlng,
     get_user_and_related_or_404,
-    get_user_list_from_username_list,
-    get_user_list_after,
-    get_prevnext_user,
+    get_user_navigation,
     prepare_paginated_user_list,
     get_paginated_user_list,
-    get_matches_user_list,
     count_matches,
     update_list_of_subscribed_subreddits,
 )
+from dtr5app.utils_counters import incr_profile_counters
+from dtr5app.utils_pagination import get_approximate_count, get_keyset_page
 from dtr5app.utils_push_notifications import simple_push_notification
 from dtr5app.utils_search import (
+    get_search_key,
     search_results_buffer,
     update_search_settings,
     search_subreddit_users,
 )
+from dtr5app.utils_visitors import (
+    add_visit,
+    get_recent_visitors,
+    get_visitors_list,
+)
 from simple_reddit_oauth import api
 from toolbox import force_int
 
@@ -84,16 +92,14 @@ def filter_members_view(request):
     ul = User.objects.filter(username__in=usernames).prefetch_related("profile")[:50]
 
     if request.user.is_authenticated:
-        ul = add_likes_sent(ul, request.user)
-        ul = add_likes_recv(ul, request.user)
-        ul = add_matches_to_user_list(ul, request.user)
+        ul = add_relationship_flags(ul, request.user)
         ul = add_auth_user_latlng(request.user, ul)
 
     response_data = []
     for user in ul:
         item = {
             "name": user.username,
-            "pic": user.profile.pics[0]["url"] if user.profile.pics else "",
+            "pic": user.profile.primary_pic_url,
             "sex_symbol": user.profile.get_sex_symbol(),
             "sex": user.profile.get_sex_display(),
             "age": user.profile.get_age(),
@@ -114,7 +120,15 @@ def filter_members_view(request):
     ["GET",]
 )
 def sr_user_list(request, sr, format=None):
-    """Return a list of users who are member of a subreddit."""
+    """
+    Return a list of users who are member of a subreddit.
+
+    With a "cursor" parameter, the list is cursor paginated, but only in the
+    order of "-date_joined". Last login, last activity, and views change all
+    the time, and a cursor after such a value would repeat or skip users
+    whose value changed between two pages, so with these orders the list is
+    always paginated by page number.
+    """
     pg = int(request.GET.get("page", 1))
     view_sr = get_object_or_404(Sr, display_name__iexact=sr)
 
@@ -153,15 +167,25 @@ def sr_user_list(request, sr, format=None):
     elif params["order"] == "-views_count":  # most views first
         ul = ul.order_by("-profile__views_count")
 
-    # Paginate and add "is_like_recv" and "is_like"sent"
-    ul = get_paginated_user_list(ul, pg, request.user)
-    ul.object_list = add_likes_sent(ul.object_list, request.user)
-    ul.object_list = add_likes_recv(ul.object_list, request.user)
-    ul.object_list = add_matches_to_user_list(ul.object_list, request.user)
+    if "cursor" in request.GET and params["order"] == "-date_joined":
+        # Count the members that are shown with these search options, not
+        # all members of the subreddit.
+        name = "sr_user_list:{}".format(
+            get_search_key([view_sr.id], params, "")
+        )
+        count = get_approximate_count(name, ul)
+        data = get_keyset_user_list(
+            request, ul, ("-date_joined", "-id"), count
+        )
+        data["view_sr"] = ViewSrSerializer(view_sr, many=False).data
+        return Response(data=data)
+
+    # Paginate, the page's object_list is still a queryset.
+    ul = prepare_paginated_user_list(ul, pg)
 
     return Response(
         data={
-            "user_list": BasicUserSerializer(ul.object_list, many=True).data,
+            "user_list": basic_user_list_data(ul.object_list),
             "view_sr": ViewSrSerializer(view_sr, many=False).data,
         }
     )
@@ -185,12 +209,12 @@ def search_params(request):
     # Save search options from request.POST
     update_search_settings(request)
     # Then force a search results buffer refresh
-    search_results_buffer(request, force=True)
+    buff = search_results_buffer(request, force=True)
     # If no profiles found, return a 404 from here
-    if len(request.session["search_results_buffer"]) < 1:
+    if len(buff) < 1 and not buff.refreshing:
         return HttpResponseNotFound()  # 404
-    # Otherwise return Found
-    return JsonResponse({})  # HTTP 200
+    # Otherwise return Found, and if the search worker is still busy
+    return JsonResponse({"refreshing": buff.refreshing})  # HTTP 200
 
 
 @csrf_exempt
@@ -205,24 +229,23 @@ def results_list(request, format=None):
     """
     pg = int(request.GET.get("page", 1))
     if pg == 1:
-        update_search_if_changed(request.GET, request.user, request.session)
-        search_results_buffer(request, force=True)
+        # Only run a full search if the search options changed, otherwise
+        # merge recently changed users into the results.
+        changed = update_search_if_changed(
+            request.GET, request.user, request.session
+        )
+        buff = search_results_buffer(request, force=changed, refresh=True)
     else:
-        search_results_buffer(request)
-
-    ul = request.session["search_results_buffer"]
-    ul = prepare_paginated_user_list(ul, pg)
+        buff = search_results_buffer(request)
 
-    ul.object_list = get_user_list_from_username_list(ul.object_list)
-    ul.object_list = add_auth_user_latlng(request.user, ul.object_list)
-    ul.object_list = add_likes_sent(ul.object_list, request.user)
-    ul.object_list = add_likes_recv(ul.object_list, request.user)
+    ul = prepare_paginated_user_list(buff, pg)
 
     return Response(
         data={
             "count": ul.paginator.count,
             "num_pages": ul.paginator.num_pages,
-            "user_list": BasicUserSerializer(ul.object_list, many=True).data,
+            "refreshing": buff.refreshing,
+            "user_list": basic_user_list_data_by_ids(ul.object_list),
         }
     )
 
@@ -256,16 +279,10 @@ def user_detail(request, username, format=None):
     setattr(view_user, "pics_list", view_user.profile.pics[:10])
     view_user.pics_list += [None] * (10 - len(view_user.pics_list))
 
-    # Get the next five users to be displayed at the end of the profile page.
-    search_results_buffer(request)
-    user_list = get_user_list_after(request, view_user, 5)
-
-    # Find previous and next user on the list, relative to view user.
-    prev_user, next_user = get_prevnext_user(request, view_user)
-    if not prev_user and user_list:
-        prev_user = user_list[-1]
-    if not next_user and user_list:
-        next_user = user_list[0]
+    # Find previous and next user on the list, relative to view user, and
+    # the next five users to be displayed at the end of the profile page.
+    buff = search_results_buffer(request)
+    prev_user, next_user, user_list = get_user_navigation(buff, view_user, 5)
 
     # Count the profile view, unless auth user is viewing their own profile.
     if request.user.pk != view_user.pk:
@@ -276,13 +293,11 @@ def user_detail(request, username, format=None):
         try:
             request.session["last_viewed_users"].remove(view_user.pk)
         except ValueError:
-            view_user.profile.views_count += 1
-            view_user.profile.new_views_count += 1
-            view_user.profile.save(update_fields=["views_count", "new_views_count"])
+            incr_profile_counters(view_user.id, views_count=1, new_views_count=1)
         request.session["last_viewed_users"].append(view_user.pk)
 
         # remember the view for visitor history
-        Visit.add_visitor_host(request.user, view_user)
+        add_visit(request.user, view_user)
 
     # there was an error with the "created" timestamp handling, so some were
     # set to "0", i.e. Epoch time 1970-01-01. Filter those out.
@@ -396,20 +411,26 @@ def upvotes_recv_api(request, format=None):
         )
         .annotate(flag_created=F("flags_sent__created"))
         .exclude(pk__in=nopes_qs)
-        .order_by("-flags_sent__created")
-        .prefetch_related("profile")[:500]
     )
 
-    # user_list = get_paginated_user_list(user_list, pg, request.user)
-    # user_list.object_list = add_matches_to_user_list(user_list.object_list,
-    #                                                  request.user)
+    if "cursor" in request.GET:
+        count = get_approximate_count(
+            "upvotes_recv:{}".format(request.user.id), user_list
+        )
+        data = get_keyset_user_list(
+            request, user_list, ("-flag_created", "-id"), count,
+            flag_created="flag_created",
+        )
+    else:
+        user_list = user_list.order_by("-flags_sent__created")[:500]
+        data = {"user_list": basic_user_list_data(user_list)}
+
     # Reset the "new_likes_count" value
-    request.user.profile.new_likes_count = 0
-    request.user.profile.save(update_fields=["new_likes_count"])
+    if not request.GET.get("cursor"):
+        request.user.profile.new_likes_count = 0
+        request.user.profile.save(update_fields=["new_likes_count"])
 
-    return JsonResponse(
-        data={"user_list": BasicUserSerializer(user_list, many=True).data,}
-    )
+    return JsonResponse(data=data)
 
 
 @login_required
@@ -419,22 +440,34 @@ def matches_api(request, format=None):
     Show a page with all matches (i.e. mututal 'like' flags) of auth
     user and all other users.
     """
-    # pg = int(request.GET.get('page', 1))
-
-    # Get a list user_list ordered by match time, most recent first,
-    # including the additional property 'matched' with match timestamp.
-    user_list = get_matches_user_list(request.user)[:500]
-    # user_list = get_paginated_user_list(user_list, pg, request.user)
+    # Later cursor pages show the count of the first page.
+    if not request.GET.get("cursor"):
+        # Recount the total matches number to correct for countring errors.
+        request.user.profile.matches_count = count_matches(request.user)
+
+        # Reset the new_matches_count value
+        request.user.profile.new_matches_count = 0
+        request.user.profile.save(
+            update_fields=["matches_count", "new_matches_count"]
+        )
 
-    # Recount the total matches number to correct for countring errors.
-    request.user.profile.matches_count = count_matches(request.user)
+    # Get a list user_list ordered by match time, most recent first, with
+    # the match time as "flag_created".
+    matches = Match.objects.filter(user=request.user)
+    if "cursor" in request.GET:
+        data = get_keyset_user_list(
+            request, matches, ("-created", "-id"),
+            request.user.profile.matches_count,
+            prefix="match_user__", flag_created="created",
+        )
+    else:
+        data = {"user_list": basic_user_list_data(
+            matches.order_by("-created")[:500],
+            prefix="match_user__",
+            flag_created="created",
+        )}
 
-    # Reset the new_matches_count value
-    request.user.profile.new_matches_count = 0
-    request.user.profile.save(update_fields=["matches_count", "new_matches_count"])
-    return JsonResponse(
-        data={"user_list": BasicUserSerializer(user_list, many=True).data,}
-    )
+    return JsonResponse(data=data)
 
 
 @login_required
@@ -444,21 +477,23 @@ def upvotes_sent_api(request, format=None):
     Display a list of users liked by auth user, i.e. sent upvotes, including
     those that are "matches" (mutual upvotes).
     """
-    user_list = (
-        User.objects.filter(
-            flags_received__sender=request.user, flags_received__flag=Flag.LIKE_FLAG
+    user_list = User.objects.filter(
+        flags_received__sender=request.user, flags_received__flag=Flag.LIKE_FLAG
+    ).annotate(flag_created=F("flags_received__created"))
+
+    if "cursor" in request.GET:
+        count = get_approximate_count(
+            "upvotes_sent:{}".format(request.user.id), user_list
         )
-        .annotate(flag_created=F("flags_received__created"))
-        .prefetch_related("profile")
-        .order_by("-flags_received__created")[:500]
-    )
+        data = get_keyset_user_list(
+            request, user_list, ("-flag_created", "-id"), count,
+            flag_created="flag_created",
+        )
+    else:
+        user_list = user_list.order_by("-flags_received__created")[:500]
+        data = {"user_list": basic_user_list_data(user_list)}
 
-    # user_list = get_paginated_user_list(user_list, pg, request.user)
-    # user_list.object_list = add_matches_to_user_list(user_list.object_list,
-    #                                                  request.user)
-    return JsonResponse(
-        data={"user_list": BasicUserSerializer(user_list, many=True).data,}
-    )
+    return JsonResponse(data=data)
 
 
 @login_required
@@ -493,38 +528,31 @@ def visitors_api(request, format=None):
     """
     Display a list of users who recently viewed auth user's profile.
     """
-    # TODO Remove pagination and limit to 500 or so.
-    # TODO make sure order by visit time and add visit time to sericalized data
-
-    pg = int(request.GET.get("page", 1))
-
-    # fetch last 1000 visitors list
-    vl = (
-        request.user.was_visited.filter(
+    if "cursor" in request.GET:
+        # Most recent visit first, with the visit time as "flag_created".
+        visits = request.user.was_visited.filter(
             visitor__last_login__isnull=False, visitor__is_active=True, hidden=False
         )
-        .order_by("-visitor")
-        .distinct("visitor")
-        .prefetch_related("visitor")
-        .values_list("visitor__username", "created")[:1000]
-    )
+        count = get_approximate_count(
+            "visitors:{}".format(request.user.id), visits
+        )
+        data = get_keyset_user_list(
+            request, visits, ("-created", "-id"), count,
+            prefix="visitor__", flag_created="created",
+        )
+        if not request.GET.get("cursor"):
+            request.user.profile.new_views_count = 0
+            request.user.profile.save(update_fields=["new_views_count"])
+        return JsonResponse(data=data)
 
-    # fetch the User qs
-    user_list = User.objects.filter(username__in=[x[0] for x in vl])
-    user_list = get_paginated_user_list(user_list, pg, request.user)
-    user_list.object_list = add_likes_sent(user_list.object_list, request.user)
-    user_list.object_list = add_likes_recv(user_list.object_list, request.user)
-    user_list.object_list = add_matches_to_user_list(
-        user_list.object_list, request.user
-    )
-    # attach "visited" property to each user
-    for u in user_list.object_list:
-        try:
-            v = [x[1] for x in vl if x[0] == u.username][0]
-            setattr(u, "visit_created", v)
-        except IndexError:
-            setattr(u, "visit_created", None)
-    user_list = sorted(user_list, key=lambda x: x.visit_created, reverse=True)
+    pg = int(request.GET.get("page", 1))
+
+    # Paginate the recent visitors, most recent first, and fetch only the
+    # users of the page, with the visit time as "flag_created".
+    ul = prepare_paginated_user_list(get_recent_visitors(request.user.id), pg)
+    user_list = get_visitors_list(ul.object_list)
+    for u in user_list:
+        u.flag_created = u.visit_created
 
     # Reset the new_views_count value
     request.user.profile.new_views_count = 0
@@ -535,6 +563,25 @@ def visitors_api(request, format=None):
     )
 
 
+def get_keyset_user_list(request, queryset, ordering, count, prefix="",
+                         flag_created=None):
+    """
+    Return the response data of one page of a cursor paginated user list,
+    after the "cursor" GET parameter, see utils_pagination. The client gets
+    the "next_cursor" for the following page, which is null on the last
+    page, and the approximate "count" of all users in the list.
+    """
+    columns = get_basic_user_columns(prefix, flag_created)
+    page = get_keyset_page(
+        queryset, ordering, request.GET.get("cursor"), columns
+    )
+    return {
+        "count": count,
+        "next_cursor": page.next_cursor,
+        "user_list": [get_basic_user_data(row) for row in page],
+    }
+
+
 def update_search_if_changed(opts, user, session_obj=None):
     """Update all posted search uptions in authuser's Profile."""
     changed = False
@@ -605,6 +652,7 @@ def update_search_if_changed(opts, user, session_obj=None):
     user.profile.save(
         update_fields=[
             "f_sex",
+            "f_distance",
             "f_minage",
             "f_maxage",
             "f_hide_no_pic",
@@ -648,22 +696,19 @@ def flag_api(request, flag, username, format=None):
 
     if request.method == "POST":
         Flag.set_flag(request.user, view_user, flag)
-        update_fields = ["new_likes_count"]
         if flag == "like":
             # Count the like in the view_user profile.
-            view_user.profile.new_likes_count += 1
+            deltas = {"new_likes_count": 1}
             # Check if we have a match, count it, and return {'match': 1}
             if request.user.profile.match_with(view_user):
-                request.user.profile.new_matches_count += 1
-                request.user.profile.save()
-                view_user.profile.new_matches_count += 1
-                update_fields.append("new_matches_count")
+                incr_profile_counters(request.user.id, new_matches_count=1)
+                deltas["new_matches_count"] = 1
                 data["is_match"] = 1
                 nt = "match"
             else:
                 nt = "upvote"
             simple_push_notification(request.user, view_user, nt)
-            view_user.profile.save(update_fields=update_fields)
+            incr_profile_counters(view_user.id, **deltas)
 
     if request.method == "DELETE":
         # This deletes any flag, because a user can only ever set one flag on
@@ -687,6 +732,11 @@ def pms_list(request, username, format=None):
         client. If there is no message shown yet on the client and after is
         unset, then get the x most recent messages.
 
+    GET api/v1/pms/<username>?before=<id>
+
+        Return a list of x messages with an id smaller than <id>, to load the
+        messages older than the oldest message currently displayed.
+
     POST api/v1/pms/<username> msg="Message text"&after=<id>
 
         Create a new message from auth user to <username>. Then return a list
@@ -702,8 +752,7 @@ def pms_list(request, username, format=None):
         after = body.get("after", None)
 
         # Store message
-        kwargs = {"sender": request.user, "receiver": view_user, "msg": msg}
-        Message.objects.create(**kwargs)
+        Conversation.add_message(request.user, view_user, msg)
 
         # Send push notification to receiver
         args = [request.user, view_user, "message", "{}".format(msg[:60])]
@@ -713,11 +762,16 @@ def pms_list(request, username, format=None):
         return JsonResponse(data=get_msg_data(after, request.user, view_user))
 
     elif request.method == "GET":
-        after = request.GET.get("after", None)
-        return JsonResponse(data=get_msg_data(after, request.user, view_user))
+        after = force_int(request.GET.get("after", None)) or None
+        before = force_int(request.GET.get("before", None)) or None
+        # Auth user is reading the conversation now.
+        Conversation.mark_read(request.user, view_user)
+        return JsonResponse(
+            data=get_msg_data(after, request.user, view_user, before)
+        )
 
 
-def get_msg_data(after, user1, user2):
-    obj = Message.get_messages_list(after, user1, user2)
+def get_msg_data(after, user1, user2, before=None):
+    obj = Message.get_messages_list(after, user1, user2, before)
     li = MessageSerializer(obj, many=True).data
     return {"msg_list": li}
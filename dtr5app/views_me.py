@@ -18,17 +18,23 @@ from django.views.decorators.http import require_http_methods
 from simple_reddit_oauth import api
 from toolbox import force_int, force_float, get_age
 from toolbox_imgur import set_imgur_url
-from .models import Subscribed, Flag, Report
+from .models import Subscribed, Flag, Match, Report
 from .utils import (
     get_matches_user_queryset,
     update_list_of_subscribed_subreddits,
     get_prevnext_user,
     get_user_and_related_or_404,
+    get_user_list_from_id_list,
     PictureInaccessibleError,
     assert_pic_accessible,
     count_matches,
 )
-from .utils_search import search_results_buffer, update_search_settings
+from .utils_counters import incr_profile_counters, update_profile_counters
+from .utils_search import (
+    SearchBuffer,
+    search_results_buffer,
+    update_search_settings,
+)
 
 
 @login_required
@@ -94,7 +100,7 @@ def me_view(request, template_name="dtr5app/me.html"):
             date.today().year - 18, date.today().month, date.today().day
         )
 
-    elif len(request.user.profile.pics) == 0:
+    elif request.user.profile.pic_count == 0:
         # no pics yet, ask to link one picture
         template_name = "dtr5app/step_5.html"
         request.session["view_post_signup"] = True
@@ -168,7 +174,19 @@ def me_update_view(request):
         p.hide_from_robots = bool(reddit_user["hide_from_robots"])
         p.has_verified_email = bool(reddit_user["has_verified_email"])
         p.gold_creddits = bool(reddit_user["gold_creddits"])
-        p.save()
+        p.save(
+            update_fields=[
+                "name",
+                "created",
+                "updated",
+                "link_karma",
+                "comment_karma",
+                "over_18",
+                "hide_from_robots",
+                "has_verified_email",
+                "gold_creddits",
+            ]
+        )
         # messages.success(request, 'Profile data updated.')
     else:
         messages.warning(request, "Could not find any user profile data.")
@@ -194,7 +212,7 @@ def me_locate_view(request, template_name="dtr5app/location_form.html"):
     request.user.profile.fuzzy = force_float(request.POST.get("fuzzy", 2))
     request.user.profile.lat = force_float(request.POST.get("lat", 0.0))
     request.user.profile.lng = force_float(request.POST.get("lng", 0.0))
-    request.user.profile.save()
+    request.user.profile.save(update_fields=["fuzzy", "lat", "lng"])
     # messages.success(request, 'Location data updated.')
 
     if request.is_ajax():
@@ -283,7 +301,22 @@ def me_manual_view(request):
     if request.POST.get("fitness", None):  # unused
         request.user.profile.fitness = request.POST.get("fitness")
 
-    request.user.profile.save()
+    request.user.profile.save(
+        update_fields=[
+            "dob",
+            "sex",
+            "about",
+            "_lookingfor",
+            "_pref_distance_unit",
+            "herefor",
+            "tagline",
+            "relstatus",
+            "education",
+            "height",
+            "weight",
+            "fitness",
+        ]
+    )
     # messages.success(request, 'Profile data updated.')
 
     if request.is_ajax():
@@ -337,7 +370,7 @@ def me_picture_view(request):
         request.user.profile.background_pic = bg_url
         messages.info(request, "background picture updated.")
 
-    request.user.profile.save()
+    request.user.profile.save(update_fields=["_pics", "background_pic"])
 
     if request.is_ajax():
         return HttpResponse()  # HTTP 200
@@ -356,7 +389,7 @@ def me_pic_del_view(request):
         request.user.profile.pics = [
             x for x in request.user.profile.pics if x["url"] != pic_url
         ]
-        request.user.profile.save()
+        request.user.profile.save(update_fields=["_pics"])
         messages.info(request, "Picture removed.")
     except:
         messages.info(request, "Picture not found.")
@@ -377,13 +410,14 @@ def me_search_view(request):
 
     if request.method in ["GET", "HEAD"]:
         # Find the next profile to show and redirect.
-        search_results_buffer(request)
+        buff = search_results_buffer(request)
+        user_list = get_user_list_from_id_list(buff[:1])
 
-        if len(request.session["search_results_buffer"]) < 1:
+        if len(user_list) < 1:
             messages.warning(request, txt_not_found)
             return redirect(request.POST.get("next", reverse("me_page")))
 
-        x = {"username": request.session["search_results_buffer"][0]}
+        x = {"username": user_list[0].username}
         _next = request.POST.get("next", reverse("profile_page", kwargs=x))
         return redirect(_next)
 
@@ -391,9 +425,9 @@ def me_search_view(request):
     # TODO: check if model is dirty and only force a search results
     # buffer refresh if the search parameters actually changed. To
     # avoid too many searches.
-    search_results_buffer(request, force=True)
+    buff = search_results_buffer(request, force=True)
     _next = request.POST.get("next", reverse("me_results_page"))
-    if len(request.session["search_results_buffer"]) < 1:
+    if len(buff) < 1 and not buff.refreshing:
         messages.warning(request, txt_not_found)
 
     if request.is_ajax():
@@ -413,18 +447,16 @@ def me_account_del_view(request, template_name="dtr5app/account_del.html"):
         # users match counts. currently, it can happen that a user sees a
         # match in the "upvote matches" header, but that match was from a
         # deleted user who doesn't exist anymore.
-        qs = get_matches_user_queryset(request.user)
-        qs = qs.prefetch_related("profile")
-        for match_user in qs:
-            if match_user.profile.matches_count > 0:
-                match_user.profile.matches_count -= 1
-                match_user.profile.save()
+        update_profile_counters(
+            get_matches_user_queryset(request.user).values("id"), matches_count=-1
+        )
 
         # remove all data
         request.user.profile.reset_all_and_save()
         request.user.subs.all().delete()
         request.user.flags_sent.all().delete()
         request.user.flags_received.all().delete()
+        Match.delete_user_matches(request.user)
         # if user's last_login is None means they have not activated their
         # account or have deleted it. either way, treat it as if it doesn't
         # exist.
@@ -464,8 +496,9 @@ def me_flag_del_view(request, template_name="dtr5app/flag_del_all.html"):
     q.delete()
 
     if Flag.FLAG_DICT["like"] in flag_ids:
+        Match.delete_user_matches(request.user)
         request.user.profile.matches_count = 0
-        request.user.profile.save()
+        request.user.profile.save(update_fields=["matches_count"])
     # messages.info(request, '{} items deleted.'.format(count))
 
     if request.is_ajax():
@@ -480,7 +513,7 @@ def me_flag_view(request, action, flag, username):
     """
     Let auth user set a flag for their relation to view user. Then
     redirect to GET[next] value, if exists, or to the next user in
-    session[search_results_buffer] list.
+    search results buffer.
 
     Valid action values: 'set', 'delete'.
     Valid flag values: 'like', 'nope', 'report'.
@@ -502,16 +535,13 @@ def me_flag_view(request, action, flag, username):
         Flag.set_flag(request.user, view_user, flag)
 
         if flag == "like":
-            view_user.profile.new_likes_count += 1
-            view_user.profile.save(update_fields=["new_likes_count"])
+            incr_profile_counters(view_user.id, new_likes_count=1)
 
             if request.user.profile.match_with(view_user):
                 # a match? then count the new match on both users'
                 # profiles.
-                request.user.profile.new_matches_count += 1
-                request.user.profile.save()
-                view_user.profile.new_matches_count += 1
-                view_user.profile.save()
+                incr_profile_counters(request.user.id, new_matches_count=1)
+                incr_profile_counters(view_user.id, new_matches_count=1)
                 # if authuser set a like flag, and we have a match, then
                 # show the newly matched profile again, so authuser can
                 # write them a message!
@@ -561,19 +591,21 @@ def me_flag_view(request, action, flag, username):
     if _next:
         return redirect(_next)
 
-    if len(request.session["search_results_buffer"]) > 0:
+    buff = SearchBuffer.load(request.user.id)
+    user_list = get_user_list_from_id_list(buff[:1])
+
+    if len(user_list) > 0:
         # if there are more profiles, show them.
-        if view_user.username in request.session["search_results_buffer"]:
-            prev_user, next_user = get_prevnext_user(request, view_user)
+        if view_user.id in buff:
+            prev_user, next_user = get_prevnext_user(buff, view_user)
             _next = reverse("profile_page", args={next_user.username})
-            username = view_user.username
-            request.session["search_results_buffer"].remove(username)
-            request.session.modified = True
+            buff.remove(view_user.id)
+            buff.save()
         else:
-            username = request.session["search_results_buffer"][0]
+            username = user_list[0].username
             _next = reverse("profile_page", args={username})
 
-    elif len(request.session["search_results_buffer"]) < 1:
+    else:
         messages.warning(request, "nobody found :(")
 
         return redirect(reverse("me_page"))
@@ -8,11 +8,14 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.core.paginator import Paginator, EmptyPage
 from django.urls import reverse
-from django.http import HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.http import require_http_methods
 
-from dtr5app.models import Report
+from dtr5app.models import Match, Report
+from dtr5app.utils_metrics import get_metrics, get_prometheus_metrics
+from dtr5app.utils_search_cache import get_search_cache_stats
+from dtr5app.utils_search_jobs import get_search_job_stats
 
 
 @staff_member_required
@@ -70,6 +73,7 @@ def mod_deluser_view(request, pk, template_name="dtr5app/mod_del_profile.html"):
         view_user.subs.all().delete()
         view_user.flags_sent.all().delete()
         view_user.flags_received.all().delete()
+        Match.delete_user_matches(view_user)
         # if user's last_login is None means they have not activated their
         # account or have deleted it. either way, treat it as if it doesn't
         # exist. ~~view_user.last_login = None~~
@@ -88,3 +92,41 @@ def mod_deluser_view(request, pk, template_name="dtr5app/mod_del_profile.html"):
     ctx = {"view_user": view_user}
 
     return render(request, template_name, ctx)
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def mod_search_cache_view(request):
+    """
+    For staff users to see hit ratio, build time and invalidation counts of
+    the shared search results cache.
+    """
+    return JsonResponse(get_search_cache_stats())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def mod_search_jobs_view(request):
+    """
+    For staff users to see the queue depth, wait and run times of the search
+    worker's jobs.
+    """
+    return JsonResponse(get_search_job_stats())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def mod_metrics_view(request):
+    """
+    For staff users to see the request metrics of this web server process,
+    per view, with the slowest sampled queries.
+    """
+    return JsonResponse(get_metrics())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def mod_metrics_prometheus_view(request):
+    """Same as mod_metrics_view(), in the Prometheus text format."""
+    return HttpResponse(get_prometheus_metrics(),
+                        content_type="text/plain; version=0.0.4")
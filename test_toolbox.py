@@ -36,3 +36,42 @@ class ToolboxTestCase(SimpleTestCase):
             self.assertEqual(res, mres[i])
             res = toolbox_imgur.set_imgur_url(orig[i], 't')
             self.assertEqual(res, tres[i])
+
+    def test_get_latlng_bounderies(self):
+        lat_min, lng_min, lat_max, lng_max = \
+            toolbox.get_latlng_bounderies(52.52, 13.40, 100)
+        # 100 km are about 0.9 degrees latitude, and at 52.5 degrees north
+        # about 1.48 degrees longitude.
+        self.assertAlmostEqual(lat_max - 52.52, 0.899, places=2)
+        self.assertAlmostEqual(52.52 - lat_min, 0.899, places=2)
+        self.assertAlmostEqual(lng_max - 13.40, 1.48, places=1)
+
+        # a pole within the area: all longitudes.
+        box = toolbox.get_latlng_bounderies(89.5, 13.40, 100)
+        self.assertEqual((box[1], box[2], box[3]), (-180.0, 90.0, 180.0))
+
+    def test_get_geo_cell_ranges(self):
+        berlin = toolbox.get_geo_cell(52.52, 13.40)
+        potsdam = toolbox.get_geo_cell(52.40, 13.06)
+        munich = toolbox.get_geo_cell(48.14, 11.58)
+        ranges = toolbox.get_geo_cell_ranges(52.52, 13.40, 50)
+
+        def covered(cell):
+            return any(a <= cell <= b for a, b in ranges)
+
+        self.assertTrue(covered(berlin))
+        self.assertTrue(covered(potsdam))
+        self.assertFalse(covered(munich))
+
+        # areas across the antimeridian wrap around.
+        ranges = toolbox.get_geo_cell_ranges(-17.7, 179.9, 100)
+        self.assertTrue(covered(toolbox.get_geo_cell(-17.7, -179.5)))
+        self.assertTrue(covered(toolbox.get_geo_cell(-17.7, 179.5)))
+        self.assertFalse(covered(toolbox.get_geo_cell(-17.7, 0.0)))
+
+        # lng_max just east of 180 falls into the last column, lng 180 only.
+        ranges = toolbox.get_geo_cell_ranges(0.0, 179.9, 20)
+        self.assertTrue(covered(toolbox.get_geo_cell(0.0, -179.95)))
+        self.assertTrue(covered(toolbox.get_geo_cell(0.0, 179.95)))
+
+        self.assertIsNone(toolbox.get_geo_cell_ranges(0.0, 0.0, 20100))
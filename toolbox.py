@@ -8,7 +8,6 @@ from datetime import date, datetime
 import dateutil.parser
 import pytz
 import re
-from geopy.distance import great_circle
 
 
 def meters_in_km(m):
@@ -226,6 +225,12 @@ def get_eastern_zodiac_symbol(dob):
 
 # --- Geolocation --------------------------------------------------- #
 
+EARTH_RADIUS_KM = 6371.0
+# Size of the grid cells of Profile.geo_cell in degrees. Changing it needs a
+# recalculation of all cells, see migration 0047_profile_geo_cell.
+GEO_CELL_DEGREES = 0.5
+GEO_CELL_COLS = int(360 / GEO_CELL_DEGREES) + 1  # incl. lng 180 == -180
+
 
 def distance_between_geolocations(p1, p2):
     """
@@ -245,6 +250,31 @@ def distance_between_geolocations(p1, p2):
     return 12742000 * math.asin(math.sqrt(a))  # 12742000 == 2 * Earth radius
 
 
+def get_latlng_box(lat, lng, distance):
+    """
+    Return min/max lat/lng values for a distance around a latlng, with the
+    longitudes not wrapped around the antimeridian, i.e. lng_min may be
+    below -180 and lng_max above 180. If the area contains a pole, it
+    spans all longitudes.
+
+    :lat:, :lng: the center of the area.
+    :distance: in km, the "radius" around the center point.
+    """
+    d = distance / EARTH_RADIUS_KM  # angular radius
+    lat_min = lat - math.degrees(d)
+    lat_max = lat + math.degrees(d)
+
+    # Smallest box around a circle on a sphere, as explained on
+    # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+    cos_lat = math.cos(math.radians(lat))
+    if lat_min <= -90 or lat_max >= 90 or d >= math.pi / 2 or \
+            math.sin(d) >= cos_lat:
+        return max(lat_min, -90.0), -180.0, min(lat_max, 90.0), 180.0
+
+    dlng = math.degrees(math.asin(math.sin(d) / cos_lat))
+    return lat_min, lng - dlng, lat_max, lng + dlng
+
+
 def get_latlng_bounderies(lat, lng, distance):
     """
     Return min/max lat/lng values for a distance around a latlng.
@@ -253,16 +283,59 @@ def get_latlng_bounderies(lat, lng, distance):
     :distance: in km, the "radius" around the center point.
 
     :returns: Two corner points of a square that countains the circle,
-              lat_min, lng_min, lat_max, lng_max.
+              lat_min, lng_min, lat_max, lng_max. An area that crosses the
+              antimeridian is cut off there, use get_geo_cell_ranges() to
+              find all of it.
     """
-    gc = great_circle(kilometers=distance)
-    p0 = gc.destination((lat, lng), 0)
-    p90 = gc.destination((lat, lng), 90)
-    p180 = gc.destination((lat, lng), 180)
-    p270 = gc.destination((lat, lng), 270)
-
-    ret = p180[0], p270[1], p0[0], p90[1]
-    print(ret)
-    return ret
+    lat_min, lng_min, lat_max, lng_max = get_latlng_box(lat, lng, distance)
+    return lat_min, max(lng_min, -180.0), lat_max, min(lng_max, 180.0)
+
+
+def get_geo_cell(lat, lng):
+    """
+    Return the number of the grid cell of GEO_CELL_DEGREES size that
+    contains the location. Cells are numbered row by row, from the south
+    pole and the antimeridian.
+    """
+    row = math.floor((min(max(lat, -90.0), 90.0) + 90) / GEO_CELL_DEGREES)
+    col = math.floor((min(max(lng, -180.0), 180.0) + 180) / GEO_CELL_DEGREES)
+    return row * GEO_CELL_COLS + col
+
+
+def get_geo_cell_ranges(lat, lng, distance):
+    """
+    Return a list of (first, last) ranges of grid cells, see get_geo_cell(),
+    that together cover a distance around a latlng, or None if that covers
+    the entire world.
+    """
+    lat_min, lng_min, lat_max, lng_max = get_latlng_box(lat, lng, distance)
+    if lat_min <= -90 and lat_max >= 90:
+        return None
+
+    last_col = GEO_CELL_COLS - 1
+    col_min = math.floor((lng_min + 180) / GEO_CELL_DEGREES)
+    col_max = math.floor((lng_max + 180) / GEO_CELL_DEGREES)
+    if col_max - col_min >= last_col:
+        spans = [(0, last_col)]
+    elif col_min < 0:  # wraps around the antimeridian to the west
+        spans = [(0, col_max), (col_min + last_col, last_col)]
+    elif col_max >= last_col:  # wraps around the antimeridian to the east
+        # The last column only holds lng 180, so the wrapped part starts at
+        # column 0 already for lng_max in [180, 180 + GEO_CELL_DEGREES).
+        wrap_max = math.floor((lng_max - 360 + 180) / GEO_CELL_DEGREES)
+        spans = [(0, wrap_max), (col_min, last_col)]
+    else:
+        spans = [(col_min, col_max)]
+
+    ranges = []
+    for row in range(get_geo_cell(lat_min, 0) // GEO_CELL_COLS,
+                     get_geo_cell(lat_max, 0) // GEO_CELL_COLS + 1):
+        for a, b in spans:
+            first, last = row * GEO_CELL_COLS + a, row * GEO_CELL_COLS + b
+            if ranges and ranges[-1][1] + 1 >= first:
+                ranges[-1] = (ranges[-1][0], last)  # adjacent, merge them
+            else:
+                ranges.append((first, last))
+    return ranges
 
 # ------------------------------------------------------------------- #